@@ -0,0 +1,183 @@
+# -*- coding: utf-8 -*-
+"""
+Logging helpers, keeping disk I/O away from hot paths (radio loop, socket
+broadcasts).
+
+* `AsyncHandler` puts records to a bounded queue, a background thread writes
+  them to the real handler. If the queue is full, the record is dropped and
+  counted, the caller never waits for the disk.
+* `RateLimitFilter` limits chatty per-message logs: every logger gets its own
+  token bucket, debug records over the budget are sampled.
+
+Both are meant to be used from `dictConfig`, see server.py.
+"""
+
+import logging
+import logging.handlers
+from threading import Thread, Lock
+from time import time
+from Queue import Queue, Full
+
+_handlers = []
+_filters = []
+
+_STOP = object()
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Non-blocking wrapper around another handler.
+    """
+    def __init__(self, target, maxsize=10000):
+        logging.Handler.__init__(self)
+        self.target = target
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._queue = Queue(maxsize)
+
+        self._thread = Thread(target=self._writer, name='log-writer')
+        self._thread.daemon = True
+        self._thread.start()
+
+        _handlers.append(self)
+
+    def setFormatter(self, fmt):
+        logging.Handler.setFormatter(self, fmt)
+        self.target.setFormatter(fmt)
+
+    def _prepare(self, record):
+        """
+        Make a record safe to be processed in another thread:
+        merge arguments into the message and render the traceback.
+        """
+        record.msg = record.getMessage()
+        record.args = None
+
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+
+        return record
+
+    def emit(self, record):
+        try:
+            self._queue.put_nowait(self._prepare(record))
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _report_dropped(self):
+        dropped = self.dropped
+        if dropped == self._reported_dropped:
+            return
+
+        record = logging.LogRecord(
+            __name__, logging.WARNING, __file__, 0,
+            '%s log records dropped, queue is full',
+            (dropped - self._reported_dropped,), None,
+        )
+        self._reported_dropped = dropped
+        self.target.handle(record)
+
+    def _writer(self):
+        while True:
+            record = self._queue.get()
+            if record is _STOP:
+                return
+
+            try:
+                self.target.handle(record)
+            except Exception:
+                self.handleError(record)
+
+            if self._queue.empty():
+                self._report_dropped()
+
+    def close(self):
+        if self._thread.is_alive():
+            # Blocking put - we want to flush everything before exit.
+            self._queue.put(_STOP)
+            self._thread.join()
+
+        self.target.close()
+
+        if self in _handlers:
+            _handlers.remove(self)
+
+        logging.Handler.close(self)
+
+
+def async_file_handler(maxsize=10000, **kwargs):
+    """
+    `TimedRotatingFileHandler`, written in a background thread.
+    """
+    return AsyncHandler(
+        logging.handlers.TimedRotatingFileHandler(**kwargs),
+        maxsize=maxsize,
+    )
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Allows up to `rate` records per second per logger (with bursts up to `burst`).
+    Records over the limit are sampled: only every `sample_every`-th passes.
+    Records above `max_level` are never limited: per-message logs are DEBUG,
+    lifecycle ones (start, stop, node online/offline) always get through.
+    """
+    def __init__(self, rate=10, burst=50, sample_every=100, max_level='DEBUG'):
+        logging.Filter.__init__(self)
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self.sample_every = sample_every
+        self.max_level = logging.getLevelName(max_level) \
+            if isinstance(max_level, basestring) else max_level
+
+        self.suppressed = {}
+        # logger name -> [tokens, last update time, records over the limit]
+        self._buckets = {}
+        self._lock = Lock()
+
+        _filters.append(self)
+
+    def filter(self, record):
+        if record.levelno > self.max_level:
+            return True
+
+        now = time()
+
+        with self._lock:
+            bucket = self._buckets.get(record.name)
+            if bucket is None:
+                bucket = self._buckets[record.name] = [self.burst, now, 0]
+
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+
+            if bucket[0] >= 1:
+                bucket[0] -= 1
+                return True
+
+            bucket[2] += 1
+            if self.sample_every and bucket[2] % self.sample_every == 0:
+                return True
+
+            self.suppressed[record.name] = self.suppressed.get(record.name, 0) + 1
+            return False
+
+
+def get_stats():
+    """
+    Number of dropped (queue overflow) and suppressed (rate limit) records.
+    """
+    suppressed = {}
+    for f in _filters:
+        with f._lock:
+            for name, count in f.suppressed.iteritems():
+                suppressed[name] = suppressed.get(name, 0) + count
+
+    return {
+        'dropped': sum(h.dropped for h in _handlers),
+        'queued': sum(h._queue.qsize() for h in _handlers),
+        'suppressed': suppressed,
+    }
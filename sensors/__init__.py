@@ -5,4 +5,5 @@ from . import (
     weather,
     endomondo,
     wireless,
+    views,
 )
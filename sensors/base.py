@@ -20,12 +20,8 @@ with public methods `get_value` and `set_value`.
 from threading import Thread, Lock
 import logging
 from time import sleep
-from db import conn_pool
 import json
 
-from psycopg2 import Error as PsycopgError
-from app import app
-
 from .socket_server import server as SServer
 
 log = logging.getLogger(__name__)
@@ -82,6 +78,10 @@ class Sensor(object):
             sensor.stop()
 
     def _iteration(self):
+        """
+        Returns False if there was nothing to do, then the status is
+        left as it is.
+        """
         raise NotImplementedError()
 
     def _get_value(self, key):
@@ -116,32 +116,72 @@ class Sensor(object):
         """
 
     def _process_socket_messages(self):
+        """
+        Answer consumers' requests. If a request has an `id` field, it's copied
+        to the response, so consumers can send many requests without waiting
+        and match responses (and tell them apart from broadcasts).
+        Requests with `id` always get a response, even if it's just an ack.
+        A sensor can answer with a future (`add_done_callback`), then the
+        response is sent when it's done.
+        """
         for sensor_name, data, fno in SServer.get_messages():
+            request_id = data.get('id')
             sensor = Sensor.by_name(sensor_name)
 
             if not sensor:
                 log.warning('Socket message for unexpected sensor %s', sensor_name)
+                if request_id is not None:
+                    SServer.send_message(
+                        json.dumps({'id': request_id, 'error': 'sensor not found'}),
+                        fno,
+                    )
                 continue
 
             try:
                 response = sensor.process_client_message(data)
+            except Exception as ex:
+                log.warning('Error while processing socket message:', exc_info=ex)
+                response = {'error': 'internal error'}
+
+            if hasattr(response, 'add_done_callback'):
+                response.add_done_callback(
+                    lambda f, request_id=request_id, fno=fno: self._send_response(
+                        self._future_response(f), request_id, fno,
+                    ),
+                )
+                continue
 
-                if response is None:
-                    return
+            self._send_response(response, request_id, fno)
 
-                if not isinstance(response, basestring):
-                    response = json.dumps(response)
+    @staticmethod
+    def _future_response(future):
+        ex = future.exception()
+        if ex is not None:
+            return {'error': str(ex)}
 
-                SServer.send_message(response, fno)
-            except Exception as ex:
-                log.warning('Error while processing socket message:', exc_info=ex)
+        return future.result()
+
+    @staticmethod
+    def _send_response(response, request_id, fno):
+        if response is None:
+            if request_id is None:
+                return
+            response = {'status': 'ok'}
+
+        if request_id is not None and isinstance(response, dict):
+            response = dict(response, id=request_id)
+
+        if not isinstance(response, basestring):
+            response = json.dumps(response)
+
+        SServer.send_message(response, fno)
 
     def _loop(self):
         while True:
             try:
-                self._iteration()
-                self.errors_count = 0
-                self.set_value('status', self.STATUS_OK)
+                if self._iteration() is not False:
+                    self.errors_count = 0
+                    self.set_value('status', self.STATUS_OK)
             except Exception as ex:
                 if isinstance(ex, SensorError):
                     log.error(
@@ -165,6 +205,10 @@ class Sensor(object):
                     sleep(t)
 
     def db_execute(self, command):
+        # Not on import, so sensors can be used without the database (tools)
+        from db import conn_pool
+        from psycopg2 import Error as PsycopgError
+
         if not self._conn:
             self._conn = conn_pool.getconn()
 
@@ -176,20 +220,3 @@ class Sensor(object):
             log.error('Error while executing request %s: %s', command, ex)
             self._conn.rollback()
 
-
-@app.route('/sensors/list')
-def list_sensors():
-    sensors = []
-    for s in Sensor._active_sensors:
-        sensors.append({
-            'name': s.NAME,
-            'loop_delay': s.LOOP_DELAY,
-            'status': s.get_value('status'),
-            'errors_count': s._errors_count,
-            'errors_threshold': s.ERRORS_THRESHOLD,
-        })
-
-    return json.dumps({
-        'status': 'ok',
-        'data': sensors,
-    })
@@ -18,6 +18,8 @@ import json
 
 import logging
 
+from ..http_client import client
+
 URL_BASE = 'https://api.mobile.endomondo.com'
 URL_AUTHENTICATE = URL_BASE + '/mobile/auth'
 URL_WORKOUTS = URL_BASE + '/mobile/api/workouts'
@@ -51,9 +53,6 @@ class MobileApi(object):
     auth_token = None
     secure_token = None
 
-    Requests = requests.session()
-
-
     device_info = {
         'os':            platform.system(),
         'model':        platform.python_implementation(),
@@ -75,19 +74,20 @@ class MobileApi(object):
         email = kwargs.get('email')
         password = kwargs.get('password')
 
-        if kwargs.get('auth_token'):
-            self.set_auth_token(kwargs.get('auth_token'))
-        elif email and password:
-            self.set_auth_token(self.request_auth_token(email, password))
-
         if self.device_info['os'] in ['Linux']:
             self.device_info['vendor'] = platform.linux_distribution()[0]
 
-        self.Requests.headers['User-Agent'] = (
-            '{appVariant}/{appVersion} ({os}; {osVersion}; {model}) {vendor}'.format(
+        # Per instance, the HTTP session is shared with other sensors
+        self.headers = {
+            'User-Agent': '{appVariant}/{appVersion} ({os}; {osVersion}; {model}) {vendor}'.format(
                 **self.device_info
-            )
-        )
+            ),
+        }
+
+        if kwargs.get('auth_token'):
+            self.set_auth_token(kwargs.get('auth_token'))
+        elif email and password:
+            self.set_auth_token(self.request_auth_token(email, password))
 
     def get_auth_token(self):
         return self.auth_token
@@ -119,7 +119,7 @@ class MobileApi(object):
             'password':    password
         })
 
-        r = self.Requests.get(URL_AUTHENTICATE, params=params)
+        r = client.get(URL_AUTHENTICATE, params=params, headers=self.headers)
 
         lines = r.text.split("\n")
         if lines[0] != 'OK':
@@ -162,7 +162,8 @@ class MobileApi(object):
         elif data and params.get('deflate') == 'true':
             data = zlib.compress(data)
 
-        r = self.Requests.request(method, url, data=data, params=params, **kwargs)
+        kwargs['headers'] = dict(self.headers, **kwargs.get('headers', {}))
+        r = client.request(method, url, data=data, params=params, **kwargs)
 
         if r.status_code != requests.codes.ok:
             logging.debug(
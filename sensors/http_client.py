@@ -0,0 +1,230 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP client, shared by all the sensors talking to external services.
+
+* One keep-alive session, with a connection pool per host.
+* Default (connect, read) timeouts, so a hung socket never stalls a sensor.
+* Idempotent requests are retried on connection errors and 5xx responses,
+  with exponential backoff.
+* Token bucket per quota key (e.g. API key). Buckets start empty, so
+  a restart doesn't burst past the quota.
+* Per-host metrics: requests, errors, retries, quota waits and latencies,
+  see `/sensors/http`.
+
+    from ..http_client import client
+    client.set_quota(API_KEY, per_minute=60)
+    response = client.get(url, params={...}, quota_key=API_KEY)
+"""
+from __future__ import unicode_literals
+
+import json
+import logging
+import random
+from threading import Lock
+from time import time, sleep
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from app import app
+from .base import SensorError
+from .tracing import Histogram
+
+log = logging.getLogger(__name__)
+
+
+class HttpError(SensorError):
+    pass
+
+
+class TokenBucket(object):
+    def __init__(self, rate, burst):
+        """
+        :param rate: tokens per second.
+        :param burst: max tokens saved up.
+        """
+        self.rate = rate
+        self.burst = burst
+        self._tokens = 0.0
+        self._updated = time()
+        self._lock = Lock()
+
+    def take(self, max_wait):
+        """
+        Take a token, waiting for it if needed.
+        :return: seconds waited.
+        """
+        with self._lock:
+            now = time()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+            if self._tokens >= 1:
+                wait = 0
+            elif not self.rate:
+                raise HttpError('Quota exceeded, no more requests')
+            else:
+                wait = (1 - self._tokens) / self.rate
+                if wait > max_wait:
+                    raise HttpError('Quota exceeded, next request in %.1f seconds' % wait)
+
+            # Reserved now, so waiting callers are served in order
+            self._tokens -= 1
+
+        if wait:
+            sleep(wait)
+        return wait
+
+
+class HostMetrics(object):
+    def __init__(self):
+        self.requests = 0
+        self.errors = 0
+        self.retries = 0
+        self.quota_wait = 0.0
+        # HTTP status -> count
+        self.statuses = {}
+        self.latency = Histogram()
+
+    def to_dict(self):
+        return {
+            'requests': self.requests,
+            'errors': self.errors,
+            'retries': self.retries,
+            'quota_wait_seconds': round(self.quota_wait, 3),
+            'statuses': self.statuses,
+            'latency': self.latency.to_dict(),
+        }
+
+
+class HttpClient(object):
+    # (connect, read) seconds
+    TIMEOUT = (3.05, 10)
+    RETRIES = 2
+    # Before the first retry, seconds. Doubled for every next one.
+    BACKOFF = 0.5
+    RETRY_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+    # Hosts with their own pools, and connections kept per host
+    POOL_HOSTS = 10
+    POOL_SIZE = 4
+    # Max time to wait for a quota token, seconds
+    QUOTA_WAIT = 30
+
+    def __init__(self):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=self.POOL_HOSTS,
+            pool_maxsize=self.POOL_SIZE,
+            max_retries=0,
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+        # quota key -> TokenBucket
+        self._quotas = {}
+        # host -> HostMetrics
+        self._metrics = {}
+        self._lock = Lock()
+
+    def set_quota(self, key, per_minute, burst=None):
+        """
+        Never more than `per_minute` requests with the `key` in any minute.
+        :param burst: requests which can be sent at once, 10% by default.
+            Must be less than `per_minute`, the rest of the minute is for
+            the steady rate.
+        """
+        if burst is None:
+            burst = max(1, per_minute // 10)
+        if not 1 <= burst < per_minute:
+            raise ValueError('Bad quota: %s per minute, burst %s' % (per_minute, burst))
+
+        with self._lock:
+            if key not in self._quotas:
+                self._quotas[key] = TokenBucket((per_minute - burst) / 60.0, burst)
+
+    def _record(self, host, latency=None, status=None, error=False, retry=False, quota_wait=0):
+        with self._lock:
+            metrics = self._metrics.get(host)
+            if metrics is None:
+                metrics = self._metrics[host] = HostMetrics()
+
+            if latency is not None:
+                metrics.requests += 1
+                metrics.latency.add(latency * 1e6)
+            if status is not None:
+                metrics.statuses[status] = metrics.statuses.get(status, 0) + 1
+            metrics.errors += error
+            metrics.retries += retry
+            metrics.quota_wait += quota_wait
+
+    def request(self, method, url, quota_key=None, retries=None, quota_wait=None, **kwargs):
+        """
+        Same as `requests.request`. Responses with any status are returned,
+        5xx ones - after all retries.
+        :param quota_key: every attempt takes a token of its quota.
+        :param retries: None - `RETRIES` for idempotent methods, 0 for others.
+        :raise HttpError: on connection errors, timeouts or no quota.
+        """
+        parsed = urlparse(url)
+        host = parsed.netloc
+        if retries is None:
+            retries = self.RETRIES if method.upper() in self.RETRY_METHODS else 0
+        kwargs.setdefault('timeout', self.TIMEOUT)
+
+        bucket = self._quotas.get(quota_key) if quota_key is not None else None
+        error = None
+
+        for attempt in xrange(retries + 1):
+            if attempt:
+                self._record(host, retry=True)
+                # Jitter, so sensors failed together don't retry together
+                sleep(self.BACKOFF * 2 ** (attempt - 1) * random.uniform(0.5, 1.5))
+
+            if bucket:
+                waited = bucket.take(self.QUOTA_WAIT if quota_wait is None else quota_wait)
+                self._record(host, quota_wait=waited)
+
+            started = time()
+            try:
+                response = self.session.request(method, url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout) as ex:
+                self._record(host, latency=time() - started, error=True)
+                # No query string, it may have keys
+                error = HttpError('%s %s%s: %s' % (method, host, parsed.path, ex))
+                log.warning('[%s/%s] %s', attempt + 1, retries + 1, error)
+                continue
+            except requests.RequestException as ex:
+                self._record(host, error=True)
+                raise HttpError('%s %s%s: %s' % (method, host, parsed.path, ex))
+
+            status = response.status_code
+            self._record(host, latency=time() - started, status=status, error=status >= 500)
+            if status >= 500 and attempt < retries:
+                log.warning('[%s/%s] %s %s%s: HTTP %s', attempt + 1, retries + 1, method, host, parsed.path, status)
+                continue
+
+            return response
+
+        raise error
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def get_metrics(self):
+        with self._lock:
+            return {host: metrics.to_dict() for host, metrics in self._metrics.iteritems()}
+
+
+client = HttpClient()
+
+
+@app.route('/sensors/http')
+def read_http_metrics():
+    return json.dumps({
+        'status': 'ok',
+        'data': client.get_metrics(),
+    })
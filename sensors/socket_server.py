@@ -4,15 +4,23 @@
 Fast and reliable way to provide sensors' interface. Main point - ability to
 push state changes to all registered consumers directly and without HTTP overhead,
 just send JSON data directly.
+
+Every message is a JSON object on a separate line. Requests can have an `id`
+field, which is copied to the response. It allows to send many requests without
+waiting for responses, and to tell responses apart from broadcasts.
 """
 
 from __future__ import unicode_literals
 from threading import Thread, Lock
+from collections import deque
+import errno
 import socket
 import logging
 import select
 import json
 
+from .tracing import tracer
+
 logger = logging.getLogger(__name__)
 
 
@@ -20,13 +28,20 @@ class ClientSocket(object):
     def __init__(self, conn):
         self.conn = conn
         self.initialized = False
+        # Incomplete message, waiting for the rest of it.
+        self.buffer = b''
 
         # Keep track of all registration, so we can clean them on removal.
         self.registrations = set()
 
 
 class SocketServer(object):
-    EPOLL_REG_FLAGS = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP
+    # Edge-triggered: we get one event per change, so every socket has to be
+    # drained (accept/recv until EAGAIN) before waiting again.
+    EPOLL_REG_FLAGS = select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP | select.EPOLLET
+    EPOLL_MAX_EVENTS = 256
+    LISTEN_BACKLOG = 128
+    RECV_SIZE = 65536
 
     def __init__(self, port):
         self._port = port
@@ -35,11 +50,11 @@ class SocketServer(object):
         self.server_lock = Lock()
         self.registrations = {}
         self._epoll = select.epoll()
+        self._messages = deque()
 
         self._thread = Thread(target=self._listener)
         self._thread.daemon = True
         self._thread.start()
-        self._messages = []
 
     @staticmethod
     def _set_keepalive(sock, after_idle_sec=30, interval_sec=10, max_fails=5):
@@ -60,7 +75,7 @@ class SocketServer(object):
         some immediate request from consumer.
         :param data: string to be sent.
         """
-        logger.info('Sending data `%s` to %s', data, fno)
+        logger.debug('Sending data `%s` to %s', data, fno)
 
         self.server_lock.acquire()
 
@@ -92,7 +107,8 @@ class SocketServer(object):
         """
 
         if not isinstance(data, basestring):
-            data = json.dumps(data)
+            with tracer.span('json'):
+                data = json.dumps(data)
 
         self.server_lock.acquire()
 
@@ -104,7 +120,7 @@ class SocketServer(object):
             set(),
         )
 
-        logger.info(
+        logger.debug(
             'Sending broadcast socket message `%s:%s` `%s` to %s receivers',
             sensor_name,
             msg_stream,
@@ -115,16 +131,17 @@ class SocketServer(object):
         to_remove = []
 
         try:
-            for fno in sockets:
+            for fno in list(sockets):
                 sock = self.active_sockets.get(fno)
                 if not sock:
                     to_remove.append(fno)
                     continue
 
                 try:
-                    sock.conn.sendall(data)
-                    if not data.endswith('\n'):
-                        sock.conn.sendall('\n')
+                    with tracer.span('sendall'):
+                        sock.conn.sendall(data)
+                        if not data.endswith('\n'):
+                            sock.conn.sendall('\n')
 
                 except socket.error:
                     self._unregister_socket(fno)
@@ -132,7 +149,7 @@ class SocketServer(object):
 
             # Cleanup
             for fno in to_remove:
-                sockets.remove(fno)
+                sockets.discard(fno)
 
         finally:
             self.server_lock.release()
@@ -141,8 +158,9 @@ class SocketServer(object):
         """
         Get all messages and remove them from the local storage.
         """
-        output = self._messages
-        self._messages = []
+        output = []
+        while self._messages:
+            output.append(self._messages.popleft())
         return output
 
     def _unregister_socket(self, fno):
@@ -160,7 +178,7 @@ class SocketServer(object):
 
     def _process_message(self, fno, raw_data):
         # NOTE: all exception will be caught and logged outside
-        logger.info('Processing message %s from %s', raw_data, fno)
+        logger.debug('Processing message %s from %s', raw_data, fno)
 
         data = json.loads(raw_data)
         sensor_name = data['sensor']
@@ -185,33 +203,80 @@ class SocketServer(object):
         else:
             self._messages.append((sensor_name, data, fno))
 
-    def _process_event(self, server_socket, fno, event):
+    def _accept_connections(self, server_socket):
         """
-        Process a new EPOLL event.
+        Accept all pending connections at once.
         """
+        connections = []
+
+        while True:
+            try:
+                connection, address = server_socket.accept()
+            except socket.error as ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                raise
 
-        # New incoming socket connection.
-        if fno == server_socket.fileno():
-            connection, address = server_socket.accept()
             logger.info('New connection from %s', address)
 
             connection.setblocking(0)
             self._set_keepalive(connection)
+            connections.append(connection)
 
-            self._epoll.register(connection.fileno(), self.EPOLL_REG_FLAGS)
+        if not connections:
+            return
 
-            with self.server_lock:
+        with self.server_lock:
+            for connection in connections:
                 self.active_sockets[connection.fileno()] = ClientSocket(connection)
 
-        # New message from consumer
-        elif event & select.EPOLLIN:
-            data = self.active_sockets[fno].conn.recv(4096)
+        for connection in connections:
+            self._epoll.register(connection.fileno(), self.EPOLL_REG_FLAGS)
+
+    def _read_all(self, client):
+        """
+        Read everything available from the socket.
+        :return: (data, is_closed)
+        """
+        chunks = []
+
+        while True:
+            try:
+                data = client.conn.recv(self.RECV_SIZE)
+            except socket.error as ex:
+                if ex.errno in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return b''.join(chunks), False
+                if ex.errno == errno.EINTR:
+                    continue
+                return b''.join(chunks), True
+
             if not data:
-                with self.server_lock:
-                    self._unregister_socket(fno)
-                return
+                return b''.join(chunks), True
+
+            chunks.append(data)
+
+    def _process_event(self, server_socket, fno, event):
+        """
+        Process a new EPOLL event.
+        """
+
+        # New incoming socket connection.
+        if fno == server_socket.fileno():
+            self._accept_connections(server_socket)
+            return
 
-            messages = data.split('\n')
+        client = self.active_sockets.get(fno)
+        if not client:
+            # Already closed while sending data.
+            return
+
+        data, is_closed = self._read_all(client)
+
+        if data:
+            # Consumers can send many requests at once, the last one
+            # can be split between reads.
+            messages = (client.buffer + data).split('\n')
+            client.buffer = messages.pop()
 
             for message in messages:
                 if not message:
@@ -226,23 +291,22 @@ class SocketServer(object):
                     )
 
         # Socket has died.
-        elif event & select.EPOLLHUP:
+        if is_closed or event & (select.EPOLLHUP | select.EPOLLERR):
             with self.server_lock:
-                self._unregister_socket(fno)
-        else:
-            logger.critical('Unprocessed epoll event: %s', event)
+                if fno in self.active_sockets:
+                    self._unregister_socket(fno)
 
     def _listener(self):
         server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         server_socket.bind(('0.0.0.0', self._port))
-        server_socket.listen(10)
+        server_socket.listen(self.LISTEN_BACKLOG)
         server_socket.setblocking(0)
 
         self._epoll.register(server_socket.fileno(), self.EPOLL_REG_FLAGS)
 
         while True:
-            events = self._epoll.poll(1)
+            events = self._epoll.poll(1, self.EPOLL_MAX_EVENTS)
             for fileno, event in events:
                 try:
                     self._process_event(server_socket, fileno, event)
@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+"""
+Tracing of messages through the pipeline, e.g. from a radio packet to
+the socket consumers:
+
+    read -> parse -> state -> compare -> render -> json -> sendall
+
+Every stage is a span with its start and end time. Finished traces are kept
+in a ring (the latest `RING_SIZE`), span durations go to per-stage latency
+histograms.
+
+The current trace is per-thread. `tracer.span` adds to the current trace and
+does nothing if there's none, so the stages do not need to know whether
+they're traced:
+
+    with tracer.trace('radio'):
+        with tracer.span('read'):
+            ...
+
+Disabled by default, can be enabled over HTTP (see `sensors.views`).
+"""
+from __future__ import unicode_literals
+
+import bisect
+from collections import deque
+from threading import Lock, local
+from time import time
+
+
+class Histogram(object):
+    # Upper bounds of buckets, microseconds. The last bucket is for the rest.
+    BOUNDS = [
+        1, 2, 5, 10, 20, 50, 100, 200, 500,
+        1000, 2000, 5000, 10000, 20000, 50000,
+        100000, 200000, 500000, 1000000,
+    ]
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, us):
+        self.counts[bisect.bisect_left(self.BOUNDS, us)] += 1
+        self.count += 1
+        self.total += us
+        self.max = max(self.max, us)
+
+    def percentile(self, p):
+        """
+        Upper bound of the bucket with `p` share of values, microseconds.
+        """
+        if not self.count:
+            return None
+
+        rank = p * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return self.BOUNDS[i] if i < len(self.BOUNDS) else self.max
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'avg_us': round(self.total / self.count, 1) if self.count else None,
+            'max_us': round(self.max, 1),
+            'p50_us': self.percentile(0.5),
+            'p90_us': self.percentile(0.9),
+            'p99_us': self.percentile(0.99),
+            # [upper bound or None for the rest, count], empty ones skipped
+            'buckets': [
+                [self.BOUNDS[i] if i < len(self.BOUNDS) else None, n]
+                for i, n in enumerate(self.counts)
+                if n
+            ],
+        }
+
+
+class Trace(object):
+    def __init__(self, name):
+        self.name = name
+        self.started = time()
+        # (stage, start, end)
+        self.spans = []
+        self.discarded = False
+
+    def discard(self):
+        """
+        Nothing worth keeping, e.g. the radio had no packets.
+        """
+        self.discarded = True
+
+    def to_dict(self):
+        return {
+            'name': self.name,
+            'started': self.started,
+            # [stage, microseconds since the trace start, duration]
+            'spans': [
+                [stage, round((start - self.started) * 1e6, 1), round((end - start) * 1e6, 1)]
+                for stage, start, end in self.spans
+            ],
+        }
+
+
+class _Span(object):
+    __slots__ = ('_trace', '_stage', '_started')
+
+    def __init__(self, trace, stage):
+        self._trace = trace
+        self._stage = stage
+
+    def __enter__(self):
+        self._started = time()
+
+    def __exit__(self, *exc_info):
+        self._trace.spans.append((self._stage, self._started, time()))
+
+
+class _NoSpan(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NO_SPAN = _NoSpan()
+
+
+class _TraceContext(object):
+    def __init__(self, tracer, name):
+        self._tracer = tracer
+        self._name = name
+        self._trace = None
+
+    def __enter__(self):
+        if not self._tracer.enabled:
+            return None
+
+        self._trace = self._tracer._local.trace = Trace(self._name)
+        return self._trace
+
+    def __exit__(self, *exc_info):
+        if self._trace is None:
+            return
+
+        self._tracer._local.trace = None
+        if not self._trace.discarded:
+            self._tracer._finish(self._trace)
+
+
+class Tracer(object):
+    RING_SIZE = 1000
+
+    def __init__(self):
+        self.enabled = False
+        self._ring = deque(maxlen=self.RING_SIZE)
+        # stage -> Histogram, 'total' is the whole trace
+        self._histograms = {}
+        self._lock = Lock()
+        self._local = local()
+
+    def trace(self, name):
+        """
+        Context manager, starts a trace in this thread.
+        Returns the `Trace`, None if tracing is disabled.
+        """
+        return _TraceContext(self, name)
+
+    def span(self, stage):
+        """
+        Context manager, adds a span to the current trace of this thread.
+        """
+        trace = getattr(self._local, 'trace', None)
+        if trace is None:
+            return _NO_SPAN
+        return _Span(trace, stage)
+
+    def _finish(self, trace):
+        ended = time()
+
+        with self._lock:
+            self._ring.append(trace)
+
+            for stage, start, end in trace.spans:
+                self._histogram(stage).add((end - start) * 1e6)
+            self._histogram('total').add((ended - trace.started) * 1e6)
+
+    def _histogram(self, stage):
+        histogram = self._histograms.get(stage)
+        if histogram is None:
+            histogram = self._histograms[stage] = Histogram()
+        return histogram
+
+    def reset(self):
+        with self._lock:
+            self._ring.clear()
+            self._histograms = {}
+
+    def get_traces(self, limit):
+        """
+        The latest `limit` traces, newest first.
+        """
+        if limit <= 0:
+            return []
+
+        with self._lock:
+            traces = list(self._ring)[-limit:]
+        return [trace.to_dict() for trace in reversed(traces)]
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                'enabled': self.enabled,
+                'traces': len(self._ring),
+                'stages': {
+                    stage: histogram.to_dict()
+                    for stage, histogram in self._histograms.iteritems()
+                },
+            }
+
+
+tracer = Tracer()
@@ -0,0 +1,52 @@
+# -*- coding: utf-8 -*-
+"""
+REST views of all the sensors.
+"""
+import json
+
+from app import app
+from flask import request
+from .base import Sensor
+from .tracing import tracer
+from .wireless.utils import to_bool
+
+
+@app.route('/sensors/list')
+def list_sensors():
+    sensors = []
+    for s in Sensor._active_sensors:
+        sensors.append({
+            'name': s.NAME,
+            'loop_delay': s.LOOP_DELAY,
+            'status': s.get_value('status'),
+            'errors_count': s._errors_count,
+            'errors_threshold': s.ERRORS_THRESHOLD,
+        })
+
+    return json.dumps({
+        'status': 'ok',
+        'data': sensors,
+    })
+
+
+@app.route('/sensors/tracing', methods=['GET', 'POST'])
+def sensors_tracing():
+    """
+    Per-stage latency histograms of traced messages, `?traces=N` also
+    returns the latest N traces.
+    POST `enabled=1` to start tracing, `enabled=0` - to stop, `reset=1` -
+    to drop everything collected.
+    """
+    if request.method == 'POST':
+        if 'enabled' in request.form:
+            tracer.enabled = to_bool(request.form['enabled'])
+        if to_bool(request.form.get('reset')):
+            tracer.reset()
+
+    return json.dumps({
+        'status': 'ok',
+        'data': dict(
+            tracer.to_dict(),
+            latest=tracer.get_traces(request.args.get('traces', 0, type=int)),
+        ),
+    })
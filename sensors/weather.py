@@ -4,19 +4,48 @@ Retrieves the current weather and weather forecasts from  openweathermap.org
 API once in a while and caches it to be easily retrieved later.
 
 We separately calculate "rain forecast rating", like some measure of umbrella
-necessity today... It's England, I need it!
+necessity today... It's England, I need it! Ratings for several horizons
+(3 to 48 hours) and the next dry window are computed once per forecast.
+
+One sensor tracks several locations (cities). The current weather of all of
+them is requested with one call of the group API, every location has its own
+state and socket stream (city id). Forecasts are requested at the same time,
+over the shared keep-alive session (see `http_client`), within the free
+tier quota of the API key. The forecast changes every few hours, so it's
+requested only when it could have changed: when the HTTP cache headers say
+so, or when its first item is in the past. Even then the request is
+conditional (ETag / Last-Modified), and the response is parsed only if it's
+modified.
+
+The wireless outdoor node (`wireless.weather`) measures temperature and
+humidity right here, so while it's online and its readings are stable the
+API is polled rarely. A jump of the local readings, or the node going
+offline, brings the next poll forward. `/sensors/weather/outdoor` merges
+both: local readings where there are some, the rest from the API.
 """
 
-import requests
+import re
 import json
 import logging
+from array import array
+from bisect import bisect_left
+from email.utils import parsedate_tz, mktime_tz
+from itertools import izip
+from multiprocessing import TimeoutError
+from multiprocessing.pool import ThreadPool
+from time import time
 
 from app import app
+from flask import request
 from prod_config import WEATHER_API_KEY
-from .base import Sensor
+from .base import Sensor, SensorError
+from .http_client import client
+from .socket_server import server as SServer
 
 log = logging.getLogger(__name__)
 
+API_URL = 'http://api.openweathermap.org/data/2.5/'
+
 # There are lots of possible rain types, let's get value to each,
 # assuming that 1 is a usual rain
 
@@ -59,54 +88,407 @@ WEATHER_CODE_RAIN_WEIGHTS = {
     620: LIGHT_RAIN,            # light shower snow
 }
 
+# The same, as an array indexed by weather code (all codes are below 1000).
+_RAIN_WEIGHTS = array('d', [0.0]) * 1000
+for _code, _weight in WEATHER_CODE_RAIN_WEIGHTS.iteritems():
+    _RAIN_WEIGHTS[_code] = _weight
+
+
+class RainForecast(object):
+    """
+    Parsed forecast, as compact arrays: item times, weather codes and
+    precipitation. Running totals of rain weights and precipitation are
+    computed in one pass, so a rating for any horizon is two lookups.
+    """
+    # Forecast has data for every 3 hours
+    STEP = 3 * 3600
+    # Hours, precomputed for consumers
+    HORIZONS = (3, 6, 12, 24, 48)
+
+    def __init__(self, items):
+        self.times = array('l', [item['dt'] for item in items])
+        self.codes = array('H', [item['weather'][0]['id'] for item in items])
+        # mm in 3 hours, rain and snow
+        self.precipitation = array('f', [
+            item.get('rain', {}).get('3h', 0) + item.get('snow', {}).get('3h', 0)
+            for item in items
+        ])
+
+        # Totals of the first N items, N = 0..len(items)
+        self._weights = array('d', [0.0])
+        self._mm = array('d', [0.0])
+        # First dry item and the first rainy one after it
+        self.dry_from = self.dry_until = None
+
+        weights = _RAIN_WEIGHTS
+        for t, code, mm in izip(self.times, self.codes, self.precipitation):
+            weight = weights[code] if code < len(weights) else 0.0
+            self._weights.append(self._weights[-1] + weight)
+            self._mm.append(self._mm[-1] + mm)
+
+            if self.dry_from is None:
+                if not weight:
+                    self.dry_from = t
+            elif self.dry_until is None and weight:
+                self.dry_until = t
+
+        self.ratings = {hours: self.rating(hours) for hours in self.HORIZONS}
+
+    def _count(self, hours):
+        """
+        Number of items in the next `hours`.
+        """
+        if not self.times:
+            return 0
+        return bisect_left(self.times, self.times[0] + hours * 3600)
+
+    def rating(self, hours):
+        """
+        Average rain weight of the next `hours`, 1 is a usual rain.
+        """
+        return self._weights[self._count(hours)] / max(1.0, hours * 3600.0 / self.STEP)
+
+    def precipitation_mm(self, hours):
+        return self._mm[self._count(hours)]
+
+    def to_dict(self):
+        return {
+            'ratings': {'%sh' % hours: rating for hours, rating in self.ratings.iteritems()},
+            'precipitation_mm': {
+                '%sh' % hours: round(self.precipitation_mm(hours), 2)
+                for hours in self.HORIZONS
+            },
+            # None - dry forever, or no dry items in the forecast
+            'next_dry': {
+                'from': self.dry_from,
+                'until': self.dry_until,
+            },
+        }
+
+
+class Location(object):
+    """
+    A city with its weather and forecast.
+    """
+    def __init__(self, city_id):
+        self.city_id = city_id
+        self.name = None
+        self.values = {}
+
+        self.rain_forecast = None
+        # Validators and freshness of the latest forecast response
+        self.forecast_etag = None
+        self.forecast_last_modified = None
+        self.forecast_first_dt = None
+        self.forecast_fresh_until = 0
+
+    def render_to_response(self):
+        return {
+            'sensor': WeatherSensor.NAME,
+            'city_id': self.city_id,
+            'name': self.name,
+            'msg_stream': str(self.city_id),
+            'type': 'state',
+            'state': dict(self.values),
+        }
+
 
 class WeatherSensor(Sensor):
-    LOOP_DELAY = 60
+    # How often the local readings are checked, the API is polled less often
+    LOOP_DELAY = 10
     ERRORS_THRESHOLD = 2
     NAME = 'WEATHER'
 
-    # Forecast has data for every 3 hours, so let'sconsider only 12 hours
-    RAIN_ITEMS_TO_MEASURE = 4
+    # OpenWeatherMap city ids, the first one is the default location.
+    CITY_IDS = [
+        2654675,  # Bristol
+    ]
+
+    # Horizon of `rain_forecast_rating`, hours
+    RAIN_RATING_HOURS = 12
+
+    # Free tier of OpenWeatherMap
+    API_CALLS_PER_MINUTE = 60
+    # Forecast is updated every 3 hours, request it at least this often.
+    FORECAST_MAX_AGE = 3 * 3600
+    # Forecasts requested at the same time
+    FORECAST_THREADS = 2
+    # Max seconds for a forecast request, with retries and quota waits
+    FORECAST_TIMEOUT = 60
+    # Max cities in one request of the group API
+    GROUP_SIZE = 20
 
-    def __init__(self, city_id=2654675):
+    # Poll interval without local readings, and while they're stable, seconds
+    POLL_INTERVAL = 60
+    POLL_INTERVAL_LOCAL = 15 * 60
+    # Never poll more often, even if the local readings jump
+    MIN_POLL_INTERVAL = 60
+    # Local readings changed this much since the last poll - poll again
+    TEMPERATURE_JUMP = 1.5
+    HUMIDITY_JUMP = 10
+    # Wireless sensor and its outdoor node
+    LOCAL_SENSOR = 'nrf24l01'
+    LOCAL_NODE = 'weather'
+
+    def __init__(self, city_ids=None):
         super(WeatherSensor, self).__init__()
-        self.city_id = city_id
+        self.locations = [Location(city_id) for city_id in city_ids or self.CITY_IDS]
+        self._locations_by_id = {l.city_id: l for l in self.locations}
 
-    def get_rain_forecast(self):
-        response = requests.get(
-            'http://api.openweathermap.org/data/2.5/forecast',
-            params={
-                'id': self.city_id,
-                'appid': WEATHER_API_KEY,
-            },
+        client.set_quota(WEATHER_API_KEY, self.API_CALLS_PER_MINUTE)
+        # Forecasts are requested here, while the sensor thread
+        # requests the current weather.
+        self._pool = ThreadPool(self.FORECAST_THREADS)
+
+        self._polled_at = 0
+        # Local readings at the last poll, None if there were none
+        self._local_at_poll = None
+        self._poll_failed = False
+
+    def get_location(self, city_id=None):
+        """
+        :param city_id: None - the default location.
+        """
+        if city_id is None:
+            return self.locations[0]
+        return self._locations_by_id.get(city_id)
+
+    def _get(self, path, params, headers=None):
+        response = client.get(
+            API_URL + path,
+            params=dict(params, appid=WEATHER_API_KEY),
+            headers=headers,
+            quota_key=WEATHER_API_KEY,
         )
 
-        items = response.json()['list']
-        items = items[:self.RAIN_ITEMS_TO_MEASURE]
+        if response.status_code >= 400:
+            raise SensorError('Error requesting %s: HTTP %s' % (path, response.status_code))
 
-        sum = 0
-        for item in items:
-            weather_id = item['weather'][0]['id']
-            sum += WEATHER_CODE_RAIN_WEIGHTS.get(weather_id, 0)
+        return response
 
-        return float(sum) / self.RAIN_ITEMS_TO_MEASURE
+    def _fresh_until(self, location, response, now):
+        """
+        When the forecast can change: as the HTTP cache headers say, or when
+        its first item is in the past (the next 3-hour step, if it's in the
+        past already), but no later than `FORECAST_MAX_AGE`.
+        """
+        cache_control = response.headers.get('Cache-Control', '')
+        max_age = re.search(r'max-age=(\d+)', cache_control)
+        expires = parsedate_tz(response.headers.get('Expires', ''))
 
-    def _iteration(self):
-        response = requests.get(
-            'http://api.openweathermap.org/data/2.5/weather',
-            params={
-                'id': self.city_id,
-                'appid': WEATHER_API_KEY,
-            },
+        if 'no-cache' in cache_control or 'no-store' in cache_control:
+            fresh_until = now
+        elif max_age:
+            fresh_until = now + int(max_age.group(1)) - int(response.headers.get('Age', 0))
+        elif expires:
+            fresh_until = mktime_tz(expires)
+        elif location.forecast_first_dt is not None:
+            fresh_until = location.forecast_first_dt
+            if fresh_until <= now:
+                # Not modified since then, e.g. after 304
+                steps = (now - fresh_until) // RainForecast.STEP + 1
+                fresh_until += steps * RainForecast.STEP
+        else:
+            fresh_until = now + self.FORECAST_MAX_AGE
+
+        return min(fresh_until, now + self.FORECAST_MAX_AGE)
+
+    def get_rain_forecast(self, location):
+        """
+        :return: RainForecast. The previous one, unless a new one can
+            be available.
+        """
+        now = time()
+        if location.rain_forecast is not None and now < location.forecast_fresh_until:
+            return location.rain_forecast
+
+        headers = {}
+        if location.rain_forecast is not None:
+            if location.forecast_etag:
+                headers['If-None-Match'] = location.forecast_etag
+            if location.forecast_last_modified:
+                headers['If-Modified-Since'] = location.forecast_last_modified
+
+        response = self._get('forecast', {'id': location.city_id}, headers)
+
+        if response.status_code == 304:
+            log.debug('Forecast for %s is not modified', location.city_id)
+        else:
+            items = response.json()['list']
+            location.rain_forecast = RainForecast(items)
+            location.forecast_etag = response.headers.get('ETag')
+            location.forecast_last_modified = response.headers.get('Last-Modified')
+            location.forecast_first_dt = items[0]['dt'] if items else None
+
+        location.forecast_fresh_until = self._fresh_until(location, response, now)
+        return location.rain_forecast
+
+    def _get_current_weather(self):
+        """
+        :return: city id -> weather, with one request per `GROUP_SIZE` cities.
+        """
+        weather = {}
+
+        for i in xrange(0, len(self.locations), self.GROUP_SIZE):
+            ids = [l.city_id for l in self.locations[i:i + self.GROUP_SIZE]]
+            data = self._get('group', {'id': ','.join(map(str, ids))}).json()
+
+            for item in data['list']:
+                weather[item['id']] = item
+
+        return weather
+
+    def _update_location(self, location, data, rain_forecast):
+        location.name = data.get('name')
+        values = {
+            'humidity': data['main']['humidity'],
+            'temperature': data['main']['temp'] - 273.15,
+            'pressure': data['main']['pressure'],
+            'icon_url': 'http://openweathermap.org/img/w/%s.png' % data['weather'][0]['icon'],
+            'rain_forecast_rating': rain_forecast.rating(self.RAIN_RATING_HOURS),
+            'rain_forecast': rain_forecast.to_dict(),
+        }
+
+        if values == location.values:
+            return
+
+        location.values = values
+        SServer.send_broadcast_message(
+            location.render_to_response(),
+            self.NAME,
+            str(location.city_id),
         )
 
-        data = response.json()
+        if location is self.locations[0]:
+            # The default location, also as plain values
+            for key, value in values.iteritems():
+                self.set_value(key, value)
+
+    def get_local_readings(self):
+        """
+        Temperature and humidity of the outdoor wireless node,
+        None if it's offline or there's no such node.
+        """
+        # The wireless sensor is started after this one
+        sensor = Sensor.by_name(self.LOCAL_SENSOR)
+        node = sensor and sensor.get_node(name=self.LOCAL_NODE)
+        if not node:
+            return None
+
+        state = node.state
+        if not state.is_online or not state.data:
+            return None
+
+        readings = {
+            key: state.data.get(key)
+            for key in ('temperature', 'humidity')
+        }
+        if None in readings.values():
+            return None
+        return readings
+
+    def _poll_reason(self, local, now):
+        """
+        Why the API should be polled now, None if it shouldn't.
+        """
+        since = now - self._polled_at
+        if since < self.MIN_POLL_INTERVAL:
+            return None
+        if self._poll_failed:
+            return 'retry'
+
+        previous = self._local_at_poll
+        if local is None:
+            if previous is not None:
+                return 'outdoor node is offline'
+            if since >= self.POLL_INTERVAL:
+                return 'interval'
+            return None
+
+        if previous is None:
+            return 'outdoor node is online'
+        if abs(local['temperature'] - previous['temperature']) >= self.TEMPERATURE_JUMP:
+            return 'temperature changed'
+        if abs(local['humidity'] - previous['humidity']) >= self.HUMIDITY_JUMP:
+            return 'humidity changed'
+        if since >= self.POLL_INTERVAL_LOCAL:
+            return 'interval'
+        return None
+
+    def get_outdoor_conditions(self):
+        """
+        Best current outdoor conditions of the default location:
+        local readings if the outdoor node is online, the API otherwise.
+        """
+        values = dict(self.locations[0].values)
+        sources = dict.fromkeys(values, 'api')
+
+        local = self.get_local_readings()
+        if local:
+            values.update(local)
+            sources.update(dict.fromkeys(local, 'local'))
+
+        return {
+            'data': values,
+            'sources': sources,
+            'polled_at': self._polled_at or None,
+        }
+
+    def _iteration(self):
+        local = self.get_local_readings()
+        now = time()
+        reason = self._poll_reason(local, now)
+        if not reason:
+            # The status is of the last poll
+            return False
+
+        log.info('Polling the weather API: %s', reason)
+        # Even if it fails, the next poll is in MIN_POLL_INTERVAL at least
+        self._polled_at = now
+        self._local_at_poll = local
+        self._poll_failed = True
+
+        forecasts = [
+            (location, self._pool.apply_async(self.get_rain_forecast, (location,)))
+            for location in self.locations
+        ]
+        weather = self._get_current_weather()
+
+        # Forecasts are requested FORECAST_THREADS at a time
+        rounds = -(-len(forecasts) // self.FORECAST_THREADS)
+        deadline = time() + self.FORECAST_TIMEOUT * rounds
+        errors = []
+
+        for location, forecast in forecasts:
+            try:
+                rain_forecast = forecast.get(max(0, deadline - time()))
+            except TimeoutError:
+                errors.append('%s: timeout requesting forecast' % location.city_id)
+                continue
+            except SensorError as ex:
+                errors.append('%s: %s' % (location.city_id, ex))
+                continue
+
+            data = weather.get(location.city_id)
+            if data is None:
+                errors.append('%s: no current weather' % location.city_id)
+                continue
+
+            self._update_location(location, data, rain_forecast)
 
-        self.set_value('humidity', data['main']['humidity'])
-        self.set_value('temperature', data['main']['temp'] - 273.15)
-        self.set_value('pressure', data['main']['pressure'])
-        self.set_value('icon_url', 'http://openweathermap.org/img/w/%s.png' % data['weather'][0]['icon'])
-        self.set_value('rain_forecast_rating', self.get_rain_forecast())
+        self._poll_failed = bool(errors)
+        if errors:
+            raise SensorError('; '.join(errors))
+
+    def process_client_message(self, data):
+        if data.get('type') != 'get_state':
+            return {'error': 'unknown message type %s' % data.get('type')}
+
+        location = self.get_location(data.get('city_id'))
+        if not location:
+            return {'error': 'location not found'}
+
+        return location.render_to_response()
 
 
 weather = WeatherSensor()
@@ -125,3 +507,59 @@ def read_weather_values():
             'rain_forecast_rating': weather.get_value('rain_forecast_rating'),
         },
     })
+
+
+@app.route('/sensors/weather/outdoor')
+def read_outdoor_conditions():
+    """
+    Local readings merged with the API ones, `sources` tells which is which.
+    """
+    return json.dumps(dict(weather.get_outdoor_conditions(), status='ok'))
+
+
+@app.route('/sensors/weather/<int:city_id>/read')
+def read_location_weather_values(city_id):
+    location = weather.get_location(city_id)
+    if not location:
+        return json.dumps({
+            'status': 'error',
+            'error_code': 'location_not_found',
+        })
+
+    return json.dumps({
+        'status': 'ok',
+        'name': location.name,
+        'data': location.values,
+    })
+
+
+@app.route('/sensors/weather/rain')
+def read_rain_forecast():
+    """
+    `?hours=N` - rain rating for any horizon, `city_id` - not the default
+    location. Uses the latest forecast, never requests the API.
+    """
+    location = weather.get_location(request.args.get('city_id', type=int))
+    if not location:
+        return json.dumps({
+            'status': 'error',
+            'error_code': 'location_not_found',
+        })
+
+    forecast = location.rain_forecast
+    if not forecast:
+        return json.dumps({
+            'status': 'error',
+            'error_code': 'no_forecast',
+        })
+
+    hours = request.args.get('hours', weather.RAIN_RATING_HOURS, type=int)
+    return json.dumps({
+        'status': 'ok',
+        'data': {
+            'hours': hours,
+            'rating': forecast.rating(hours),
+            'precipitation_mm': forecast.precipitation_mm(hours),
+            'next_dry': forecast.to_dict()['next_dry'],
+        },
+    })
@@ -1,4 +1,9 @@
 # -*- coding: utf-8 -*-
 
 import base
+
+# Not in `base`, so the tools can import it without starting the sensor.
+wireless_sensor = base.WirelessSensor()
+wireless_sensor.start()
+
 import views
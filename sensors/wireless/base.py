@@ -1,27 +1,56 @@
 # -*- coding: utf-8 -*-
+import heapq
 import logging
+from contextlib import nested
+from functools import partial
+from itertools import count
 from time import time
 import socket
 import json
-from threading import Lock
-
-from RF24 import RF24_PA_MAX, RF24_PA_HIGH, RF24_250KBPS, RF24
-import RPi.GPIO as GPIO
+import struct
+from threading import Lock, Thread, Condition
 
 from ..base import Sensor, SensorError
 from ..socket_server import server as SServer
+from ..tracing import tracer
+
+from .codec import Layout
+from .radio import Radio, GPIO
+from .tx_queue import TxFuture, gather, PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW
+from .routing import RouteTable, wrap, unwrap
+from .capture import PacketCapture
+from .link_stats import LinkStats
+from .survey import ChannelSurvey
+from .utils import ByteValues
 
 log = logging.getLogger(__name__)
 
 
+class StateMeta(type):
+    """
+    Compiles `FIELDS` of a state class into a binary layout.
+    """
+    def __init__(cls, name, bases, attrs):
+        super(StateMeta, cls).__init__(name, bases, attrs)
+
+        cls._layout = Layout(cls.FIELDS)
+        if cls._layout.size > cls.MAX_DATA_LEN:
+            raise TypeError('%s: status payload is too long' % name)
+
+
 class State(object):
     """
     "Wireless" is a special type of sensor, which works with NRF24L01+ wireless sensor
     attached. It provides an abstraction for wireless devices connected, allowing to
     send them messages and receive their current states.
     """
+    __metaclass__ = StateMeta
 
     ALLOWED_KEYS = set()
+    # Payload of status message, list of `codec.Field`.
+    FIELDS = ()
+    # Max payload size minus node id and message type
+    MAX_DATA_LEN = 30
 
     def __init__(self, node, data=None, is_online=True):
         self.node = node
@@ -30,14 +59,17 @@ class State(object):
 
     @classmethod
     def _parse_raw_data(cls, raw_data):
-        return {}
+        try:
+            return cls._layout.decode(raw_data)
+        except struct.error as ex:
+            raise SensorError('Malformed status: %s' % ex)
 
     @classmethod
     def from_message(cls, node, msg):
         assert msg.msg_type == Message.TYPE_STATUS
 
         data = cls._parse_raw_data(msg.data)
-        log.info('Parsed state %s', data)
+        log.debug('Parsed state %s', data)
         return cls(node=node, data=data)
 
     def _apply_new_state(self, old, new):
@@ -56,11 +88,15 @@ class State(object):
             'is_online': self.is_online,
             'type': 'state',
             'state': self.data,
+            'version': self.node.state_version,
         }
 
     def send_update_message(self):
+        with tracer.span('render'):
+            data = self.render_to_response()
+
         SServer.send_broadcast_message(
-            self.render_to_response(),
+            data,
             self.node.sensor.NAME,
             str(self.node.NODE_ID),
         )
@@ -75,70 +111,205 @@ class State(object):
         return not self.__eq__(other)
 
 
+class MessageMeta(type):
+    """
+    Compiles `FIELDS` of a message class into lookup tables
+    and binary layouts for every field.
+    """
+    def __init__(cls, name, bases, attrs):
+        super(MessageMeta, cls).__init__(name, bases, attrs)
+
+        cls._fields_by_id = {}
+        cls._field_ids = {}
+        # field_id -> layouts of value alone and of TYPE_FIELD_SET message
+        cls._value_layouts = {}
+        cls._set_layouts = {}
+
+        for field in cls.FIELDS:
+            if not field.field_id:
+                # Zero is padding in TYPE_FIELD_RESPONSE
+                raise TypeError('%s: field %s has no field_id' % (name, field.name))
+
+            cls._fields_by_id[field.field_id] = field
+            cls._field_ids[field.name] = field.field_id
+            cls._value_layouts[field.field_id] = Layout([field])
+            cls._set_layouts[field.field_id] = Layout([field], prefix='BB')
+
+            if cls._set_layouts[field.field_id].size > cls.MAX_DATA_LEN + 1:
+                raise TypeError('%s: field %s is too long' % (name, field.name))
+
+        cls.FIELD_NAMES = {f.field_id: f.name for f in cls.FIELDS}
+
+
 class Message(object):
     """
     A representation of a bytestring being sent to/from wireless device.
     Helps to parse or format a message.
     """
+    __metaclass__ = MessageMeta
+
     MAX_DATA_LEN = 31  # Max payload size one byte for message type
+    # Incoming messages also start with node id
+    MAX_RESPONSE_LEN = MAX_DATA_LEN - 1
 
     # Send every N seconds. After M times without response node gows offline.
     TYPE_STATUS = 0
-    # Asking for a value of the field. Field id should be passed in data.
+    # Asking for values of the fields. Followed by one or more field ids.
     TYPE_FIELD_REQUEST = 1
     # Set some value of the field. Should be followed by field id and actual value.
     TYPE_FIELD_SET = 2
-    # Response for TYPE_DATA_REQUEST
+    # Response for TYPE_FIELD_REQUEST, one or more (field id, value) pairs.
     TYPE_FIELD_RESPONSE = 3
     # Ask device to proxy data to another device in the next lavel
     TYPE_PROXY = 4
+    # Device introduces itself, followed by its device type and optional
+    # flags (HELLO_*). Devices of the same type share the pipe.
+    TYPE_HELLO = 5
+    # Hub is going to move to another channel, followed by the channel number.
+    # The device answers with the same message when it's ready to move,
+    # and stays until TYPE_CHANNEL_SWITCH.
+    TYPE_CHANNEL = 6
+    # Move to the channel of the last TYPE_CHANNEL now.
+    TYPE_CHANNEL_SWITCH = 7
     # Other types are device-specific.
 
-    FIELD_NAMES = {}  # Number to name map
+    # The device takes only messages starting with its node id,
+    # see `Node.addressed`.
+    HELLO_ADDRESSED = 0x01
+
+    # Fields of the device, which can be requested or set. List of `codec.Field`
+    # with `field_id` set.
+    FIELDS = ()
+    FIELD_NAMES = {}  # Number to name map, built from FIELDS
 
-    def __init__(self, node_id, msg_type, data=None, field_name=None):
+    # node_id + msg_type for incoming, msg_type + field_id for outgoing messages.
+    _HEADER = struct.Struct(str('<BB'))
+    _TYPE = struct.Struct(str('<B'))
+
+    def __init__(self, node_id, msg_type, data=None, field_name=None,
+                 field_names=None):
+        """
+        :param field_names: several fields to request at once.
+        """
         self.node_id = node_id
         self.msg_type = msg_type
         self.field_name = field_name
+        self.field_names = field_names or ([field_name] if field_name else [])
         self.data = data
+        # Values of TYPE_FIELD_RESPONSE, name -> value
+        self.fields = {}
+        # HELLO_* flags of TYPE_HELLO
+        self.flags = 0
 
     @property
     def field_id(self):
-        # TODO: optimize
-        _field_numbers = {v: k for k, v in self.FIELD_NAMES}
-        return _field_numbers[self.field_name]
+        try:
+            return self._field_ids[self.field_name]
+        except KeyError:
+            raise SensorError('Unknown field %s' % self.field_name)
 
     @classmethod
     def parse(cls, raw_data):
-        node_id = raw_data[0]
-        msg_type = raw_data[1]
-        data = raw_data[2:]
+        try:
+            node_id, msg_type = cls._HEADER.unpack_from(raw_data)
+            msg = cls(node_id, msg_type)
+
+            if msg_type == cls.TYPE_STATUS:
+                # No copying, state layout reads directly from the buffer.
+                msg.data = memoryview(raw_data)[cls._HEADER.size:]
+                return msg
+
+            elif msg_type == cls.TYPE_HELLO:
+                msg.data, = cls._TYPE.unpack_from(raw_data, cls._HEADER.size)
+                # Older devices do not send flags
+                if len(raw_data) > cls._HEADER.size + cls._TYPE.size:
+                    msg.flags, = cls._TYPE.unpack_from(raw_data, cls._HEADER.size + cls._TYPE.size)
+
+            elif msg_type == cls.TYPE_CHANNEL:
+                msg.data, = cls._TYPE.unpack_from(raw_data, cls._HEADER.size)
+
+            elif msg_type == cls.TYPE_FIELD_RESPONSE:
+                values = cls._parse_fields(raw_data, cls._HEADER.size)
+                msg.fields = dict(values)
+                # The first one, for simple single-field responses
+                msg.field_name, msg.data = values[0]
+            else:
+                raise SensorError('Unexpected message type: ' + str(msg_type))
+
+        except struct.error as ex:
+            raise SensorError('Malformed message: %s' % ex)
+
+        return msg
+
+    @classmethod
+    def _parse_fields(cls, raw_data, offset):
+        """
+        :return: list of (name, value)
+        """
+        fields = []
 
-        msg = cls(node_id, msg_type)
+        while offset < len(raw_data):
+            field_id, = cls._TYPE.unpack_from(raw_data, offset)
+            if not field_id:
+                # Padding
+                break
 
-        if msg_type == cls.TYPE_STATUS:
-            msg.data = data
-            return msg
+            layout = cls._value_layouts.get(field_id)
+            if not layout:
+                raise SensorError('Unknown field_id %s' % field_id)
 
-        elif msg_type == cls.TYPE_FIELD_RESPONSE:
-            msg.field_name = cls.FIELD_NAMES.get(ord(data[0]))
-            if not msg.field_name:
-                raise SensorError('Unknown field_id %s', ord(data[0]))
+            value, = layout.unpack(raw_data, offset + cls._TYPE.size)
+            fields.append((layout.names[0], value))
+            offset += cls._TYPE.size + layout.size
 
-            msg.data = data[1:]
-        else:
-            raise SensorError('Unexpected message type: ' + str(msg_type))
+        if not fields:
+            raise SensorError('Empty field response')
 
-        return msg
+        return fields
 
-    def format(self):
-        data = chr(self.msg_type)
+    @classmethod
+    def batch_fields(cls, field_names):
+        """
+        Split fields into groups, which can be requested in one message,
+        so the response fits into one message too.
+        """
+        batches = []
+        batch, size = [], 0
+
+        for name in field_names:
+            field_size = cls._TYPE.size + cls._value_layouts[cls._field_ids[name]].size
+            if batch and size + field_size > cls.MAX_RESPONSE_LEN:
+                batches.append(batch)
+                batch, size = [], 0
+
+            batch.append(name)
+            size += field_size
 
+        if batch:
+            batches.append(batch)
+        return batches
+
+    def format(self):
         if self.msg_type == self.TYPE_FIELD_REQUEST:
-            data += chr(self.field_id)
+            try:
+                field_ids = [self._field_ids[name] for name in self.field_names]
+            except KeyError as ex:
+                raise SensorError('Unknown field %s' % ex)
+
+            data = self._TYPE.pack(self.msg_type) + bytes(bytearray(field_ids))
 
         elif self.msg_type == self.TYPE_FIELD_SET:
-            data += chr(self.field_id) + self.data
+            field_id = self.field_id
+            data = self._set_layouts[field_id].encode(
+                {self.field_name: self.data},
+                self.msg_type,
+                field_id,
+            )
+        elif self.msg_type == self.TYPE_CHANNEL:
+            data = self._HEADER.pack(self.msg_type, self.data)
+
+        else:
+            data = self._TYPE.pack(self.msg_type)
 
         return data
 
@@ -147,16 +318,41 @@ class Message(object):
             self.__class__.__name__,
             self.msg_type,
             self.field_name,
-            len(self.data) if self.data else 'None',
+            len(self.data) if hasattr(self.data, '__len__') else self.data,
         )
 
 
+class FieldRequest(object):
+    """
+    Fields, asked with `Node.request_fields`.
+    """
+    def __init__(self, field_names, deadline):
+        self.waiting = set(field_names)
+        self.values = {}
+        self.deadline = deadline
+        self.future = TxFuture()
+
+    def add_value(self, name, value):
+        self.waiting.discard(name)
+        self.values[name] = value
+
+        if not self.waiting:
+            self.future.set_result(self.values)
+
+
 class Node(object):
     """
     Node represents a single wireless device with its own ID and hardware address.
     It helps to communicate with a single the device directly.
+
+    All devices of the same type share the pipes, so devices which say they
+    can (`Message.HELLO_ADDRESSED`) get their ID in the beginning of every
+    message sent to them.
     """
+    # Default ID, device with this ID is created on start.
     NODE_ID = None
+    # Device type from hello message.
+    NODE_TYPE = None
     LISTEN_PIPE_ADDR = None
     LISTEN_PIPE_NUMBER = None
     SEND_PIPE_ADDR = None
@@ -172,28 +368,51 @@ class Node(object):
     BASE_SEND_ADDR = 0x53654e6400
     BASE_RECV_ADDR = 0x5265437600
 
+    # Upper limits, actual values are tuned by `LinkStats`
     SEND_RETRIES = 5
-    SEND_DELAY = 50  # msec
+    SEND_DELAY = 50  # msec, doubled after every failed attempt
+
+    # Default timeout of `request_fields`, seconds
+    FIELD_REQUEST_TIMEOUT = 5
+    # Seconds to wait for the answer to TYPE_CHANNEL
+    CHANNEL_REPLY_TIMEOUT = 5
 
-    def __init__(self, sensor, radio):
-        log.info('Initializing wireless node %s', self.__class__.__name__)
+    # Send messages with ACKs of the device's own packets, if the radio has
+    # dynamic payloads. For devices which sleep between sending statuses.
+    ACK_PAYLOADS = False
+
+    def __init__(self, sensor, radio, node_id=None):
+        """
+        :param node_id: ID of the device, if it's not the default one.
+        """
+        if node_id is not None and node_id != self.NODE_ID:
+            self.NODE_ID = node_id
+            self.NAME = '%s-%s' % (self.NAME, node_id)
+
+        log.info('Initializing wireless node %s', self.NAME)
+        # The device said it takes only messages starting with its node id
+        # (`Message.HELLO_ADDRESSED`). Checked when a message is sent, so
+        # messages queued before the hello get the id too.
+        self.addressed = False
         self._fields = {}
+        # field name -> list of FieldRequest, waiting for its value
+        self._field_waiters = {}
+        self._field_lock = Lock()
+        # TxRequests waiting to go with an ACK, the first one may be loaded
+        self._ack_requests = []
+        # (channel, TxFuture) of TYPE_CHANNEL waiting for the answer
+        self._channel_request = None
         self._errors_in_a_row = 0
         self._last_status_update_time = time()
-        self._radio = radio
+        self._offline_check_scheduled = False
+        # `radio.Radio` the device is reachable with
+        self.radio = radio
         self.sensor = sensor
         self.state = self.STATE_CLASS(self, is_online=False)
-
-        if self.LISTEN_PIPE_NUMBER is not None:
-            log.info(
-                'Start listening on pipe %s addr=%s',
-                self.LISTEN_PIPE_NUMBER,
-                self.recv_addr,
-            )
-            radio.openReadingPipe(
-                self.LISTEN_PIPE_NUMBER,
-                self.recv_addr,
-            )
+        # Grows on every state change, see `wait_for_state`
+        self.state_version = sensor.next_state_version()
+        self._state_changed = Condition()
+        self.link = LinkStats()
 
     @property
     def recv_addr(self):
@@ -205,88 +424,302 @@ class Node(object):
 
     @property
     def name(self):
-        return self.__class__.__name__
+        return '%s(%s)' % (self.__class__.__name__, self.NODE_ID)
+
+    def _with_address(self, payload):
+        """
+        Formatted message as it goes to the device, see `addressed`.
+        """
+        if self.addressed:
+            return self.MESSAGE_CLASS._TYPE.pack(self.NODE_ID) + payload
+        return payload
+
+    @property
+    def uses_ack_payloads(self):
+        return self.ACK_PAYLOADS and self.radio.dynamic_payloads
+
+    @property
+    def can_switch_channel(self):
+        """
+        The device can be asked to move: it's online, and reads messages
+        (devices with `ACK_PAYLOADS` read only ACKs, if the radio has them).
+        """
+        return self.state.is_online and (self.uses_ack_payloads or not self.ACK_PAYLOADS)
 
     def get_value(self, field_name):
         return self._fields.get(field_name)
 
     def ask_for_value(self, field_name):
-        self.send_data(
-            self.MESSAGE_CLASS(
-                self.NODE_ID,
-                self.MESSAGE_CLASS.TYPE_FIELD_REQUEST,
-                field_name=field_name,
-            ),
+        return self.request_fields([field_name])
+
+    def request_fields(self, field_names, timeout=None):
+        """
+        Ask the device for fresh values of the fields.
+        Fields are requested in as few messages as possible. Fields which are
+        already requested and not answered yet are not requested again.
+
+        :return: TxFuture, resolved with dict name -> value when all the
+            values arrive, or with SensorError after `timeout` seconds.
+        """
+        unknown = set(field_names) - set(self.MESSAGE_CLASS._field_ids)
+        if unknown:
+            raise SensorError('Unknown fields %s' % ', '.join(sorted(unknown)))
+
+        if not field_names:
+            future = TxFuture()
+            future.set_result({})
+            return future
+
+        if timeout is None:
+            timeout = self.FIELD_REQUEST_TIMEOUT
+
+        request = FieldRequest(field_names, time() + timeout)
+        to_ask = []
+
+        with self._field_lock:
+            for name in request.waiting:
+                waiters = self._field_waiters.get(name)
+                if waiters is None:
+                    waiters = self._field_waiters[name] = []
+                    to_ask.append(name)
+                waiters.append(request)
+
+        self.sensor.call_at(request.deadline, self.expire_field_requests)
+
+        for batch in self.MESSAGE_CLASS.batch_fields(to_ask):
+            tx = self.send_data(
+                self.MESSAGE_CLASS(
+                    self.NODE_ID,
+                    self.MESSAGE_CLASS.TYPE_FIELD_REQUEST,
+                    field_names=batch,
+                ),
+                priority=PRIORITY_LOW,
+            )
+            tx.add_done_callback(
+                lambda f, batch=batch: self._on_field_request_sent(f, batch),
+            )
+
+        return request.future
+
+    def _on_field_request_sent(self, future, field_names):
+        ex = future.exception()
+        if ex is None:
+            return
+
+        with self._field_lock:
+            failed = [
+                request
+                for name in field_names
+                for request in self._field_waiters.pop(name, [])
+            ]
+
+        # Futures run callbacks, so not under the lock
+        for request in failed:
+            request.future.set_exception(ex)
+
+    def _on_field_values(self, values):
+        self._fields.update(values)
+
+        with self._field_lock:
+            answered = [
+                (name, self._field_waiters.pop(name, []))
+                for name in values
+            ]
+
+        for name, requests in answered:
+            for request in requests:
+                request.add_value(name, values[name])
+
+    def expire_field_requests(self):
+        """
+        Fail requests, waiting for too long.
+        """
+        if not self._field_waiters:
+            return
+
+        now = time()
+        expired = []
+
+        with self._field_lock:
+            for name, waiters in self._field_waiters.items():
+                for request in list(waiters):
+                    if request.deadline <= now:
+                        waiters.remove(request)
+                        expired.append((name, request))
+
+                if not waiters:
+                    # Will be requested again next time
+                    del self._field_waiters[name]
+
+        for name, request in expired:
+            request.future.set_exception(
+                SensorError('No response from %s for %s' % (self.name, name)),
+            )
+
+    def request_channel(self, channel):
+        """
+        Ask the device to get ready to move to `channel`.
+        :return: TxFuture, resolved when the device answers, or with
+            SensorError if it doesn't in time.
+        """
+        future = TxFuture()
+        self._channel_request = (channel, future)
+
+        # Devices with ACK payloads get the message when they wake up
+        timeout = self.OFFLINE_AFTER_N_SECONDS if self.uses_ack_payloads \
+            else self.CHANNEL_REPLY_TIMEOUT
+
+        def expire():
+            future.set_exception(SensorError(
+                'No answer from %s about channel %s' % (self.name, channel),
+            ))
+
+        self.sensor.call_at(time() + timeout, expire)
+
+        tx = self.send_data(
+            self.MESSAGE_CLASS(self.NODE_ID, Message.TYPE_CHANNEL, data=channel),
+            priority=PRIORITY_HIGH,
+            coalesce_key='channel',
         )
+        tx.add_done_callback(
+            lambda f: f.exception() is not None and future.set_exception(f.exception()),
+        )
+        return future
+
+    def _on_channel_reply(self, channel):
+        request = self._channel_request
+        if request is None or request[0] != channel:
+            log.warning('%s: unexpected answer about channel %s', self.name, channel)
+            return
+
+        self._channel_request = None
+        request[1].set_result(channel)
 
     def set_value(self, field_name, value):
-        self.send_data(
+        return self.send_data(
             self.MESSAGE_CLASS(
                 self.NODE_ID,
                 self.MESSAGE_CLASS.TYPE_FIELD_SET,
                 data=value,
                 field_name=field_name,
             ),
+            coalesce_key=('set', field_name),
         )
 
-    def _send_data_to_radio(self, payload):
+    def _send_data_to_radio(self, payload, radio):
+        """
+        :param radio: the one owning the TX queue, even if the device was
+            heard by another radio meanwhile: only one radio is locked at
+            a time.
+        """
         payload = bytearray(payload)
         log.debug('%s: Sending length %s', self.name, len(payload))
-        try:
-            self._radio.stopListening()
-            self._radio.openWritingPipe(self.send_addr)
-            if not self._radio.write(payload):
+        capture = self.sensor.capture
+        if capture:
+            capture.write_tx(self.NODE_ID, payload)
+
+        with radio.tx_mode():
+            radio.set_hw_retries(self.link.hw_retries(radio.retries_count))
+            radio.open_writing_pipe(self.send_addr)
+            success, hw_retries = radio.write(payload)
+            self.link.add_tx(success, hw_retries)
+            if not success:
                 raise SensorError('Failed to send data to %s' % self.name)
-        finally:
-            self._radio.startListening()
 
-    def send_data(self, msg):
-        for i in range(self.SEND_RETRIES):
-            try:
-                self._send_data_to_radio(msg.format())
-                break
-            except SensorError as ex:
-                log.warning(
-                    '[%s/%s] Error sending message %s to device %s: %s',
-                    i + 1,
-                    self.SEND_RETRIES,
-                    msg,
-                    self.NODE_ID,
-                    str(ex),
-                )
-        else:
-            raise SensorError(
-                'Request failed %s times in a row' % self.SEND_RETRIES,
-            )
+    def send_data(self, msg, priority=PRIORITY_NORMAL, coalesce_key=None):
+        """
+        Queue the message, it will be sent by the radio thread, or loaded as
+        ACK payload (see `ACK_PAYLOADS`) and picked up by the device later.
+        :param coalesce_key: pending message to this node with the same key
+            is replaced by this one.
+        :return: TxFuture
+        """
+        return self.radio.tx_queue.put(self, msg, priority, coalesce_key)
+
+    @property
+    def offline_deadline(self):
+        return self._last_status_update_time + self.OFFLINE_AFTER_N_SECONDS
+
+    def _schedule_offline_check(self):
+        if self._offline_check_scheduled:
+            # Will be moved forward when it fires
+            return
+
+        self._offline_check_scheduled = True
+        self.sensor.call_at(self.offline_deadline, self.check_if_offline)
 
     def check_if_offline(self):
+        self._offline_check_scheduled = False
+
         if not self.state.is_online:
             return
 
-        if time() - self._last_status_update_time < self.OFFLINE_AFTER_N_SECONDS:
-            # Everything's fine
+        if self.sensor.get_node(node_id=self.NODE_ID) is not self:
+            # Replaced after a new hello
+            return
+
+        if time() < self.offline_deadline:
+            # Got a status since the check was scheduled
+            self._schedule_offline_check()
             return
         self.state = self.STATE_CLASS(self, is_online=False)
         log.info('Device `%s` went offline', self.name)
+        self.publish_state()
+
+    def publish_state(self):
+        """
+        Let everyone know the state has changed: socket clients and
+        `wait_for_state` callers.
+        """
+        with self._state_changed:
+            self.state_version = self.sensor.next_state_version()
+            self._state_changed.notify_all()
+
         self.state.send_update_message()
 
+    def update_state(self, data):
+        self.state.update(data)
+        self.publish_state()
+
+    def wait_for_state(self, since, timeout):
+        """
+        Block until the state is newer than version `since`.
+        :return: True if it is.
+        """
+        deadline = time() + timeout
+
+        with self._state_changed:
+            while self.state_version <= since:
+                remaining = deadline - time()
+                if remaining <= 0:
+                    return False
+                self._state_changed.wait(remaining)
+
+        return True
+
     def process_new_hw_message(self, msg):
-        log.debug(
-            'Received HW message of type %s, data %s'
-            % (msg.msg_type, map(int, msg.data)),
-        )
+        log.debug('Received HW message %r', msg)
 
         if msg.msg_type == self.MESSAGE_CLASS.TYPE_STATUS:
-            new_state = self.STATE_CLASS.from_message(self, msg)
+            with tracer.span('state'):
+                new_state = self.STATE_CLASS.from_message(self, msg)
+
+            with tracer.span('compare'):
+                changed = new_state != self.state
 
-            if new_state != self.state:
+            if changed:
                 self.state = new_state
-                new_state.send_update_message()
+                self.publish_state()
 
             self._last_status_update_time = time()
+            if self.state.is_online:
+                self._schedule_offline_check()
 
         if msg.msg_type == self.MESSAGE_CLASS.TYPE_FIELD_RESPONSE:
-            self._fields[msg.field_name] = msg.data
+            self._on_field_values(msg.fields)
+
+        if msg.msg_type == self.MESSAGE_CLASS.TYPE_CHANNEL:
+            self._on_channel_reply(msg.data)
 
     def process_client_message(self, data):
         t = data['type']
@@ -295,10 +728,12 @@ class Node(object):
             return self.state.render_to_response()
 
         if t == 'set_state':
-            self.state.update(data.get('state'))
-            self.state.send_update_message()
+            self.update_state(data.get('state'))
             return
 
+        if t == 'get_link_stats':
+            return {'link': self.link.to_dict()}
+
         return {'error': 'unknown message type %s' % t}
 
     def terminate(self):
@@ -312,20 +747,74 @@ class WirelessSensor(Sensor):
     The process starts with sensor connecting to the HUB and
     sending hello message with it's identifier.
     When it happens, we create a node and route all message to it later.
+
+    There can be several radios, on different channels (`RADIOS`). All of
+    them listen for every node type, a node is talked to with the radio it's
+    heard by.
+
+    If a radio has IRQ pin set, its incoming messages are read by a separate
+    radio thread, woken up by the nRF24L01+ IRQ line (falling edge on
+    "RX data ready"). Otherwise the radio is polled every `LOOP_DELAY` seconds.
     """
     NAME = 'nrf24l01'
     LOOP_DELAY = 0.1
     ERRORS_THRESHOLD = None
 
     RF24_PINS = [25, 8]
+    # BCM number of the pin, connected to IRQ. None - poll the radio.
+    IRQ_PIN = None
+    # Read the radio at least this often in IRQ mode, in case an edge is missed.
+    IRQ_WAIT_TIMEOUT = 1
+    # Max messages sent in one go, radio is read after each of them.
+    TX_BATCH_SIZE = 8
     CHANNEL = 0x30
+    # Several radios: list of dicts with `pins` ([CE, CSN]), `channel`,
+    # optional `irq_pin` and `dynamic_payloads`. None - one radio with
+    # the settings above.
+    RADIOS = None
+    # node_id -> radio index, for nodes created on start. Other ones start
+    # on the first radio, nodes move to the radio they are heard by.
+    NODE_RADIOS = {}
     RETRIES_DELAY = 5
     RETRIES_COUNT = 15
     MAX_PAYLOAD_SIZE = 32
-
-    def __init__(self):
+    # Packets are not padded to MAX_PAYLOAD_SIZE, and messages to devices
+    # with `Node.ACK_PAYLOADS` go with ACKs. Devices must be flashed with
+    # dynamic payloads enabled too.
+    DYNAMIC_PAYLOADS = False
+
+    # Look for a quieter channel every N seconds, None - never. Devices
+    # must support TYPE_CHANNEL, otherwise the radio never moves.
+    SURVEY_INTERVAL = None
+    # Survey only if nothing was received for so long and nothing is queued.
+    SURVEY_IDLE = 0.5
+    # Channels surveyed in one go, the radio is deaf meanwhile.
+    SURVEY_SLICE = 4
+    SURVEY_SWEEPS = 20
+    # 2400-2483 MHz, the rest is not allowed in many countries.
+    SURVEY_CHANNELS = range(84)
+    # Move only if the current channel is busy this much more often.
+    SURVEY_MIN_GAIN = 0.1
+    # Keep radios this far from each other's channels.
+    SURVEY_RADIO_SPACING = 2
+    # Write all radio packets to this file, can be enabled over HTTP as well.
+    CAPTURE_ENABLED = False
+    CAPTURE_PATH = '/var/log/sensors_radio.cap'
+
+    def __init__(self, radio=None, gpio=GPIO, irq_pin=None, radios=None):
+        """
+        :param radio: RF24-compatible object for the first radio,
+            created from settings if not passed.
+        :param gpio: RPi.GPIO-compatible module, used in IRQ mode.
+        :param irq_pin: overrides IRQ pin of the first radio.
+        :param radios: overrides `RADIOS`, dicts can also have `rf24` -
+            RF24-compatible object.
+        """
         super(WirelessSensor, self).__init__()
         log.info('INIT1')
+        # Shared by all nodes, so versions do not go back when a node
+        # is replaced after hello.
+        self._state_versions = count(1)
         from .power_control import PowerControlNode
         from .weather import WeatherNode
 
@@ -333,60 +822,703 @@ class WirelessSensor(Sensor):
             PowerControlNode.NODE_ID: PowerControlNode,
             WeatherNode.NODE_ID: WeatherNode,
         }
+        # Other devices are created when they say hello.
+        self._node_by_type = {
+            node_cls.NODE_TYPE: node_cls
+            for node_cls in self._node_by_id.itervalues()
+        }
         self._active_nodes = {}
-
-        self._radio = self._get_radio()
+        self._nodes_by_name = {}
+        self._nodes_lock = Lock()
+        # (radio index, pipe) -> TxRequest loaded as ACK payload
+        self._ack_loaded = {}
+        self._ack_lock = Lock()
+        self.routes = RouteTable()
+        self.radios = self._get_radios(radios, radio, irq_pin, gpio)
+
+        # (time, seq, callable) - offline checks and timeouts
+        self._timers = []
+        self._timers_seq = count()
+        self._timers_lock = Lock()
         self._init_nodes()
 
+        self.capture = None
+        if self.CAPTURE_ENABLED:
+            self.start_capture(self.CAPTURE_PATH)
+
+    def _get_radios(self, radios, rf24, irq_pin, gpio):
+        if radios is None:
+            radios = self.RADIOS or [{
+                'pins': self.RF24_PINS,
+                'channel': self.CHANNEL,
+                'irq_pin': self.IRQ_PIN,
+            }]
+
+        radios = [
+            dict({'dynamic_payloads': self.DYNAMIC_PAYLOADS}, **config)
+            for config in radios
+        ]
+        if rf24 is not None:
+            radios[0]['rf24'] = rf24
+        if irq_pin is not None:
+            radios[0]['irq_pin'] = irq_pin
+
+        return [
+            Radio(
+                index,
+                gpio=gpio,
+                retries_delay=self.RETRIES_DELAY,
+                retries_count=self.RETRIES_COUNT,
+                **config
+            )
+            for index, config in enumerate(radios)
+        ]
+
+    @property
+    def _timers_radio(self):
+        """
+        The radio thread which runs timers, None - the sensor thread does.
+        """
+        radio = self.radios[0]
+        return radio if radio.irq_mode else None
+
+    def start(self):
+        for radio in self.radios:
+            if radio.irq_mode:
+                radio.setup_irq()
+                radio.thread = Thread(target=self._radio_loop, args=(radio,))
+                radio.thread.daemon = True
+
+        super(WirelessSensor, self).start()
+
+        for radio in self.radios:
+            if radio.thread:
+                radio.thread.start()
+
+    def stop(self):
+        super(WirelessSensor, self).stop()
+
+        for radio in self.radios:
+            radio.stop()
+
+        with self._ack_lock:
+            requests = [r for node in self.get_nodes() for r in node._ack_requests]
+            for node in self.get_nodes():
+                node._ack_requests = []
+            self._ack_loaded = {}
+
+        for request in requests:
+            request.resolve(exception=SensorError('Sensor is stopped'))
+
+        self.stop_capture()
+
+    def _radio_loop(self, radio):
+        """
+        Wait for IRQ or a new message to send, read everything in RX FIFO
+        and send queued messages.
+        """
+        timer_due_in = None
+        runs_timers = radio is self._timers_radio
+
+        while not self.should_stop:
+            timeout = self.IRQ_WAIT_TIMEOUT
+            survey_due_in = self._survey_due_in(radio)
+            for due_in in (radio.tx_queue.next_due_in(), timer_due_in, survey_due_in):
+                if due_in is not None:
+                    timeout = min(timeout, due_in)
+
+            radio.wakeup.wait(timeout)
+            radio.wakeup.clear()
+
+            try:
+                self._process_hw_messages(radio)
+                self._send_queued(radio)
+                self._survey_if_idle(radio)
+                if runs_timers:
+                    timer_due_in = self._run_timers()
+            except Exception as ex:
+                log.error('Error while working with radio %s:', radio.index, exc_info=ex)
+                # Some messages can still be waiting in FIFO
+                radio.wakeup.set()
+
+    def call_at(self, deadline, fn):
+        """
+        Call `fn` from the radio thread (or the sensor thread, if there's
+        no IRQ) at `deadline`.
+        """
+        with self._timers_lock:
+            heapq.heappush(self._timers, (deadline, next(self._timers_seq), fn))
+
+        # The radio thread may be sleeping longer than that
+        if self._timers_radio:
+            self._timers_radio.wakeup.set()
+
+    def _run_timers(self):
+        """
+        Call everything that is due.
+        :return: seconds until the next timer, None if there are none.
+        """
+        now = time()
+        due = []
+
+        with self._timers_lock:
+            while self._timers and self._timers[0][0] <= now:
+                due.append(heapq.heappop(self._timers)[2])
+            next_in = self._timers[0][0] - now if self._timers else None
+
+        for fn in due:
+            try:
+                fn()
+            except Exception as ex:
+                log.error('Error in timer %s:', fn, exc_info=ex)
+
+        return next_in
+
+    def _send_queued(self, radio):
+        """
+        Send messages from TX queue, which are due. Incoming messages are
+        read after every sent one, so reception never starves. Messages of
+        one window are sent in one go, grouped by pipe.
+        """
+        for _ in xrange(self.TX_BATCH_SIZE):
+            request = radio.tx_queue.pop()
+            if not request:
+                return
+
+            if request.window is None:
+                self._send_request(radio, request)
+            else:
+                requests = [request] + radio.tx_queue.pop_window(request.window)
+                requests.sort(key=lambda r: r.node.send_addr)
+
+                with radio.tx_mode():
+                    for request in requests:
+                        self._send_request(radio, request)
+
+            self._process_hw_messages(radio)
+
+    def _survey_due_in(self, radio):
+        """
+        Seconds until the radio can do the next survey step, if nothing
+        happens meanwhile.
+        """
+        if not self.SURVEY_INTERVAL:
+            return
+
+        now = time()
+        return max(
+            0,
+            radio.next_survey_at - now if radio.survey is None else 0,
+            radio.last_rx + self.SURVEY_IDLE - now,
+        )
+
+    def _survey_if_idle(self, radio):
+        """
+        Survey the next few channels, if it's time and the radio is idle.
+        When the survey is complete, move to a quieter channel.
+        """
+        if not self.SURVEY_INTERVAL:
+            return
+
+        now = time()
+        if radio.survey is None:
+            if now < radio.next_survey_at:
+                return
+            radio.survey = ChannelSurvey(self.SURVEY_CHANNELS, self.SURVEY_SWEEPS)
+
+        if len(radio.tx_queue) or now - radio.last_rx < self.SURVEY_IDLE:
+            return
+
+        radio.survey.step(radio, self.SURVEY_SLICE)
+        if not radio.survey.complete:
+            return
+
+        survey = radio.last_survey = radio.survey
+        radio.survey = None
+        radio.next_survey_at = now + self.SURVEY_INTERVAL
+
+        exclude = set()
+        for other in self.radios:
+            if other is not radio:
+                exclude.update(xrange(
+                    other.channel - self.SURVEY_RADIO_SPACING,
+                    other.channel + self.SURVEY_RADIO_SPACING + 1,
+                ))
+
+        channel = survey.quietest(exclude)
+        current = radio.channel
+        if channel is None:
+            log.warning('Radio %s survey: no candidate channel, staying on %s', radio.index, current)
+            return
+
+        log.info(
+            'Radio %s survey: channel %s busy %.2f, the quietest %s busy %.2f',
+            radio.index,
+            current,
+            survey.occupancy(current) if current in survey.histogram else -1,
+            channel,
+            survey.occupancy(channel),
+        )
+
+        if current not in survey.histogram or \
+                survey.occupancy(current) - survey.occupancy(channel) >= self.SURVEY_MIN_GAIN:
+            self.switch_channel(radio, channel)
+
+    def switch_channel(self, radio, channel):
+        """
+        Move the radio and its devices to `channel`.
+
+        Every device is asked first (TYPE_CHANNEL), and only when all of
+        them have answered, they are told to move (TYPE_CHANNEL_SWITCH) and
+        the radio moves too. Nothing moves if any device of the radio can't
+        be asked (see `Node.can_switch_channel`) or doesn't answer, so
+        devices with old firmware are never left behind.
+
+        Devices with ACK payloads get the messages only when they send
+        something, so they are told to move first, and the rest - after all
+        of them have it. Otherwise the rest would be lost meanwhile.
+        :param channel: None - there's no channel to move to.
+        :return: TxFuture, resolved with the channel when the radio is
+            switched, or with SensorError if it's not.
+        """
+        nodes = [node for node in self.get_nodes() if node.radio is radio]
+        done = TxFuture()
+
+        if channel is None:
+            log.warning('Radio %s: no candidate channel, staying on %s', radio.index, radio.channel)
+            done.set_exception(SensorError('No candidate channel'))
+            return done
+
+        deaf = [node.name for node in nodes if not node.can_switch_channel]
+        if deaf:
+            log.warning(
+                'Radio %s: staying on channel %s, can not ask %s',
+                radio.index, radio.channel, ', '.join(deaf),
+            )
+            done.set_exception(SensorError('Can not ask %s' % ', '.join(deaf)))
+            return done
+
+        log.info('Radio %s: asking %s nodes to move to channel %s', radio.index, len(nodes), channel)
+
+        def tell(nodes, callback):
+            with radio.tx_queue.window():
+                futures = [
+                    node.send_data(
+                        node.MESSAGE_CLASS(node.NODE_ID, Message.TYPE_CHANNEL_SWITCH),
+                        priority=PRIORITY_HIGH,
+                        coalesce_key='channel',
+                    )
+                    for node in nodes
+                ]
+
+            def on_sent(future):
+                for node, result in zip(nodes, future.result()):
+                    if isinstance(result, Exception):
+                        # Should find us again by scanning, or stay offline
+                        log.warning('%s was not told to move: %s', node.name, result)
+                callback()
+
+            gather(futures).add_done_callback(on_sent)
+
+        def switch():
+            radio.set_channel(channel)
+            done.set_result(channel)
+
+        def on_answered(future):
+            silent = [
+                node.name
+                for node, result in zip(nodes, future.result())
+                if isinstance(result, Exception)
+            ]
+            if silent:
+                log.warning(
+                    'Radio %s: staying on channel %s, no answer from %s',
+                    radio.index, radio.channel, ', '.join(silent),
+                )
+                done.set_exception(SensorError('No answer from %s' % ', '.join(silent)))
+                return
+
+            sleeping = [node for node in nodes if node.uses_ack_payloads]
+            awake = [node for node in nodes if not node.uses_ack_payloads]
+            tell(sleeping, lambda: tell(awake, switch))
+
+        gather([node.request_channel(channel) for node in nodes]).add_done_callback(on_answered)
+        return done
+
+    def _send_request(self, radio, request):
+        node = request.node
+        request.attempts += 1
+
+        if node.uses_ack_payloads and not self.routes.best(node.NODE_ID).relays:
+            self._park_ack_request(radio, request)
+            return
+
+        retries = node.link.send_retries(node.SEND_RETRIES)
+
+        try:
+            self._send_via_route(radio, node, request.payload)
+        except SensorError as ex:
+            log.warning(
+                '[%s/%s] Error sending message %s to device %s: %s',
+                request.attempts,
+                retries,
+                request.msg,
+                node.NODE_ID,
+                str(ex),
+            )
+
+            if request.attempts >= retries:
+                request.resolve(exception=SensorError(
+                    'Request failed %s times in a row' % retries,
+                ))
+            else:
+                node.link.add_retry()
+                delay = node.link.send_delay(node.SEND_DELAY) * 2 ** (request.attempts - 1)
+                radio.tx_queue.retry_later(request, delay / 1000.0)
+        except Exception as ex:
+            # Not a radio error, retrying won't help. The request is popped
+            # already, so whoever waits for it must know.
+            log.exception('Error sending message %s to device %s', request.msg, node.NODE_ID)
+            request.resolve(exception=ex)
+        else:
+            request.resolve(True)
+
+    def _send_via_route(self, radio, node, payload):
+        """
+        Send directly or through relays, whichever works better.
+        """
+        route = self.routes.best(node.NODE_ID)
+        target = node
+        payload = node._with_address(payload)
+
+        if route.relays:
+            target = self.get_node(node_id=route.relays[0])
+            if not target:
+                raise SensorError('Unknown relay node_id=%s' % route.relays[0])
+
+            payload = wrap(payload, node.NODE_ID, route.relays, Node.PAYLOAD_SIZE)
+            payload = target._with_address(payload)
+
+        started = time()
+        try:
+            target._send_data_to_radio(payload, radio)
+        except SensorError:
+            route.add_tx_result(False, time() - started)
+            raise
+
+        route.add_tx_result(True, time() - started)
+
+    def _park_ack_request(self, radio, request):
+        """
+        Keep the request until it can go with ACK to the device's packet.
+        Devices take ACK payloads only when they send something, so it fails
+        if nothing is heard from the device for `OFFLINE_AFTER_N_SECONDS`.
+        """
+        node = request.node
+
+        with self._ack_lock:
+            for i, parked in enumerate(node._ack_requests):
+                if request.coalesce_key is not None and \
+                        parked.coalesce_key == request.coalesce_key and \
+                        parked not in self._ack_loaded.values():
+                    log.debug('%r is superseded', parked)
+                    request.futures = parked.futures + request.futures
+                    node._ack_requests[i] = request
+                    break
+            else:
+                node._ack_requests.append(request)
+
+        self.call_at(
+            time() + node.OFFLINE_AFTER_N_SECONDS,
+            partial(self._expire_ack_request, request),
+        )
+        self._load_ack_payloads(radio)
+
+    def _load_ack_payloads(self, radio):
+        """
+        Load the first waiting request of every device, while the pipe is
+        free and there's room in TX FIFO.
+        """
+        with self._ack_lock:
+            for node in self.get_nodes():
+                if not node._ack_requests or node.radio is not radio:
+                    continue
+
+                key = (radio.index, node.LISTEN_PIPE_NUMBER)
+                request = node._ack_requests[0]
+                if key in self._ack_loaded:
+                    continue
+
+                payload = node._with_address(request.payload)
+                if radio.load_ack_payload(node.LISTEN_PIPE_NUMBER, payload):
+                    self._ack_loaded[key] = request
+
+    def _ack_payload_taken(self, radio, raw_data):
+        """
+        A packet is received, so ACK payload of the sender's pipe went to
+        the sender with the ACK.
+        """
+        # The device itself or the closest relay
+        sender_id = int(raw_data[0])
+        sender = self._active_nodes.get(sender_id)
+        if sender is None and len(raw_data) > 2 and raw_data[1] == Message.TYPE_HELLO:
+            # Introducing itself on the pipe of its type
+            sender = self._node_by_type.get(raw_data[2])
+        if sender is None or sender.LISTEN_PIPE_NUMBER is None:
+            return
+
+        pipe = sender.LISTEN_PIPE_NUMBER
+        if radio.pop_ack_payload(pipe) is None:
+            return
+
+        with self._ack_lock:
+            request = self._ack_loaded.pop((radio.index, pipe), None)
+            if request is not None and request.node.NODE_ID == sender_id:
+                request.node._ack_requests.remove(request)
+            else:
+                # Another device of the same type, it ignores messages
+                # not addressed to it. Loaded again below.
+                request = None
+
+        if request is not None:
+            log.debug('%r is sent with ACK', request)
+            request.node.link.add_tx(True)
+            request.resolve(True)
+
+        self._load_ack_payloads(radio)
+
+    def _expire_ack_request(self, request):
+        node = request.node
+
+        with self._ack_lock:
+            if request not in node._ack_requests:
+                # Sent or superseded
+                return
+
+            node._ack_requests.remove(request)
+            loaded = [key for key, r in self._ack_loaded.iteritems() if r is request]
+            for key in loaded:
+                del self._ack_loaded[key]
+
+        for index, pipe in loaded:
+            self.radios[index].drop_ack_payload(pipe)
+            self._load_ack_payloads(self.radios[index])
+
+        node.link.add_tx(False)
+        request.resolve(exception=SensorError(
+            '%s did not send anything to pick the message up' % node.name,
+        ))
+
     def get_node(self, node_id=None, name=None):
         if node_id is not None:
             return self._active_nodes.get(node_id)
 
-        for node in self._active_nodes.itervalues():
-            if node.NAME == name:
-                return node
+        return self._nodes_by_name.get(name)
+
+    def get_nodes(self):
+        return self._active_nodes.values()
+
+    def start_capture(self, path, **kwargs):
+        """
+        Write all radio packets to `path`, see `capture.PacketCapture`.
+        """
+        self.stop_capture()
+        log.info('Capturing radio packets to %s', path)
+        self.capture = PacketCapture(path, **kwargs)
+
+    def stop_capture(self):
+        capture, self.capture = self.capture, None
+        if capture:
+            capture.close()
+
+    def _open_reading_pipe(self, node):
+        """
+        On all the radios, so a device can be heard on any channel.
+        """
+        number = node.LISTEN_PIPE_NUMBER
+        if number is None:
+            return
+
+        for radio in self.radios:
+            radio.open_reading_pipe(number, node.recv_addr)
+
+    def _add_node(self, node):
+        self._open_reading_pipe(node)
+
+        with self._nodes_lock:
+            old = self._active_nodes.get(node.NODE_ID)
+            if old:
+                del self._nodes_by_name[old.NAME]
+
+            self._active_nodes[node.NODE_ID] = node
+            self._nodes_by_name[node.NAME] = node
+
+    def _process_hello(self, node_id, node_type, radio, flags=0):
+        addressed = bool(flags & Message.HELLO_ADDRESSED)
 
-    def _get_radio(self):
-        log.info('Initializing radio...')
-        radio = RF24(*self.RF24_PINS)
-        radio.begin()
-        radio.setRetries(self.RETRIES_DELAY, self.RETRIES_COUNT)
+        node = self._active_nodes.get(node_id)
+        if node and node.NODE_TYPE == node_type:
+            log.info('%s is back', node.name)
+            node.addressed = addressed
+            return
+
+        node_cls = self._node_by_type.get(node_type)
+        if not node_cls:
+            log.warning('Hello from node_id=%s of unknown type %s', node_id, node_type)
+            return
+
+        log.info('New node of type %s, node_id=%s', node_cls.__name__, node_id)
+        if node_id != node_cls.NODE_ID and not addressed:
+            log.warning(
+                'node_id=%s does not take addressed messages, it gets the ones '
+                'for other devices of its type too', node_id,
+            )
 
-        radio.setPALevel(RF24_PA_HIGH)
-        radio.setDataRate(RF24_250KBPS)
-        radio.setChannel(self.CHANNEL)
-        radio.printDetails()
-        radio.startListening()
+        node = node_cls(self, radio, node_id=node_id)
+        node.addressed = addressed
+        self._add_node(node)
 
-        return radio
+    def next_state_version(self):
+        return next(self._state_versions)
+
+    def get_link_stats(self):
+        return {
+            node.NAME: node.link.to_dict()
+            for node in self.get_nodes()
+        }
+
+    def get_radios_info(self):
+        nodes = self.get_nodes()
+
+        return [
+            dict(
+                radio.to_dict(),
+                nodes=[node.NAME for node in nodes if node.radio is radio],
+            )
+            for radio in self.radios
+        ]
+
+    def _pick_radio(self, node_id):
+        """
+        Only from the config: the device is on the channel of that radio,
+        any other one would fail every send until the device is heard.
+        """
+        return self.radios[self.NODE_RADIOS.get(node_id, 0)]
+
+    def _move_node(self, node, radio):
+        """
+        The device is heard by another radio: queued messages go with it,
+        and its ACK payload is loaded to the new radio.
+        """
+        log.info('%s is heard by radio %s now', node.name, radio.index)
+        old, node.radio = node.radio, radio
+        old.tx_queue.move_node(node, radio.tx_queue)
+
+        with self._ack_lock:
+            loaded = [
+                key for key, request in self._ack_loaded.iteritems()
+                if request.node is node and key[0] == old.index
+            ]
+            for key in loaded:
+                del self._ack_loaded[key]
+
+        for _, pipe in loaded:
+            old.drop_ack_payload(pipe)
+        if loaded:
+            self._load_ack_payloads(old)
+        self._load_ack_payloads(radio)
 
     def _init_nodes(self):
         """
         Open needed listening pipes for all devices.
         """
         for node_id, node_cls in self._node_by_id.iteritems():
-            self._active_nodes[node_id] = node_cls(self, self._radio)
+            self._add_node(node_cls(self, self._pick_radio(node_id)))
 
-    def _read_data_from_radio(self):
+    def _read_data_from_radio(self, radio):
         """
         If there's some data available - read one message and return.
         Else return None.
         """
-        if self._radio.available():
-            payload = self._radio.read(self.MAX_PAYLOAD_SIZE)
+        payload = radio.read(self.MAX_PAYLOAD_SIZE)
+        if payload is None:
+            return
 
-            log.debug(
-                'Got payload size=%s value=%s',
-                len(payload),
-                map(int, payload),
-            )
+        capture = self.capture
+        if capture:
+            capture.write_rx(payload)
+
+        log.debug(
+            'Got payload size=%s value=%s',
+            len(payload),
+            ByteValues(payload),
+        )
+
+        return payload
+
+    def apply_scene(self, changes):
+        """
+        Change states of many nodes at once. Resulting messages are sent
+        together, in one TX window.
+
+        :param changes: list of {'node_id' or 'name': ..., 'state': {...}}
+        :return: TxFuture, resolved with {node name: 'ok' or error} when
+            all the messages are sent or failed.
+        """
+        results = {}
+        nodes = []
+
+        with nested(*[radio.tx_queue.window() for radio in self.radios]) as windows:
+            for change in changes:
+                node = self.get_node(node_id=change.get('node_id'), name=change.get('name'))
+                if not node:
+                    key = change.get('name') or change.get('node_id')
+                    results[key] = 'node not found'
+                    continue
+
+                if not node.state.is_online:
+                    results[node.NAME] = 'offline'
+                    continue
+
+                node.update_state(change.get('state') or {})
+                nodes.append(node)
 
-            return payload
+        requests = [
+            r
+            for window in windows
+            for r in window.requests
+            if not r.cancelled
+        ]
+        done = TxFuture()
+
+        def on_done(future):
+            for node in nodes:
+                results.setdefault(node.NAME, 'ok')
+
+            for request, result in zip(requests, future.result()):
+                if isinstance(result, Exception):
+                    results[request.node.NAME] = str(result)
+
+            done.set_result(results)
+
+        gather(r.future for r in requests).add_done_callback(on_done)
+        return done
 
     def process_client_message(self, data):
         node_id = data.get('node_id')
         type_ = data.get('type')
 
+        if type_ == 'scene':
+            changes = data.get('changes')
+            if not isinstance(changes, list):
+                return {'error': 'bad format'}
+
+            response = TxFuture()
+            self.apply_scene(changes).add_done_callback(
+                lambda f: response.set_result({'results': f.result()}),
+            )
+            return response
+
         if node_id is None or not type_:
             return {'error': 'bad format'}
 
@@ -397,39 +1529,66 @@ class WirelessSensor(Sensor):
 
         return node.process_client_message(data)
 
-    def _process_hw_messages(self):
+    def _process_hw_messages(self, radio):
+        """
+        Read everything from RX FIFO. Every packet is traced, from the read
+        to the socket consumers (see `tracing`).
+        """
         while True:
-            new_msg = self._read_data_from_radio()
-            if not new_msg:
-                break
+            with tracer.trace('radio') as trace:
+                with tracer.span('read'):
+                    new_msg = self._read_data_from_radio(radio)
+                if not new_msg:
+                    if trace:
+                        trace.discard()
+                    break
 
-            node_id = int(new_msg[0])
-            node = self._active_nodes.get(node_id)
+                if radio.ack_payloads:
+                    self._ack_payload_taken(radio, new_msg)
 
-            if not node:
-                log.warning('Message for unknown node_id=%s' % node_id)
-                continue
+                relays, new_msg = unwrap(new_msg)
+                node_id = int(new_msg[0])
+                self.routes.learn(node_id, relays)
 
-            node.process_new_hw_message(
-                node.MESSAGE_CLASS.parse(new_msg),
-            )
+                if len(new_msg) > 1 and new_msg[1] == Message.TYPE_HELLO:
+                    msg = Message.parse(new_msg)
+                    self._process_hello(msg.node_id, msg.data, radio, msg.flags)
+                    continue
+
+                node = self._active_nodes.get(node_id)
+
+                if not node:
+                    log.warning('Message for unknown node_id=%s' % node_id)
+                    continue
+
+                if node.radio is not radio:
+                    self._move_node(node, radio)
+
+                node.link.add_rx()
+                with tracer.span('parse'):
+                    msg = node.MESSAGE_CLASS.parse(new_msg)
+                node.process_new_hw_message(msg)
+
+        if radio.dynamic_payloads:
+            # Not loaded while RX FIFO had packets, see `Radio.load_ack_payload`
+            self._load_ack_payloads(radio)
 
     def _iteration(self):
         """
         Read all new messages and route them to nodes.
         """
-        self._process_hw_messages()
-
+        polled = [radio for radio in self.radios if not radio.irq_mode]
 
-        # Check devices state
-        for node in self._active_nodes.itervalues():
-            node.check_if_offline()
+        for radio in polled:
+            self._process_hw_messages(radio)
 
         self._process_socket_messages()
 
+        for radio in polled:
+            self._send_queued(radio)
+            self._survey_if_idle(radio)
 
-
-
-wireless_sensor = WirelessSensor()
-wireless_sensor.start()
+        if not self._timers_radio:
+            # Offline checks and timeouts, the radio thread runs them in IRQ mode.
+            self._run_timers()
 
@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+"""
+Raw radio packet capture.
+
+Every packet read from or written to the radio is appended to a binary log:
+    [timestamp: double][direction: byte][node_id: byte][length: byte][payload]
+Writes are buffered, files are rotated by size like `RotatingFileHandler`.
+Captures can be fed back with tools/radio_replay.py.
+"""
+from __future__ import unicode_literals
+
+import logging
+import os
+import struct
+from threading import Lock
+from time import time
+
+log = logging.getLogger(__name__)
+
+MAGIC = b'NRFCAP1\n'
+
+DIRECTION_RX = 0
+DIRECTION_TX = 1
+
+_RECORD = struct.Struct(str('<dBBB'))
+
+
+class PacketCapture(object):
+    def __init__(self, path, max_bytes=10 * 1024 * 1024, backup_count=5,
+                 buffer_size=64 * 1024, flush_interval=5):
+        """
+        :param max_bytes: rotate the file when it's bigger. 0 - never.
+        :param flush_interval: write the buffer to disk at least every N seconds.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.buffer_size = buffer_size
+        self.flush_interval = flush_interval
+        self.packets = 0
+
+        self._lock = Lock()
+        self._file = None
+        self._last_flush = time()
+        self._open()
+
+    def _open(self):
+        self._file = open(self.path, 'ab', self.buffer_size)
+        if self._file.tell() == 0:
+            self._file.write(MAGIC)
+
+    def _rotate(self):
+        self._file.close()
+
+        for i in xrange(self.backup_count - 1, 0, -1):
+            src = '%s.%s' % (self.path, i)
+            if os.path.exists(src):
+                os.rename(src, '%s.%s' % (self.path, i + 1))
+
+        if self.backup_count:
+            os.rename(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+
+        self._open()
+
+    def write(self, direction, node_id, payload):
+        now = time()
+        record = _RECORD.pack(now, direction, node_id or 0, len(payload)) + bytes(payload)
+
+        with self._lock:
+            if self._file is None:
+                return
+
+            self._file.write(record)
+            self.packets += 1
+
+            if now - self._last_flush >= self.flush_interval:
+                self._file.flush()
+                self._last_flush = now
+
+            if self.max_bytes and self._file.tell() >= self.max_bytes:
+                self._rotate()
+
+    def write_rx(self, payload):
+        self.write(DIRECTION_RX, 0, payload)
+
+    def write_tx(self, node_id, payload):
+        self.write(DIRECTION_TX, node_id, payload)
+
+    def close(self):
+        with self._lock:
+            if self._file:
+                self._file.close()
+                self._file = None
+
+
+def read_capture(path):
+    """
+    :return: generator of (timestamp, direction, node_id, payload)
+    """
+    with open(path, 'rb') as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError('%s is not a packet capture' % path)
+
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+
+            ts, direction, node_id, length = _RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                log.warning('Capture %s is truncated', path)
+                return
+
+            yield ts, direction, node_id, bytearray(payload)
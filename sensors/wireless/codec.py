@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+"""
+Declarative binary layouts for wireless messages.
+
+Node classes describe their payloads once, as a list of `Field`s. Layouts are
+compiled to `struct.Struct` when the class is created, so parsing a packet is
+a single `unpack_from` on the received buffer, without slicing or concatenation.
+"""
+from __future__ import unicode_literals
+
+import struct
+
+
+class Field(object):
+    """
+    A single value in a payload.
+
+    :param name: key in state dict or node fields.
+    :param fmt: `struct` format of the raw value (little-endian), 'B' by default.
+    :param scale: value = raw * scale + offset
+    :param offset: see `scale`.
+    :param field_id: id of the field, used in FIELD_REQUEST/SET/RESPONSE messages.
+    """
+    def __init__(self, name, fmt='B', scale=1, offset=0, field_id=None):
+        self.name = name
+        self.fmt = str(fmt)
+        self.scale = scale
+        self.offset = offset
+        self.field_id = field_id
+
+    @property
+    def is_raw(self):
+        return self.scale == 1 and self.offset == 0
+
+    def decode(self, raw):
+        if self.is_raw:
+            return raw
+        return raw * self.scale + self.offset
+
+    def encode(self, value):
+        if self.is_raw:
+            return value
+
+        raw = (value - self.offset) / float(self.scale)
+        # Integer formats do not accept floats
+        return raw if self.fmt in 'fd' else int(round(raw))
+
+    def __repr__(self):
+        return '<Field %s %s>' % (self.name, self.fmt)
+
+
+class Layout(object):
+    """
+    Compiled list of fields, following each other in the payload.
+    """
+    def __init__(self, fields, prefix=''):
+        """
+        :param prefix: `struct` format of values before the fields
+            (e.g. message type), one character per value.
+        """
+        self.fields = tuple(fields)
+        self.names = tuple(f.name for f in self.fields)
+        self.struct = struct.Struct(
+            str('<' + prefix + ''.join(f.fmt for f in self.fields)),
+        )
+        self.size = self.struct.size
+        self._prefix_len = len(prefix)
+        # Only these need conversion, the rest are used as is.
+        self._converted = tuple(
+            (i, f) for i, f in enumerate(self.fields) if not f.is_raw
+        )
+
+    def unpack(self, buf, offset=0):
+        """
+        :return: list of field values.
+        """
+        values = self.struct.unpack_from(buf, offset)
+        if self._prefix_len:
+            values = values[self._prefix_len:]
+
+        if not self._converted:
+            return values
+
+        values = list(values)
+        for i, f in self._converted:
+            values[i] = f.decode(values[i])
+        return values
+
+    def decode(self, buf, offset=0):
+        """
+        :return: dict name -> value.
+        """
+        return dict(zip(self.names, self.unpack(buf, offset)))
+
+    def encode(self, data, *prefix):
+        """
+        :param data: dict name -> value, all fields are required.
+        """
+        values = list(prefix)
+        for f in self.fields:
+            values.append(f.encode(data[f.name]))
+
+        return self.struct.pack(*values)
@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Link quality of a single wireless node.
+
+Every send and receive is counted, the latest ones are also kept in rolling
+windows. Retry settings are derived from the windows: a node which gets
+everything from the first attempt does not need 15 hardware retransmits and
+5 software retries, a node behind a wall does.
+"""
+from __future__ import unicode_literals
+
+import math
+from collections import deque
+from threading import Lock
+from time import time
+
+
+class LinkStats(object):
+    # Size of rolling windows, packets
+    WINDOW = 100
+    # Probability of delivering a message we aim for, with software retries
+    TARGET_DELIVERY = 0.999
+    # Hardware retransmits on top of the most seen recently
+    HW_RETRIES_MARGIN = 2
+    MIN_HW_RETRIES = 3
+    MIN_SEND_RETRIES = 2
+    # Loss, at which retries are delayed for the full `SEND_DELAY`.
+    # Occasional failures on a good link are noise, retry them right away.
+    # Many failures mean interference, which takes time to go away.
+    HIGH_LOSS = 0.3
+
+    def __init__(self):
+        self.tx_attempts = 0
+        self.tx_failures = 0
+        # Hardware retransmits, if the radio reports them
+        self.tx_hw_retries = 0
+        # Messages sent again by us, after all hardware retransmits failed
+        self.tx_retries = 0
+        self.rx_packets = 0
+        self.last_rx = None
+
+        # (success, hw retries or None)
+        self._tx_window = deque(maxlen=self.WINDOW)
+        # Seconds between received packets
+        self._rx_gaps = deque(maxlen=self.WINDOW)
+        self._lock = Lock()
+
+    def add_tx(self, success, hw_retries=None):
+        with self._lock:
+            self.tx_attempts += 1
+            if not success:
+                self.tx_failures += 1
+            if hw_retries:
+                self.tx_hw_retries += hw_retries
+            self._tx_window.append((success, hw_retries))
+
+    def add_retry(self):
+        self.tx_retries += 1
+
+    def add_rx(self, now=None):
+        now = now or time()
+
+        with self._lock:
+            if self.last_rx is not None:
+                self._rx_gaps.append(now - self.last_rx)
+            self.last_rx = now
+            self.rx_packets += 1
+
+    @property
+    def tx_loss(self):
+        """
+        Share of failed sends in the window. Starts from one success and one
+        failure, like `Route.loss`, so a single send does not make it 0 or 1.
+        """
+        with self._lock:
+            failures = sum(1 for success, _ in self._tx_window if not success)
+            return (failures + 1.0) / (len(self._tx_window) + 2)
+
+    @property
+    def rx_loss(self):
+        """
+        Estimated from gaps: devices send their status regularly, so a gap of
+        three typical ones means two packets are missing.
+        """
+        with self._lock:
+            gaps = sorted(self._rx_gaps)
+
+        if not gaps:
+            return None
+
+        typical = gaps[len(gaps) // 2]
+        if typical <= 0:
+            return 0.0
+
+        missed = sum(max(0, int(round(gap / typical)) - 1) for gap in gaps)
+        return float(missed) / (missed + len(gaps))
+
+    def hw_retries(self, max_retries):
+        """
+        Hardware retransmit count to use for the next send.
+        """
+        with self._lock:
+            window = list(self._tx_window)
+
+        if not window or any(not success for success, _ in window):
+            # Nothing known, or retransmits were not enough recently
+            return max_retries
+
+        seen = [r for _, r in window if r is not None]
+        if not seen:
+            # The radio does not report retransmits
+            return max_retries
+
+        return max(
+            min(max_retries, self.MIN_HW_RETRIES),
+            min(max_retries, max(seen) + self.HW_RETRIES_MARGIN),
+        )
+
+    def send_retries(self, max_retries):
+        """
+        Software retries, enough to deliver with `TARGET_DELIVERY` probability
+        at the current loss.
+        """
+        loss = self.tx_loss
+        needed = int(math.ceil(math.log(1 - self.TARGET_DELIVERY) / math.log(loss)))
+        return max(min(max_retries, self.MIN_SEND_RETRIES), min(max_retries, needed))
+
+    def send_delay(self, max_delay):
+        """
+        First retry delay, msec.
+        """
+        return max_delay * min(1.0, self.tx_loss / self.HIGH_LOSS)
+
+    def to_dict(self):
+        with self._lock:
+            gaps = list(self._rx_gaps)
+            window = list(self._tx_window)
+
+        return {
+            'tx_attempts': self.tx_attempts,
+            'tx_failures': self.tx_failures,
+            'tx_hw_retries': self.tx_hw_retries,
+            'tx_retries': self.tx_retries,
+            'rx_packets': self.rx_packets,
+            'last_rx': self.last_rx,
+            'window': {
+                'tx_attempts': len(window),
+                'tx_failures': sum(1 for success, _ in window if not success),
+                'rx_packets': len(gaps),
+                'rx_gap_avg': round(sum(gaps) / len(gaps), 3) if gaps else None,
+                'rx_gap_max': round(max(gaps), 3) if gaps else None,
+            },
+            'tx_loss': round(self.tx_loss, 3),
+            'rx_loss': round(self.rx_loss, 3) if gaps else None,
+        }
@@ -7,6 +7,8 @@ from __future__ import unicode_literals
 import logging
 
 from .base import Node, Message, State
+from .codec import Field
+from .tx_queue import PRIORITY_HIGH
 from .utils import to_bool
 
 
@@ -15,12 +17,9 @@ logger = logging.getLogger(__name__)
 
 class PowerControlState(State):
     ALLOWED_KEYS = {'power_on'}
-
-    @classmethod
-    def _parse_raw_data(cls, raw_data):
-        return {
-            'power_on': raw_data[0],
-        }
+    FIELDS = [
+        Field('power_on'),
+    ]
 
     def _apply_new_state(self, old, new):
         if 'power_on' in new:
@@ -35,8 +34,8 @@ class PowerControlMessage(Message):
 
 
 class PowerControlNode(Node):
-    # We only allow one device of each type for now
     NODE_ID = 1
+    NODE_TYPE = 1
     MESSAGE_CLASS = PowerControlMessage
     STATE_CLASS = PowerControlState
     NAME = 'lamp'
@@ -50,6 +49,9 @@ class PowerControlNode(Node):
         msg_type = self.MESSAGE_CLASS.TYPE_ON if is_enabled \
             else self.MESSAGE_CLASS.TYPE_OFF
 
-        self.send_data(
+        # Only the last state matters, if user clicks faster than we send.
+        return self.send_data(
             self.MESSAGE_CLASS(self.NODE_ID, msg_type),
+            priority=PRIORITY_HIGH,
+            coalesce_key='power',
         )
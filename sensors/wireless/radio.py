@@ -0,0 +1,315 @@
+# -*- coding: utf-8 -*-
+"""
+A single nRF24L01+ module of the wireless sensor.
+
+Every radio has its own pins, channel, reading pipes and TX queue. In IRQ mode
+it also has its own I/O thread (see `WirelessSensor._radio_loop`), so several
+radios on different channels work in parallel.
+"""
+from __future__ import unicode_literals
+
+import logging
+import os
+from contextlib import contextmanager
+from threading import RLock, Event
+from time import time, sleep
+
+from ..base import SensorError
+from .tx_queue import TxQueue
+
+if os.environ.get('WIRELESS_SIMULATOR'):
+    # No hardware: tests and tools, see `simulator`
+    from .simulator import (
+        RF24_PA_HIGH,
+        RF24_250KBPS,
+        SimulatedRF24 as RF24,
+        FakeGPIO,
+    )
+    GPIO = FakeGPIO()
+else:
+    from RF24 import RF24_PA_HIGH, RF24_250KBPS, RF24
+    import RPi.GPIO as GPIO
+
+log = logging.getLogger(__name__)
+
+
+class Radio(object):
+    # Time to listen on a channel before checking the carrier, seconds
+    SURVEY_DWELL = 0.0002
+    # TX FIFO levels, shared by ACK payloads of all pipes
+    ACK_FIFO_SIZE = 3
+    MAX_PAYLOAD_SIZE = 32
+
+    def __init__(self, index, channel, pins=None, irq_pin=None, rf24=None,
+                 gpio=GPIO, retries_delay=5, retries_count=15,
+                 dynamic_payloads=False):
+        """
+        :param pins: [CE, CSN], used if `rf24` is not passed.
+        :param irq_pin: BCM number of the pin, connected to IRQ. None - poll.
+        :param rf24: RF24-compatible object.
+        :param dynamic_payloads: packets are as long as the data, not padded
+            to 32 bytes, and ACK payloads can be used.
+        """
+        self.index = index
+        self.channel = channel
+        self.irq_pin = irq_pin
+        self.dynamic_payloads = dynamic_payloads
+        self.retries_delay = retries_delay
+        self.retries_count = retries_count
+
+        # RF24 is not thread-safe, and is used by radio and sensor threads.
+        self.lock = RLock()
+        # Pipe number -> address
+        self.reading_pipes = {}
+        # Wakes the radio thread up: new packet or new message to send.
+        self.wakeup = Event()
+        self.tx_queue = TxQueue(on_put=self.wakeup.set)
+        self.thread = None
+        # When the last packet was received
+        self.last_rx = 0
+        # `survey.ChannelSurvey` in progress, and the last complete one
+        self.survey = None
+        self.last_survey = None
+        self.next_survey_at = 0
+        # Pipe number -> payload, sent with ACK of the next packet on the pipe
+        self.ack_payloads = {}
+        # Pipes, which got a packet while their payload was being loaded
+        self._ack_unsure = set()
+
+        self._gpio = gpio
+        self._hw_retries = retries_count
+        # Writing pipe address, while in `tx_mode`
+        self._tx_mode = False
+        self._writing_addr = None
+        self._rf24 = self._begin(rf24 or RF24(*pins))
+
+    def __repr__(self):
+        return '<Radio %s, channel %s>' % (self.index, self.channel)
+
+    @property
+    def irq_mode(self):
+        return self.irq_pin is not None
+
+    def _begin(self, rf24):
+        log.info('Initializing radio %s...', self.index)
+        rf24.begin()
+        rf24.setRetries(self.retries_delay, self.retries_count)
+
+        rf24.setPALevel(RF24_PA_HIGH)
+        rf24.setDataRate(RF24_250KBPS)
+        rf24.setChannel(self.channel)
+        if self.dynamic_payloads:
+            rf24.enableDynamicPayloads()
+            rf24.enableAckPayload()
+        rf24.printDetails()
+        rf24.startListening()
+
+        return rf24
+
+    def setup_irq(self):
+        log.info('Radio %s: using IRQ on pin %s', self.index, self.irq_pin)
+
+        # Only "RX data ready" pulls IRQ down, not TX results.
+        self._rf24.maskIRQ(True, True, False)
+
+        self._gpio.setmode(self._gpio.BCM)
+        self._gpio.setup(self.irq_pin, self._gpio.IN, pull_up_down=self._gpio.PUD_UP)
+        self._gpio.add_event_detect(
+            self.irq_pin,
+            self._gpio.FALLING,
+            callback=self._on_irq,
+        )
+
+    def _on_irq(self, channel):
+        # Called from the RPi.GPIO thread, just wake the radio thread up.
+        self.wakeup.set()
+
+    def stop(self):
+        if self.irq_mode:
+            self._gpio.remove_event_detect(self.irq_pin)
+            self.wakeup.set()
+
+        self.tx_queue.clear(SensorError('Sensor is stopped'))
+
+    def set_channel(self, channel):
+        log.info('Radio %s: switching to channel %s', self.index, channel)
+        with self.lock:
+            self._rf24.setChannel(channel)
+            self.channel = channel
+
+    def measure_channels(self, channels, sweeps):
+        """
+        Check the carrier on every channel `sweeps` times.
+        :return: channel -> how many times it was busy.
+        """
+        test = getattr(self._rf24, 'testRPD', None) or self._rf24.testCarrier
+        busy = dict.fromkeys(channels, 0)
+
+        with self.lock:
+            self._rf24.stopListening()
+            try:
+                for _ in xrange(sweeps):
+                    for channel in channels:
+                        self._rf24.setChannel(channel)
+                        self._rf24.startListening()
+                        sleep(self.SURVEY_DWELL)
+                        self._rf24.stopListening()
+                        busy[channel] += bool(test())
+            finally:
+                self._rf24.setChannel(self.channel)
+                self._start_listening()
+
+        return busy
+
+    def open_reading_pipe(self, number, addr):
+        current = self.reading_pipes.get(number)
+        if current == addr:
+            # Shared with other devices of the same type
+            return
+
+        if current is not None:
+            raise SensorError('Pipe %s is already used by another node type' % number)
+
+        log.info('Radio %s: start listening on pipe %s addr=%s', self.index, number, addr)
+        with self.lock:
+            self._rf24.openReadingPipe(number, addr)
+        self.reading_pipes[number] = addr
+
+    def read(self, size):
+        """
+        One packet from RX FIFO, None if it's empty.
+        """
+        with self.lock:
+            if not self._rf24.available():
+                return
+
+            if self.dynamic_payloads:
+                size = self._rf24.getDynamicPayloadSize()
+                if not 0 < size <= self.MAX_PAYLOAD_SIZE:
+                    # Corrupted, the datasheet says to drop the whole FIFO
+                    log.warning('Radio %s: bad payload size %s', self.index, size)
+                    self._rf24.flush_rx()
+                    return
+
+            payload = self._rf24.read(size)
+
+        self.last_rx = time()
+        return payload
+
+    def load_ack_payload(self, pipe, payload):
+        """
+        Send `payload` with ACK of the next packet received on `pipe`,
+        without leaving RX mode.
+        :return: False if the pipe already has one, TX FIFO is full, or
+            RX FIFO is not empty: packets in it were ACKed without the
+            payload, and would be taken for picking it up.
+        """
+        with self.lock:
+            if pipe in self.ack_payloads or len(self.ack_payloads) >= self.ACK_FIFO_SIZE:
+                return False
+
+            if self._rf24.available():
+                return False
+
+            self.ack_payloads[pipe] = payload
+            if not self._tx_mode:
+                self._rf24.writeAckPayload(pipe, payload)
+                if self._rf24.available():
+                    # Received while loading, with or without the payload
+                    self._ack_unsure.add(pipe)
+        return True
+
+    def pop_ack_payload(self, pipe):
+        """
+        A packet was received on `pipe`, so its ACK payload is gone.
+        :return: the payload, None if there was none, or it's not known
+            if the packet took it (the next one does, if this one didn't).
+        """
+        with self.lock:
+            if pipe in self._ack_unsure:
+                self._ack_unsure.discard(pipe)
+                return
+
+            return self.ack_payloads.pop(pipe, None)
+
+    def drop_ack_payload(self, pipe):
+        """
+        Remove ACK payload of the pipe, which is still in TX FIFO.
+        """
+        with self.lock:
+            self._ack_unsure.discard(pipe)
+            if self.ack_payloads.pop(pipe, None) is None:
+                return
+
+            # Can't remove a single one, reload the rest
+            self._rf24.flush_tx()
+            if not self._tx_mode:
+                self._reload_ack_payloads()
+
+    def _reload_ack_payloads(self):
+        for pipe, payload in self.ack_payloads.iteritems():
+            self._rf24.writeAckPayload(pipe, payload)
+
+    def _start_listening(self):
+        self._rf24.startListening()
+        # RF24 flushes TX FIFO with ACK payloads in `stopListening`
+        self._reload_ack_payloads()
+
+    @contextmanager
+    def tx_mode(self):
+        """
+        Keep the radio transmitting (not listening) inside the block,
+        so several messages can be written in a row.
+        """
+        with self.lock:
+            if self._tx_mode:
+                yield
+                return
+
+            self._rf24.stopListening()
+            self._tx_mode = True
+            try:
+                yield
+            finally:
+                self._tx_mode = False
+                self._writing_addr = None
+                # Restores pipe 0, which is overwritten by openWritingPipe
+                self._start_listening()
+
+    def open_writing_pipe(self, addr):
+        """
+        Only in `tx_mode`. Consecutive messages to the same pipe do not
+        reopen it.
+        """
+        if addr != self._writing_addr:
+            self._rf24.openWritingPipe(addr)
+            self._writing_addr = addr
+
+    def set_hw_retries(self, retries):
+        """
+        Hardware retransmit count for the next send, only in `tx_mode`.
+        """
+        if retries != self._hw_retries:
+            self._rf24.setRetries(self.retries_delay, retries)
+            self._hw_retries = retries
+
+    def write(self, payload):
+        """
+        Only in `tx_mode`.
+        :return: (success, retransmits or None if the radio can't tell)
+        """
+        success = self._rf24.write(payload)
+        get_arc = getattr(self._rf24, 'getARC', None)
+        return success, get_arc() if get_arc else None
+
+    def to_dict(self):
+        return {
+            'index': self.index,
+            'channel': self.channel,
+            'irq_pin': self.irq_pin,
+            'reading_pipes': self.reading_pipes,
+            'tx_queue': len(self.tx_queue),
+            'dynamic_payloads': self.dynamic_payloads,
+            'ack_payloads': sorted(self.ack_payloads),
+            'survey': self.last_survey.to_dict() if self.last_survey else None,
+        }
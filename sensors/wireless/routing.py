@@ -0,0 +1,162 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-hop routing through proxy nodes.
+
+A device out of range can talk to the hub through other devices.
+Proxied message looks like this:
+    [relay_id][TYPE_PROXY][original message, starting with origin node_id]
+Several relays just nest the messages.
+
+We learn routes from incoming messages: if a status of node X came through
+relays R1, R2 - we can reach X the same way. Every route keeps its delivery
+stats, and messages to X are sent via the route with the lowest estimated loss.
+"""
+from __future__ import unicode_literals
+
+import struct
+from threading import Lock
+from time import time
+
+from ..base import SensorError
+
+# Same as Message.TYPE_PROXY
+TYPE_PROXY = 4
+
+# [TYPE_PROXY][target node_id], prepended on every hop.
+_PROXY_HEADER = struct.Struct(str('<BB'))
+
+
+def unwrap(raw_data):
+    """
+    Strip proxy headers from incoming message.
+    :return: (list of relay ids, the closest to the hub first; original message)
+    """
+    relays = []
+
+    while len(raw_data) > 2 and raw_data[1] == TYPE_PROXY:
+        relays.append(int(raw_data[0]))
+        raw_data = raw_data[2:]
+
+    return relays, raw_data
+
+
+def wrap(payload, node_id, relays, max_size):
+    """
+    Wrap message for node `node_id` to be sent via `relays`.
+    :return: payload to be sent to the first relay.
+    """
+    target = node_id
+
+    for relay in reversed(relays):
+        payload = _PROXY_HEADER.pack(TYPE_PROXY, target) + payload
+        target = relay
+
+    if len(payload) > max_size:
+        raise SensorError(
+            'Message is too long to be sent via %s relays' % len(relays),
+        )
+
+    return payload
+
+
+class Route(object):
+    # Added to the loss estimate for every hop, so shorter routes win
+    # if there's not enough statistics.
+    HOP_PENALTY = 0.05
+    # Weight of the latest value in latency average
+    LATENCY_ALPHA = 0.2
+
+    def __init__(self, relays):
+        self.relays = tuple(relays)
+        self.tx_attempts = 0
+        self.tx_failures = 0
+        self.rx_count = 0
+        self.last_seen = None
+        self.latency = None
+
+    @property
+    def loss(self):
+        # One success and one failure in advance, so new routes
+        # start from 50% and do not jump to 0 or 1 after a single send.
+        return (self.tx_failures + 1.0) / (self.tx_attempts + 2)
+
+    @property
+    def score(self):
+        return self.loss + self.HOP_PENALTY * len(self.relays)
+
+    def add_tx_result(self, success, latency):
+        self.tx_attempts += 1
+        if not success:
+            self.tx_failures += 1
+
+        if self.latency is None:
+            self.latency = latency
+        else:
+            self.latency += self.LATENCY_ALPHA * (latency - self.latency)
+
+    def to_dict(self):
+        return {
+            'relays': list(self.relays),
+            'tx_attempts': self.tx_attempts,
+            'tx_failures': self.tx_failures,
+            'rx_count': self.rx_count,
+            'last_seen': self.last_seen,
+            'loss': round(self.loss, 3),
+            'latency_ms': round(self.latency * 1000, 2) if self.latency is not None else None,
+        }
+
+
+class RouteTable(object):
+    """
+    Known routes to every node.
+    """
+    # Forget routes, not used by the node for so long.
+    ROUTE_TTL = 3600
+
+    def __init__(self):
+        self._routes = {}  # node_id -> {relays: Route}
+        self._lock = Lock()
+
+    def learn(self, node_id, relays):
+        """
+        Message from `node_id` came through `relays`.
+        """
+        relays = tuple(relays)
+
+        with self._lock:
+            routes = self._routes.setdefault(node_id, {})
+            route = routes.get(relays)
+            if not route:
+                route = routes[relays] = Route(relays)
+
+            route.rx_count += 1
+            route.last_seen = time()
+
+    def best(self, node_id):
+        """
+        :return: the route with lowest loss. Direct one if we know nothing.
+        """
+        now = time()
+
+        with self._lock:
+            routes = self._routes.get(node_id)
+            if not routes:
+                route = Route(())
+                self._routes[node_id] = {(): route}
+                return route
+
+            for relays, route in routes.items():
+                if relays and route.last_seen and now - route.last_seen > self.ROUTE_TTL:
+                    del routes[relays]
+
+            if not routes:
+                routes[()] = Route(())
+
+            return min(routes.itervalues(), key=lambda r: (r.score, len(r.relays)))
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                node_id: [r.to_dict() for r in routes.itervalues()]
+                for node_id, routes in self._routes.iteritems()
+            }
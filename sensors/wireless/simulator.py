@@ -0,0 +1,535 @@
+# -*- coding: utf-8 -*-
+"""
+Pure-python simulation of NRF24L01+ radio and wireless devices.
+
+`SimulatedRF24` implements the part of `RF24` API we use, so `WirelessSensor`
+can work without the hardware. `VirtualNode`s are devices on the other side,
+with configurable loss, latency and ACK failures. Everything is scriptable:
+
+    sim = Simulation()
+    radio = sim.radio()
+    lamp = sim.add_node(VirtualNode(node_id=1, pipe_addr=0x01, status=[1]))
+    sensor = WirelessSensor(radio=radio)
+    sim.start()  # Nodes send their statuses in background
+
+Used instead of RF24 and RPi.GPIO when `WIRELESS_SIMULATOR` environment
+variable is set (see `radio`), e.g. by the tools.
+"""
+from __future__ import unicode_literals
+
+import heapq
+import logging
+import random
+from collections import deque
+from itertools import count
+from threading import Lock, Thread
+from time import time, sleep
+
+log = logging.getLogger(__name__)
+
+RF24_PA_MIN = 0
+RF24_PA_LOW = 1
+RF24_PA_HIGH = 2
+RF24_PA_MAX = 3
+
+RF24_1MBPS = 0
+RF24_2MBPS = 1
+RF24_250KBPS = 2
+
+# Same as in Node
+BASE_SEND_ADDR = 0x53654e6400
+BASE_RECV_ADDR = 0x5265437600
+
+
+class FakeGPIO(object):
+    """
+    Subset of RPi.GPIO, edges are triggered with `fire`.
+    """
+    BCM = 11
+    BOARD = 10
+    IN = 1
+    OUT = 0
+    PUD_UP = 22
+    PUD_DOWN = 21
+    FALLING = 32
+    RISING = 31
+
+    def __init__(self):
+        self._callbacks = {}
+
+    def setmode(self, mode):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None):
+        pass
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        self._callbacks[pin] = callback
+
+    def remove_event_detect(self, pin):
+        self._callbacks.pop(pin, None)
+
+    def fire(self, pin):
+        callback = self._callbacks.get(pin)
+        if callback:
+            callback(pin)
+
+
+class Simulation(object):
+    """
+    Shared "air" between the hub radio(s) and virtual nodes.
+    """
+    def __init__(self, seed=None):
+        self.random = random.Random(seed)
+        self.radios = []
+        self.nodes = []
+        # channel -> probability it's busy (e.g. by Wi-Fi) at any moment.
+        # Busy channel loses packets and is seen by the carrier detect.
+        self.noise = {}
+        self.should_stop = False
+        self._thread = None
+        self._lock = Lock()
+        self._seq = count()
+        # (time, seq, node) - when nodes send their next status
+        self._schedule = []
+
+    def radio(self, **kwargs):
+        return SimulatedRF24(simulation=self, **kwargs)
+
+    def add_node(self, node):
+        node.simulation = self
+        self.nodes.append(node)
+        if node.interval:
+            # Nodes are not synchronized, spread them over the interval
+            first_at = time() + self.random.uniform(0, node.interval)
+            with self._lock:
+                heapq.heappush(self._schedule, (first_at, next(self._seq), node))
+        return node
+
+    def is_busy(self, channel, rnd):
+        return rnd.random() < self.noise.get(channel, 0)
+
+    def transmit_to_hub(self, node, payload):
+        """
+        Node sends a packet to the hub, hardware retries included.
+        :return: True if ACK received.
+        """
+        for radio in self.radios:
+            if radio.channel != node.channel:
+                continue
+
+            for _ in xrange(node.retries + 1):
+                if node.random.random() < node.loss or self.is_busy(node.channel, node.random):
+                    node.stats['lost'] += 1
+                    continue
+
+                delivered = radio._receive(
+                    node.send_addr,
+                    payload,
+                    time() + node.random.uniform(*node.latency),
+                )
+                if not delivered:
+                    return False
+
+                if node.random.random() < node.ack_failure:
+                    node.stats['ack_failed'] += 1
+                    continue
+
+                ack_payload = radio._take_ack_payload(node.send_addr)
+                if ack_payload is not None:
+                    node._on_receive(ack_payload)
+                return True
+
+        return False
+
+    def transmit_to_nodes(self, radio, addr, payload):
+        """
+        Hub sends a packet to the `addr`.
+        :return: True if ACK received.
+        """
+        targets = [
+            n for n in self.nodes
+            if n.recv_addr == addr and n.channel == radio.channel
+        ]
+        if not targets:
+            return False
+
+        acked = False
+        radio.arc = radio.retries_count
+        for node in targets:
+            received = False
+            for attempt in xrange(radio.retries_count + 1):
+                if node.random.random() < node.loss or self.is_busy(radio.channel, node.random):
+                    node.stats['lost'] += 1
+                    continue
+
+                received = True
+                if node.random.random() < node.ack_failure:
+                    node.stats['ack_failed'] += 1
+                    continue
+
+                acked = True
+                radio.arc = attempt
+                break
+
+            if received:
+                node._on_receive(bytes(payload))
+
+        return acked
+
+    def tick(self):
+        """
+        Let nodes send everything they're scheduled to send by now.
+        :return: seconds until the next scheduled packet.
+        """
+        now = time()
+        due = []
+
+        with self._lock:
+            while self._schedule and self._schedule[0][0] <= now:
+                _, _, node = heapq.heappop(self._schedule)
+                due.append(node)
+                heapq.heappush(
+                    self._schedule,
+                    (now + node.interval, next(self._seq), node),
+                )
+            next_at = self._schedule[0][0] if self._schedule else now + 1
+
+        for node in due:
+            node.send_status()
+        for node in self.nodes:
+            if node.replies:
+                node.send_replies()
+
+        next_in = next_at - time()
+        for radio in self.radios:
+            arrival_in = radio._deliver_due()
+            if arrival_in is not None:
+                next_in = min(next_in, arrival_in)
+
+        return max(0, next_in)
+
+    def _loop(self):
+        while not self.should_stop:
+            sleep(min(self.tick(), 0.1))
+
+    def start(self):
+        self.should_stop = False
+        self._thread = Thread(target=self._loop)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.should_stop = True
+        if self._thread:
+            self._thread.join()
+
+
+class SimulatedRF24(object):
+    """
+    Hub side radio, same interface as RF24.
+    """
+    def __init__(self, ce_pin=None, csn_pin=None, simulation=None,
+                 rx_fifo_size=3, gpio=None, irq_pin=None):
+        self.simulation = simulation or Simulation()
+        if self not in self.simulation.radios:
+            self.simulation.radios.append(self)
+
+        self.rx_fifo_size = rx_fifo_size
+        self.channel = 76
+        self.retries_delay = 5
+        self.retries_count = 15
+        self.listening = False
+        self.writing_addr = None
+        self.reading_pipes = {}
+        self.irq_masks = (False, False, False)
+        self.gpio = gpio
+        self.irq_pin = irq_pin
+        # Retransmits of the last written packet
+        self.arc = 0
+        self.dynamic_payloads = False
+        self.ack_payloads_enabled = False
+        # Pipe number -> payload, sent with the next ACK on the pipe
+        self.ack_payloads = {}
+
+        self.stats = {
+            'rx': 0,
+            'read': 0,
+            'rx_overflow': 0,
+            'rx_not_listening': 0,
+            'tx': 0,
+            'tx_failed': 0,
+            'ack_payloads': 0,
+        }
+
+        self._fifo = deque()
+        # (deliver_at, seq, payload) - sent, but "still in the air"
+        self._in_flight = []
+        self._seq = count()
+        self._lock = Lock()
+
+    # RF24 API
+
+    def begin(self):
+        return True
+
+    def setRetries(self, delay, count):
+        self.retries_delay = delay
+        self.retries_count = count
+
+    def setPALevel(self, level):
+        pass
+
+    def setDataRate(self, rate):
+        return True
+
+    def setChannel(self, channel):
+        self.channel = channel
+
+    def getChannel(self):
+        return self.channel
+
+    def setAutoAck(self, enable):
+        pass
+
+    def enableDynamicPayloads(self):
+        self.dynamic_payloads = True
+
+    def enableAckPayload(self):
+        self.ack_payloads_enabled = True
+
+    def writeAckPayload(self, pipe, buf):
+        self.ack_payloads[pipe] = bytes(buf)
+
+    def flush_tx(self):
+        self.ack_payloads.clear()
+
+    def flush_rx(self):
+        with self._lock:
+            self._fifo.clear()
+
+    def getDynamicPayloadSize(self):
+        with self._lock:
+            return len(self._fifo[0]) if self._fifo else 0
+
+    def maskIRQ(self, tx_ok, tx_fail, rx_ready):
+        self.irq_masks = (tx_ok, tx_fail, rx_ready)
+
+    def printDetails(self):
+        log.info(
+            'Simulated radio: channel=%s, retries=%s/%s, pipes=%s',
+            self.channel,
+            self.retries_delay,
+            self.retries_count,
+            self.reading_pipes,
+        )
+
+    def openReadingPipe(self, number, addr):
+        self.reading_pipes[number] = addr
+
+    def closeReadingPipe(self, number):
+        self.reading_pipes.pop(number, None)
+
+    def openWritingPipe(self, addr):
+        self.writing_addr = addr
+
+    def startListening(self):
+        self.listening = True
+
+    def stopListening(self):
+        self.listening = False
+        if self.ack_payloads_enabled:
+            # Same as RF24 does
+            self.flush_tx()
+
+    def testRPD(self):
+        return self.simulation.is_busy(self.channel, self.simulation.random)
+
+    testCarrier = testRPD
+
+    def getARC(self):
+        return self.arc
+
+    def write(self, payload):
+        self.stats['tx'] += 1
+        ok = self.simulation.transmit_to_nodes(self, self.writing_addr, payload)
+        if not ok:
+            self.stats['tx_failed'] += 1
+        return ok
+
+    def available(self):
+        self._deliver_due()
+        return bool(self._fifo)
+
+    def read(self, size):
+        with self._lock:
+            payload = self._fifo.popleft()
+            self.stats['read'] += 1
+        return bytearray(payload[:size])
+
+    # Simulation side
+
+    def inject(self, payload):
+        """
+        Put the packet to RX FIFO, no matter if it's full or what we're doing.
+        """
+        with self._lock:
+            self._fifo.append(bytes(payload))
+            self.stats['rx'] += 1
+
+    def _receive(self, addr, payload, deliver_at):
+        """
+        :return: True if the packet was accepted, i.e. would be ACKed.
+        """
+        if addr not in self.reading_pipes.itervalues():
+            return False
+
+        if not self.listening:
+            self.stats['rx_not_listening'] += 1
+            return False
+
+        with self._lock:
+            if len(self._fifo) + len(self._in_flight) >= self.rx_fifo_size:
+                self.stats['rx_overflow'] += 1
+                return False
+
+            heapq.heappush(self._in_flight, (deliver_at, next(self._seq), payload))
+            self.stats['rx'] += 1
+
+        self._deliver_due()
+        return True
+
+    def _take_ack_payload(self, addr):
+        for pipe, pipe_addr in self.reading_pipes.iteritems():
+            if pipe_addr == addr and pipe in self.ack_payloads:
+                self.stats['ack_payloads'] += 1
+                return self.ack_payloads.pop(pipe)
+
+    def _deliver_due(self):
+        """
+        Move packets which have "arrived" by now to RX FIFO, and trigger IRQ.
+        :return: seconds until the next arrival, None if nothing's in flight.
+        """
+        now = time()
+        delivered = False
+
+        with self._lock:
+            while self._in_flight and self._in_flight[0][0] <= now:
+                _, _, payload = heapq.heappop(self._in_flight)
+                self._fifo.append(payload)
+                delivered = True
+
+            next_in = self._in_flight[0][0] - now if self._in_flight else None
+
+        if delivered and self.gpio and self.irq_pin is not None and not self.irq_masks[2]:
+            self.gpio.fire(self.irq_pin)
+
+        return next_in
+
+
+class VirtualNode(object):
+    """
+    Device on the other side of the air.
+
+    :param status: status payload (list of bytes) or a callable returning it.
+    :param interval: send status every N seconds, None - never.
+    :param loss: probability of losing a single packet.
+    :param latency: (min, max) delivery delay, seconds.
+    :param ack_failure: probability of losing an ACK.
+    """
+    TYPE_STATUS = 0
+    TYPE_HELLO = 5
+    HELLO_ADDRESSED = 0x01
+    TYPE_CHANNEL = 6
+    TYPE_CHANNEL_SWITCH = 7
+
+    def __init__(self, node_id, pipe_addr, status=None, interval=1,
+                 loss=0.0, latency=(0, 0), ack_failure=0.0, node_type=None,
+                 channel=0x30, retries=15, seed=None, addressed=False,
+                 channel_switch=True):
+        """
+        :param addressed: messages from the hub start with node id, the
+            device says so in its hello.
+        :param channel_switch: the firmware supports TYPE_CHANNEL.
+        """
+        self.node_id = node_id
+        self.addressed = addressed
+        self.node_type = node_type
+        self.send_addr = BASE_RECV_ADDR | pipe_addr
+        self.recv_addr = BASE_SEND_ADDR | pipe_addr
+        self.status = status or []
+        self.interval = interval
+        self.loss = loss
+        self.latency = latency
+        self.ack_failure = ack_failure
+        self.channel = channel
+        self.retries = retries
+        self.channel_switch = channel_switch
+        self.random = random.Random(seed)
+        # Channel of the last TYPE_CHANNEL, until TYPE_CHANNEL_SWITCH
+        self.next_channel = None
+        # Answers to the hub, sent on the next tick: the hub is not
+        # listening while it's sending to us.
+        self.replies = deque()
+        self.simulation = None
+
+        # The latest messages from the hub
+        self.received = deque(maxlen=100)
+        self.stats = {
+            'sent': 0,
+            'acked': 0,
+            'lost': 0,
+            'ack_failed': 0,
+            'received': 0,
+        }
+
+    def send(self, payload):
+        self.stats['sent'] += 1
+        ok = self.simulation.transmit_to_hub(self, bytearray(payload))
+        if ok:
+            self.stats['acked'] += 1
+        return ok
+
+    def send_status(self):
+        status = self.status() if callable(self.status) else self.status
+        return self.send([self.node_id, self.TYPE_STATUS] + list(status))
+
+    def send_hello(self):
+        flags = self.HELLO_ADDRESSED if self.addressed else 0
+        return self.send([self.node_id, self.TYPE_HELLO, self.node_type, flags])
+
+    def send_replies(self):
+        while self.replies:
+            if not self.send(self.replies[0]):
+                # Next time
+                return
+            self.replies.popleft()
+
+    def _on_receive(self, payload):
+        if self.addressed:
+            if bytearray(payload[:1]) != bytearray([self.node_id]):
+                # For another device on the same pipe
+                return
+            payload = payload[1:]
+
+        self.stats['received'] += 1
+        self.received.append(payload)
+
+        data = bytearray(payload)
+        if self.channel_switch and len(data) == 2 and data[0] == self.TYPE_CHANNEL:
+            self.next_channel = data[1]
+            self.replies.append([self.node_id, self.TYPE_CHANNEL, data[1]])
+            return
+
+        if self.channel_switch and len(data) == 1 and data[0] == self.TYPE_CHANNEL_SWITCH:
+            if self.next_channel is not None:
+                # Switches after the ACK is sent
+                self.channel, self.next_channel = self.next_channel, None
+            return
+
+        self.on_message(payload)
+
+    def on_message(self, payload):
+        """
+        Override to react on messages from the hub.
+        """
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+"""
+2.4GHz channel survey.
+
+The radio listens on every channel for a moment and checks the carrier
+detect (RPD, received power > -64dBm). Repeated many times, it gives how
+often every channel is busy, e.g. by Wi-Fi. The radio is deaf to its own
+devices meanwhile, so the survey is done in small slices, when nothing
+else is going on.
+"""
+from __future__ import unicode_literals
+
+from time import time
+
+
+class ChannelSurvey(object):
+    def __init__(self, channels, sweeps):
+        """
+        :param sweeps: how many times every channel is checked.
+        """
+        self.channels = list(channels)
+        self.sweeps = sweeps
+        # channel -> times it was busy
+        self.histogram = dict.fromkeys(self.channels, 0)
+        self.started_at = time()
+        self._position = 0
+
+    @property
+    def complete(self):
+        return self._position >= len(self.channels)
+
+    def step(self, radio, count):
+        """
+        Survey next `count` channels with `radio.Radio`.
+        """
+        channels = self.channels[self._position:self._position + count]
+        for channel, busy in radio.measure_channels(channels, self.sweeps).iteritems():
+            self.histogram[channel] += busy
+        self._position += len(channels)
+
+    def occupancy(self, channel):
+        """
+        Share of checks the channel was busy.
+        """
+        return float(self.histogram[channel]) / self.sweeps
+
+    def quietest(self, exclude=()):
+        """
+        The least busy channel, the lowest one if several are equal.
+        None if every channel is excluded.
+        """
+        candidates = [c for c in self.channels if c not in exclude]
+        if not candidates:
+            return
+        return min(candidates, key=lambda c: (self.histogram[c], c))
+
+    def to_dict(self):
+        return {
+            'started_at': self.started_at,
+            'sweeps': self.sweeps,
+            'histogram': self.histogram,
+        }
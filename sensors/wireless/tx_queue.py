@@ -0,0 +1,375 @@
+# -*- coding: utf-8 -*-
+"""
+Transmit queue of the wireless sensor.
+
+Messages to nodes are not sent right away, they are queued and sent by the
+thread which owns the radio, between reads. So a node which doesn't respond
+only delays its own messages, and never blocks reception.
+
+* Lower `priority` value is sent first.
+* Failed sends are retried with exponential backoff, other messages
+  are sent meanwhile.
+* A new message with the same `coalesce_key` for the same node replaces
+  the pending one (e.g. on/off toggled several times - only the last
+  one is sent).
+* Every message has a `TxFuture`, resolved when it's sent or finally failed.
+* Messages queued inside `with queue.window():` are sent back-to-back,
+  in one go of the radio thread (see `WirelessSensor._send_queued`).
+"""
+from __future__ import unicode_literals
+
+import heapq
+import logging
+from contextlib import contextmanager
+from itertools import count
+from threading import Lock, Event, local
+from time import time
+
+from ..base import SensorError
+
+log = logging.getLogger(__name__)
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 10
+PRIORITY_LOW = 20
+
+
+class TxFuture(object):
+    """
+    Result of a queued message. Resolves to True when the message is sent,
+    or to SensorError if it failed.
+    """
+    def __init__(self):
+        self._event = Event()
+        self._result = None
+        self._exception = None
+        self._callbacks = []
+        self._lock = Lock()
+
+    def done(self):
+        return self._event.is_set()
+
+    def result(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise SensorError('Timeout waiting for result')
+
+        if self._exception is not None:
+            raise self._exception
+        return self._result
+
+    def exception(self, timeout=None):
+        if not self._event.wait(timeout):
+            raise SensorError('Timeout waiting for result')
+        return self._exception
+
+    def add_done_callback(self, fn):
+        with self._lock:
+            if not self._event.is_set():
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _resolve(self, result=None, exception=None):
+        with self._lock:
+            if self._event.is_set():
+                return
+            self._result = result
+            self._exception = exception
+            self._event.set()
+            callbacks, self._callbacks = self._callbacks, []
+
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as ex:
+                log.error('Error in future callback:', exc_info=ex)
+
+    def set_result(self, result):
+        self._resolve(result=result)
+
+    def set_exception(self, exception):
+        self._resolve(exception=exception)
+
+
+def gather(futures):
+    """
+    :return: TxFuture, resolved with a list of results (or exceptions) of
+        `futures` when all of them are done.
+    """
+    result = TxFuture()
+    futures = list(futures)
+    remaining = [len(futures)]
+    lock = Lock()
+
+    if not futures:
+        result.set_result([])
+        return result
+
+    def on_done(_):
+        with lock:
+            remaining[0] -= 1
+            if remaining[0]:
+                return
+
+        result.set_result([
+            f.exception() if f.exception() is not None else f.result()
+            for f in futures
+        ])
+
+    for future in futures:
+        future.add_done_callback(on_done)
+
+    return result
+
+
+class TxWindow(object):
+    """
+    Messages to be sent together.
+    """
+    def __init__(self):
+        self.requests = []
+
+    @property
+    def futures(self):
+        return [r.future for r in self.requests]
+
+
+class TxRequest(object):
+    def __init__(self, node, msg, priority, coalesce_key, seq):
+        self.node = node
+        self.msg = msg
+        # Formatted right away, so broken messages fail in the caller's thread.
+        # The node id is added when it's sent, see `Node.addressed`.
+        self.payload = msg.format()
+        self.priority = priority
+        self.coalesce_key = coalesce_key
+        self.seq = seq
+        self.attempts = 0
+        self.not_before = 0
+        self.cancelled = False
+        self.window = None
+        # Superseded requests are resolved together with this one.
+        self.futures = [TxFuture()]
+
+    @property
+    def future(self):
+        return self.futures[-1]
+
+    def resolve(self, result=None, exception=None):
+        for future in self.futures:
+            future._resolve(result, exception)
+
+    def __repr__(self):
+        return '<TxRequest %s to %s, attempt %s>' % (
+            self.msg,
+            self.node.name,
+            self.attempts,
+        )
+
+
+class TxQueue(object):
+    def __init__(self, on_put=None):
+        """
+        :param on_put: called after a message is queued, to wake the radio thread.
+        """
+        self._lock = Lock()
+        self._seq = count()
+        # (priority, seq, request) - can be sent now.
+        self._ready = []
+        # (not_before, seq, request) - waiting for retry.
+        self._delayed = []
+        # (node_id, coalesce_key) -> pending request
+        self._pending = {}
+        self._on_put = on_put
+        # Current window of the thread, see `window`
+        self._local = local()
+
+    def __len__(self):
+        with self._lock:
+            return sum(
+                1 for _, _, r in self._ready + self._delayed if not r.cancelled
+            )
+
+    def put(self, node, msg, priority=PRIORITY_NORMAL, coalesce_key=None):
+        """
+        :return: TxFuture
+        """
+        window = getattr(self._local, 'window', None)
+
+        with self._lock:
+            request = TxRequest(node, msg, priority, coalesce_key, next(self._seq))
+
+            if coalesce_key is not None:
+                key = (node.NODE_ID, coalesce_key)
+                old = self._pending.get(key)
+                if old:
+                    log.debug('%r is superseded', old)
+                    old.cancelled = True
+                    request.futures = old.futures + request.futures
+                    request.priority = min(request.priority, old.priority)
+                self._pending[key] = request
+
+            if window is not None:
+                # Queued when the window is closed
+                request.window = window
+                window.requests.append(request)
+                return request.future
+
+            heapq.heappush(self._ready, (request.priority, request.seq, request))
+
+        if self._on_put:
+            self._on_put()
+
+        return request.future
+
+    @contextmanager
+    def window(self):
+        """
+        Everything put by this thread inside the block is queued at once,
+        and is sent back-to-back.
+        """
+        window = self._local.window = TxWindow()
+
+        try:
+            yield window
+        finally:
+            self._local.window = None
+
+            with self._lock:
+                # The highest priority of them all, so they go together
+                priority = min([r.priority for r in window.requests] or [0])
+                for request in window.requests:
+                    request.priority = priority
+                    heapq.heappush(self._ready, (priority, request.seq, request))
+
+            if window.requests and self._on_put:
+                self._on_put()
+
+    def pop_window(self, window):
+        """
+        Take all the messages of the `window`, which are ready to be sent.
+        """
+        with self._lock:
+            requests = [
+                r for _, _, r in self._ready
+                if r.window is window and not r.cancelled
+            ]
+            if not requests:
+                return []
+
+            self._ready = [e for e in self._ready if e[2].window is not window]
+            heapq.heapify(self._ready)
+
+            for request in requests:
+                if request.coalesce_key is not None:
+                    del self._pending[(request.node.NODE_ID, request.coalesce_key)]
+
+        return requests
+
+    def next_due_in(self):
+        """
+        Seconds until the next message can be sent, None if queue is empty.
+        """
+        with self._lock:
+            if self._ready:
+                return 0
+            if self._delayed:
+                return max(0, self._delayed[0][0] - time())
+
+    def pop(self):
+        """
+        Get a message which can be sent now, or None.
+        """
+        now = time()
+
+        with self._lock:
+            while self._delayed and self._delayed[0][0] <= now:
+                _, _, request = heapq.heappop(self._delayed)
+                heapq.heappush(self._ready, (request.priority, request.seq, request))
+
+            while self._ready:
+                _, _, request = heapq.heappop(self._ready)
+                if request.cancelled:
+                    continue
+
+                if request.coalesce_key is not None:
+                    del self._pending[(request.node.NODE_ID, request.coalesce_key)]
+                return request
+
+    def retry_later(self, request, delay):
+        """
+        Put a failed request back, unless it has been superseded meanwhile.
+        """
+        with self._lock:
+            if request.coalesce_key is not None:
+                key = (request.node.NODE_ID, request.coalesce_key)
+                newer = self._pending.get(key)
+                if newer:
+                    # Newer one will be sent anyway
+                    newer.futures = request.futures + newer.futures
+                    return
+                self._pending[key] = request
+
+            request.not_before = time() + delay
+            heapq.heappush(self._delayed, (request.not_before, request.seq, request))
+
+    def move_node(self, node, queue):
+        """
+        Hand pending messages of the node over to another queue, when the
+        node is heard by another radio. Attempts and retry delays are kept.
+        """
+        with self._lock:
+            requests = [
+                r for _, _, r in self._ready + self._delayed
+                if r.node is node and not r.cancelled
+            ]
+            if not requests:
+                return
+
+            self._ready = [e for e in self._ready if e[2].node is not node]
+            self._delayed = [e for e in self._delayed if e[2].node is not node]
+            heapq.heapify(self._ready)
+            heapq.heapify(self._delayed)
+
+            for request in requests:
+                if request.coalesce_key is not None:
+                    del self._pending[(node.NODE_ID, request.coalesce_key)]
+
+        log.debug('Moving %s messages of %s', len(requests), node.name)
+        queue._take_over(sorted(requests, key=lambda r: r.seq))
+
+    def _take_over(self, requests):
+        now = time()
+
+        with self._lock:
+            for request in requests:
+                if request.coalesce_key is not None:
+                    key = (request.node.NODE_ID, request.coalesce_key)
+                    newer = self._pending.get(key)
+                    if newer:
+                        # Queued here after the node has moved
+                        newer.futures = request.futures + newer.futures
+                        continue
+                    self._pending[key] = request
+
+                request.seq = next(self._seq)
+                if request.not_before > now:
+                    heapq.heappush(self._delayed, (request.not_before, request.seq, request))
+                else:
+                    heapq.heappush(self._ready, (request.priority, request.seq, request))
+
+        if self._on_put:
+            self._on_put()
+
+    def clear(self, exception):
+        """
+        Drop everything, failing all the futures with `exception`.
+        """
+        with self._lock:
+            requests = [r for _, _, r in self._ready + self._delayed if not r.cancelled]
+            self._ready = []
+            self._delayed = []
+            self._pending = {}
+
+        for request in requests:
+            request.resolve(exception=exception)
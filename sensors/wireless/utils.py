@@ -7,3 +7,17 @@ def to_bool(value):
         return value.lower() in ['1', 'y', 'yes', 'true']
 
     return bool(value)
+
+
+class ByteValues(object):
+    """
+    Log argument, rendered as a list of byte values only if the record is
+    written, not dropped by level or rate limit.
+    """
+    __slots__ = ('data',)
+
+    def __init__(self, data):
+        self.data = data
+
+    def __str__(self):
+        return str(map(int, bytearray(self.data)))
@@ -10,13 +10,22 @@ import json
 
 from app import app
 from flask import request
-from .base import wireless_sensor
+from ..base import SensorError
+from . import wireless_sensor
+from .utils import to_bool
 
 logger = logging.getLogger(__name__)
 
+# Max seconds a state request can wait for changes
+MAX_WAIT = 60
+
 
 @app.route('/sensors/wireless/<name>/state', methods=['GET', 'POST'])
 def read_wireless_sensors(name):
+    """
+    GET `?since=<version>&wait=<seconds>` blocks until the state is newer
+    than `version`, or the time is out.
+    """
     node = wireless_sensor.get_node(name=name)
     if not node:
         return json.dumps({
@@ -25,21 +34,124 @@ def read_wireless_sensors(name):
         })
 
     if request.method == 'GET':
+        since = request.args.get('since', type=int)
+        wait = request.args.get('wait', 0, type=float)
+
+        if since is not None and wait > 0:
+            node.wait_for_state(since, min(wait, MAX_WAIT))
 
+        # Version first: the state is replaced before the version grows,
+        # so the client never gets an old state with a new version.
+        version = node.state_version
+        state = node.state
         return json.dumps({
             'status': 'ok',
-            'is_online': node.state is not None,
-            'state': node.state.data if node.state else None,
+            'version': version,
+            'is_online': state.is_online,
+            'state': state.data,
         })
 
     else:
-        if node.state is None:
+        if not node.state.is_online:
             return json.dumps({
                 'status': 'error',
                 'error_code': 'offline',
             })
 
-        node.state.update(request.form)
+        node.update_state(request.form)
+
+        return json.dumps({
+            'status': 'ok',
+            'version': node.state_version,
+        })
+
+
+@app.route('/sensors/wireless/scene', methods=['POST'])
+def apply_wireless_scene():
+    """
+    Change many nodes at once. JSON body:
+        {"changes": [{"name": "lamp", "state": {"power_on": 0}}, ...]}
+    Waits until all the messages are sent, up to `MAX_WAIT` seconds.
+    """
+    data = request.get_json(force=True, silent=True) or {}
+    changes = data.get('changes')
+    if not isinstance(changes, list):
+        return json.dumps({
+            'status': 'error',
+            'error_code': 'bad_format',
+        })
+
+    future = wireless_sensor.apply_scene(changes)
+
+    try:
+        results = future.result(MAX_WAIT)
+    except SensorError:
+        return json.dumps({
+            'status': 'error',
+            'error_code': 'timeout',
+        })
+
+    return json.dumps({
+        'status': 'ok',
+        'results': results,
+    })
+
+
+@app.route('/sensors/wireless/links')
+def read_wireless_links():
+    return json.dumps({
+        'status': 'ok',
+        'data': wireless_sensor.get_link_stats(),
+    })
+
+
+@app.route('/sensors/wireless/<name>/link')
+def read_wireless_link(name):
+    node = wireless_sensor.get_node(name=name)
+    if not node:
+        return json.dumps({
+            'status': 'error',
+            'error_code': 'node_not_found',
+        })
+
+    return json.dumps({
+        'status': 'ok',
+        'data': node.link.to_dict(),
+    })
+
+
+@app.route('/sensors/wireless/radios')
+def read_wireless_radios():
+    return json.dumps({
+        'status': 'ok',
+        'data': wireless_sensor.get_radios_info(),
+    })
+
+
+@app.route('/sensors/wireless/routes')
+def read_wireless_routes():
+    return json.dumps({
+        'status': 'ok',
+        'data': wireless_sensor.routes.to_dict(),
+    })
+
+
+@app.route('/sensors/wireless/capture', methods=['GET', 'POST'])
+def wireless_capture():
+    """
+    POST `enabled=1` to start capturing radio packets, `enabled=0` - to stop.
+    """
+    if request.method == 'POST':
+        if to_bool(request.form.get('enabled')):
+            wireless_sensor.start_capture(wireless_sensor.CAPTURE_PATH)
+        else:
+            wireless_sensor.stop_capture()
 
-        return json.dumps({'status': 'ok'})
+    capture = wireless_sensor.capture
 
+    return json.dumps({
+        'status': 'ok',
+        'enabled': capture is not None,
+        'path': capture.path if capture else None,
+        'packets': capture.packets if capture else None,
+    })
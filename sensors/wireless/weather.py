@@ -7,6 +7,7 @@ from __future__ import unicode_literals
 import logging
 
 from .base import Node, Message, State
+from .codec import Field
 from .utils import to_bool
 
 
@@ -14,12 +15,10 @@ logger = logging.getLogger(__name__)
 
 
 class WeatherState(State):
-    @classmethod
-    def _parse_raw_data(cls, raw_data):
-        return {
-            'humidity': int(raw_data[1]),
-            'temperature': int(raw_data[0] - 100),
-        }
+    FIELDS = [
+        Field('temperature', offset=-100),
+        Field('humidity'),
+    ]
 
 
 class WeatherMessage(Message):
@@ -27,16 +26,18 @@ class WeatherMessage(Message):
 
 
 class WeatherNode(Node):
-    # We only allow one device of each type for now
     NODE_ID = 2
+    NODE_TYPE = 2
     MESSAGE_CLASS = WeatherMessage
     STATE_CLASS = WeatherState
     NAME = 'weather'
 
-    # Weather sensor never reads data from this pipe,
+    # Weather sensor sleeps and never reads data from this pipe,
     # but you can send something here, especially
     # if you are too lonely and have nobody else to talk to.
     SEND_PIPE_ADDR = 0x02
+    # It reads ACKs though, messages go there if the radio allows.
+    ACK_PAYLOADS = True
 
     LISTEN_PIPE_NUMBER = 2
     LISTEN_PIPE_ADDR = 0x02
@@ -4,9 +4,11 @@ from logging.config import dictConfig
 import atexit
 import signal
 import os
+import json
 
 from app import app
 
+import async_logging
 from sensors.base import Sensor
 
 dictConfig({
@@ -17,14 +19,28 @@ dictConfig({
             'format': '%(asctime)s [%(levelname)s] %(name)s: %(message)s'
         },
     },
+    'filters': {
+        # Per-message (DEBUG) logs of radio, socket server and the rest
+        'per_message': {
+            '()': 'async_logging.RateLimitFilter',
+            'rate': 20,
+            'burst': 100,
+            'sample_every': 50,
+            'max_level': 'DEBUG',
+        },
+    },
     'handlers': {
         'default': {
             'level': 'DEBUG',
-            'class': 'logging.handlers.TimedRotatingFileHandler',
+            # Writes in a background thread, SD card can be slow.
+            '()': 'async_logging.async_file_handler',
+            'maxsize': 10000,
             'when': 'midnight',
             'backupCount': 7,
             'filename': '/var/log/sensors.log',
             'formatter': 'standard',
+            # On the handler, logger filters do not apply to child loggers
+            'filters': ['per_message'],
         },
     },
     'loggers': {
@@ -49,6 +65,14 @@ dictConfig({
 log = logging.getLogger()
 
 
+@app.route('/logging/stats')
+def logging_stats():
+    return json.dumps({
+        'status': 'ok',
+        'data': async_logging.get_stats(),
+    })
+
+
 @atexit.register
 def on_exit():
     log.info('Exitting...')
@@ -66,4 +90,6 @@ signal.signal(signal.SIGINT, signal_hendler)
 app.run(
     host='0.0.0.0',
     port=10100,
+    # State requests wait for changes up to a minute each
+    threaded=True,
 )
@@ -0,0 +1,12 @@
+# -*- coding: utf-8 -*-
+"""
+    python -m unittest discover -s tests -t .
+
+Sensor modules are imported without `sensors/__init__.py`, which starts
+every sensor (see tools/sensor_modules.py), and the radio is simulated.
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'tools'))
+os.environ['WIRELESS_SIMULATOR'] = '1'
@@ -0,0 +1,85 @@
+# -*- coding: utf-8 -*-
+"""
+Messages going with ACKs of the device's own packets (`Node.ACK_PAYLOADS`).
+"""
+import unittest
+
+from sensor_modules import import_sensor_module
+
+base = import_sensor_module('sensors.wireless.base')
+simulator = import_sensor_module('sensors.wireless.simulator')
+
+STATUS = bytearray([2, 0, 120, 50])
+MESSAGE_TYPE = 100
+
+
+class Sensor(base.WirelessSensor):
+    DYNAMIC_PAYLOADS = True
+
+
+class ReceivingWhileLoading(simulator.SimulatedRF24):
+    """
+    The device's packet arrives right when the payload is being loaded.
+    """
+    def writeAckPayload(self, pipe, buf):
+        super(ReceivingWhileLoading, self).writeAckPayload(pipe, buf)
+        self.inject(STATUS)
+
+
+class AckPayloadTest(unittest.TestCase):
+    def setUp(self, rf24_cls=simulator.SimulatedRF24):
+        self.sim = simulator.Simulation(seed=1)
+        self.rf24 = rf24_cls(simulation=self.sim)
+        self.sensor = Sensor(radio=self.rf24)
+        self.radio = self.sensor.radios[0]
+        self.node = self.sensor.get_node(node_id=2)
+        self.device = self.sim.add_node(simulator.VirtualNode(
+            node_id=2, pipe_addr=0x02, interval=0, status=list(STATUS[2:]),
+        ))
+
+    def send(self):
+        future = self.node.send_data(base.Message(2, MESSAGE_TYPE))
+        self.sensor._send_queued(self.radio)
+        return future
+
+    def device_sends(self):
+        self.assertTrue(self.device.send_status())
+        self.sensor._process_hw_messages(self.radio)
+
+    def test_picked_up(self):
+        future = self.send()
+        self.assertFalse(future.done())
+        self.assertIn(self.node.LISTEN_PIPE_NUMBER, self.radio.ack_payloads)
+
+        self.device_sends()
+        self.assertTrue(future.result(0))
+        self.assertEqual(list(self.device.received), [chr(MESSAGE_TYPE)])
+
+    def test_received_before_loading(self):
+        """
+        A packet already in RX FIFO was ACKed without the payload.
+        """
+        self.rf24.inject(STATUS)
+        future = self.send()
+        self.sensor._process_hw_messages(self.radio)
+        self.assertFalse(future.done())
+        self.assertIn(self.node.LISTEN_PIPE_NUMBER, self.radio.ack_payloads)
+
+        self.device_sends()
+        self.assertTrue(future.result(0))
+        self.assertEqual(list(self.device.received), [chr(MESSAGE_TYPE)])
+
+
+    def test_received_while_loading(self):
+        self.setUp(rf24_cls=ReceivingWhileLoading)
+        future = self.send()
+        # Can't tell if it took the payload, the next one tells
+        self.sensor._process_hw_messages(self.radio)
+        self.assertFalse(future.done())
+
+        self.device_sends()
+        self.assertTrue(future.result(0))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+"""
+Devices of the same type on one pipe: node id in the beginning of messages.
+"""
+import unittest
+
+from sensor_modules import import_sensor_module
+
+base = import_sensor_module('sensors.wireless.base')
+PowerControlMessage = import_sensor_module('sensors.wireless.power_control').PowerControlMessage
+simulator = import_sensor_module('sensors.wireless.simulator')
+
+TYPE_ON = PowerControlMessage.TYPE_ON
+
+
+class AddressingTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = simulator.Simulation(seed=1)
+        self.sensor = base.WirelessSensor(radio=self.sim.radio())
+        self.radio = self.sensor.radios[0]
+
+    def add_device(self, node_id, **kwargs):
+        return self.sim.add_node(simulator.VirtualNode(
+            node_id=node_id,
+            node_type=1,
+            pipe_addr=0x01,
+            interval=0,
+            **kwargs
+        ))
+
+    def received(self, device):
+        return [bytearray(payload) for payload in device.received]
+
+    def hello(self, device):
+        self.assertTrue(device.send_hello())
+        self.sensor._process_hw_messages(self.radio)
+
+    def turn_on(self, node_id):
+        future = self.sensor.get_node(node_id=node_id).send_data(
+            PowerControlMessage(node_id, TYPE_ON),
+        )
+        self.sensor._send_queued(self.radio)
+        self.assertTrue(future.result(1))
+
+    def test_legacy_device(self):
+        legacy = self.add_device(1)
+        other = self.add_device(7, addressed=True)
+        self.hello(other)
+
+        self.assertFalse(self.sensor.get_node(node_id=1).addressed)
+        self.assertTrue(self.sensor.get_node(node_id=7).addressed)
+
+        self.turn_on(1)
+        self.turn_on(7)
+        self.assertEqual(self.received(legacy), [bytearray([TYPE_ON]), bytearray([7, TYPE_ON])])
+        self.assertEqual(self.received(other), [bytearray([TYPE_ON])])
+
+    def test_queued_before_hello(self):
+        device = self.add_device(1, addressed=True)
+        lamp = self.sensor.get_node(node_id=1)
+        future = lamp.send_data(PowerControlMessage(1, TYPE_ON))
+
+        self.hello(device)
+        self.assertTrue(lamp.addressed)
+
+        self.sensor._send_queued(self.radio)
+        self.assertTrue(future.result(1))
+        self.assertEqual(self.received(device), [bytearray([TYPE_ON])])
+
+    def test_hello_flags(self):
+        old = base.Message.parse(bytearray([7, base.Message.TYPE_HELLO, 1]))
+        self.assertEqual((old.data, old.flags), (1, 0))
+
+        new = base.Message.parse(bytearray([7, base.Message.TYPE_HELLO, 1, 1]))
+        self.assertEqual((new.data, new.flags), (1, base.Message.HELLO_ADDRESSED))
+
+
+if __name__ == '__main__':
+    unittest.main()
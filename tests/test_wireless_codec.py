@@ -0,0 +1,155 @@
+# -*- coding: utf-8 -*-
+"""
+Declarative layouts (`codec`) against the byte layouts of the hand-written
+parse/format they replaced. The old code is kept here as the reference.
+"""
+import unittest
+
+from sensor_modules import import_sensor_module
+
+base = import_sensor_module('sensors.wireless.base')
+codec = import_sensor_module('sensors.wireless.codec')
+power_control = import_sensor_module('sensors.wireless.power_control')
+weather = import_sensor_module('sensors.wireless.weather')
+
+Message = base.Message
+
+
+def old_lamp_state(raw_data):
+    return {
+        'power_on': raw_data[0],
+    }
+
+
+def old_weather_state(raw_data):
+    return {
+        'humidity': int(raw_data[1]),
+        'temperature': int(raw_data[0] - 100),
+    }
+
+
+def old_parse(field_names, raw_data):
+    """
+    :return: (node_id, msg_type, field_name, data)
+    """
+    node_id, msg_type, data = raw_data[0], raw_data[1], raw_data[2:]
+
+    if msg_type == Message.TYPE_STATUS:
+        return node_id, msg_type, None, data
+
+    if msg_type == Message.TYPE_FIELD_RESPONSE:
+        return node_id, msg_type, field_names[data[0]], data[1:]
+
+    raise base.SensorError('Unexpected message type: ' + str(msg_type))
+
+
+def old_format(field_ids, msg_type, field_name=None, data=None):
+    # The old `field_id` could not look anything up, it's what it meant.
+    raw = chr(msg_type)
+
+    if msg_type == Message.TYPE_FIELD_REQUEST:
+        raw += chr(field_ids[field_name])
+
+    elif msg_type == Message.TYPE_FIELD_SET:
+        raw += chr(field_ids[field_name]) + data
+
+    return raw
+
+
+class MeterMessage(Message):
+    FIELDS = [
+        codec.Field('mode', field_id=1),
+        codec.Field('limit', field_id=2),
+    ]
+
+
+class StateTest(unittest.TestCase):
+    def parse(self, node_cls, raw_data):
+        msg = node_cls.MESSAGE_CLASS.parse(raw_data)
+        self.assertEqual(msg.msg_type, Message.TYPE_STATUS)
+        return node_cls.STATE_CLASS._parse_raw_data(msg.data)
+
+    def test_lamp(self):
+        for value in xrange(256):
+            raw = bytearray([1, Message.TYPE_STATUS, value])
+            self.assertEqual(
+                self.parse(power_control.PowerControlNode, raw),
+                old_lamp_state(raw[2:]),
+            )
+
+    def test_weather(self):
+        for temperature in xrange(0, 256, 7):
+            for humidity in (0, 1, 50, 99, 100, 255):
+                raw = bytearray([2, Message.TYPE_STATUS, temperature, humidity])
+                self.assertEqual(
+                    self.parse(weather.WeatherNode, raw),
+                    old_weather_state(raw[2:]),
+                )
+
+    def test_encode(self):
+        layout = weather.WeatherState._layout
+        data = {'temperature': -20, 'humidity': 80}
+        self.assertEqual(bytearray(layout.encode(data)), bytearray([80, 80]))
+        self.assertEqual(layout.decode(layout.encode(data)), data)
+
+    def test_short(self):
+        with self.assertRaises(base.SensorError):
+            weather.WeatherState._parse_raw_data(bytearray([120]))
+
+
+class MessageTest(unittest.TestCase):
+    def test_on_off(self):
+        for msg_type in (power_control.PowerControlMessage.TYPE_ON,
+                         power_control.PowerControlMessage.TYPE_OFF):
+            self.assertEqual(
+                bytearray(power_control.PowerControlMessage(1, msg_type).format()),
+                bytearray(old_format({}, msg_type)),
+            )
+
+    def test_field_request(self):
+        for name in ('mode', 'limit'):
+            msg = MeterMessage(3, Message.TYPE_FIELD_REQUEST, field_name=name)
+            self.assertEqual(
+                bytearray(msg.format()),
+                bytearray(old_format(MeterMessage._field_ids, Message.TYPE_FIELD_REQUEST, name)),
+            )
+
+    def test_field_set(self):
+        for value in (0, 1, 127, 255):
+            msg = MeterMessage(3, Message.TYPE_FIELD_SET, data=value, field_name='limit')
+            self.assertEqual(
+                bytearray(msg.format()),
+                bytearray(old_format(
+                    MeterMessage._field_ids, Message.TYPE_FIELD_SET, 'limit', chr(value),
+                )),
+            )
+
+    def test_field_response(self):
+        raw = bytearray([3, Message.TYPE_FIELD_RESPONSE, 2, 42])
+        msg = MeterMessage.parse(raw)
+        node_id, msg_type, field_name, data = old_parse(MeterMessage.FIELD_NAMES, raw)
+
+        self.assertEqual((msg.node_id, msg.msg_type), (node_id, msg_type))
+        self.assertEqual(msg.field_name, field_name)
+        self.assertEqual(msg.data, data[0])
+        self.assertEqual(msg.fields, {'limit': 42})
+
+    def test_status(self):
+        raw = bytearray([2, Message.TYPE_STATUS, 120, 50])
+        msg = Message.parse(raw)
+        node_id, msg_type, _, data = old_parse({}, raw)
+
+        self.assertEqual((msg.node_id, msg.msg_type), (node_id, msg_type))
+        self.assertEqual(bytearray(msg.data), data)
+
+    def test_errors(self):
+        for raw in ([3, Message.TYPE_FIELD_RESPONSE, 9, 1],
+                    [3, Message.TYPE_FIELD_RESPONSE],
+                    [3, 200],
+                    [3]):
+            with self.assertRaises(base.SensorError):
+                MeterMessage.parse(bytearray(raw))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Field requests: batching, asking once for the same field, expiry.
+"""
+import struct
+import unittest
+
+from sensor_modules import import_sensor_module
+
+base = import_sensor_module('sensors.wireless.base')
+codec = import_sensor_module('sensors.wireless.codec')
+simulator = import_sensor_module('sensors.wireless.simulator')
+
+
+class MeterMessage(base.Message):
+    # 5 bytes each in a response, 6 of them fit into one
+    FIELDS = [
+        codec.Field('counter%s' % i, fmt='I', field_id=i)
+        for i in xrange(1, 9)
+    ]
+
+
+class MeterNode(base.Node):
+    NODE_ID = 3
+    MESSAGE_CLASS = MeterMessage
+    NAME = 'meter'
+    SEND_PIPE_ADDR = 0x03
+
+
+class FieldRequestTest(unittest.TestCase):
+    def setUp(self):
+        sim = simulator.Simulation(seed=1)
+        self.sensor = base.WirelessSensor(radio=sim.radio())
+        self.queue = self.sensor.radios[0].tx_queue
+        self.node = MeterNode(self.sensor, self.sensor.radios[0])
+
+    def requested(self):
+        """
+        Field names of the queued requests.
+        """
+        batches = []
+        while True:
+            request = self.queue.pop()
+            if request is None:
+                return batches
+            self.assertEqual(request.msg.msg_type, MeterMessage.TYPE_FIELD_REQUEST)
+            batches.append(request.msg.field_names)
+
+    def respond(self, values):
+        raw = bytearray([self.node.NODE_ID, MeterMessage.TYPE_FIELD_RESPONSE])
+        for name, value in sorted(values.items()):
+            raw += struct.pack('<BI', MeterMessage._field_ids[name], value)
+        self.node.process_new_hw_message(MeterMessage.parse(raw))
+
+    def test_empty(self):
+        future = self.node.request_fields([])
+        self.assertTrue(future.done())
+        self.assertEqual(future.result(), {})
+        self.assertEqual(self.requested(), [])
+
+    def test_unknown_field(self):
+        with self.assertRaises(base.SensorError):
+            self.node.request_fields(['counter1', 'voltage'])
+        self.assertEqual(self.requested(), [])
+
+    def test_batches(self):
+        names = ['counter%s' % i for i in xrange(1, 9)]
+        future = self.node.request_fields(names)
+
+        batches = self.requested()
+        self.assertEqual([len(batch) for batch in batches], [6, 2])
+        self.assertEqual(sorted(sum(batches, [])), names)
+        for batch in batches:
+            payload = MeterMessage(3, MeterMessage.TYPE_FIELD_REQUEST, field_names=batch).format()
+            self.assertLessEqual(len(payload), MeterMessage.MAX_DATA_LEN + 1)
+
+        self.respond({name: i for i, name in enumerate(names[:6])})
+        self.assertFalse(future.done())
+        self.respond({name: 10 for name in names[6:]})
+        self.assertEqual(future.result(0), dict(
+            {name: i for i, name in enumerate(names[:6])},
+            counter7=10,
+            counter8=10,
+        ))
+
+    def test_asked_once(self):
+        first = self.node.request_fields(['counter1', 'counter2'])
+        second = self.node.request_fields(['counter2', 'counter3'])
+        self.assertEqual(
+            sorted(sum(self.requested(), [])),
+            ['counter1', 'counter2', 'counter3'],
+        )
+
+        self.respond({'counter1': 1, 'counter2': 2})
+        self.assertEqual(first.result(0), {'counter1': 1, 'counter2': 2})
+        self.assertFalse(second.done())
+
+        self.respond({'counter3': 3})
+        self.assertEqual(second.result(0), {'counter2': 2, 'counter3': 3})
+        self.assertEqual(self.node.get_value('counter3'), 3)
+
+    def test_expired(self):
+        expired = self.node.request_fields(['counter1', 'counter2'], timeout=0)
+        waiting = self.node.request_fields(['counter2'], timeout=60)
+        self.requested()
+
+        self.node.expire_field_requests()
+        with self.assertRaises(base.SensorError):
+            expired.result(0)
+        self.assertFalse(waiting.done())
+
+        # Nobody waits for it any more, so it's asked again
+        self.node.request_fields(['counter1'])
+        self.assertEqual(self.requested(), [['counter1']])
+
+        self.respond({'counter2': 5})
+        self.assertEqual(waiting.result(0), {'counter2': 5})
+
+
+if __name__ == '__main__':
+    unittest.main()
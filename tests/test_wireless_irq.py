@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+"""
+IRQ mode of WirelessSensor: the radio thread, woken up by the IRQ line,
+and the sensor thread both work with the radio and the nodes.
+"""
+import logging
+import threading
+import unittest
+from time import time, sleep
+
+from sensor_modules import import_sensor_module
+
+WirelessSensor = import_sensor_module('sensors.wireless.base').WirelessSensor
+PowerControlMessage = import_sensor_module('sensors.wireless.power_control').PowerControlMessage
+simulator = import_sensor_module('sensors.wireless.simulator')
+
+IRQ_PIN = 17
+
+
+class LockCheckingRF24(simulator.SimulatedRF24):
+    """
+    Records RF24 calls made without the radio lock, once `radio_lock`
+    is set (`Radio._begin` configures the chip before there's a thread).
+    """
+    def __init__(self, **kwargs):
+        super(LockCheckingRF24, self).__init__(**kwargs)
+        self.radio_lock = None
+        self.unlocked_calls = []
+
+    def _check(self, name):
+        if self.radio_lock is not None and not self.radio_lock._is_owned():
+            self.unlocked_calls.append((name, threading.current_thread().name))
+
+    def available(self):
+        self._check('available')
+        return super(LockCheckingRF24, self).available()
+
+    def read(self, size):
+        self._check('read')
+        return super(LockCheckingRF24, self).read(size)
+
+    def write(self, payload):
+        self._check('write')
+        return super(LockCheckingRF24, self).write(payload)
+
+    def openWritingPipe(self, addr):
+        self._check('openWritingPipe')
+        super(LockCheckingRF24, self).openWritingPipe(addr)
+
+    def startListening(self):
+        self._check('startListening')
+        super(LockCheckingRF24, self).startListening()
+
+    def stopListening(self):
+        self._check('stopListening')
+        super(LockCheckingRF24, self).stopListening()
+
+
+class Lamp(simulator.VirtualNode):
+    """
+    Turns on and off as the hub says, and reports it in its status.
+    """
+    def __init__(self, **kwargs):
+        super(Lamp, self).__init__(node_id=1, pipe_addr=0x01, **kwargs)
+        self.power_on = 0
+        self.status = lambda: [self.power_on]
+
+    def on_message(self, payload):
+        msg_type = bytearray(payload)[0]
+        if msg_type == PowerControlMessage.TYPE_ON:
+            self.power_on = 1
+        elif msg_type == PowerControlMessage.TYPE_OFF:
+            self.power_on = 0
+
+
+class ErrorsHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.ERROR)
+        self.records = []
+
+    def emit(self, record):
+        self.records.append(record)
+
+
+class IrqTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = simulator.Simulation(seed=1)
+        self.gpio = simulator.FakeGPIO()
+        self.rf24 = LockCheckingRF24(
+            simulation=self.sim,
+            gpio=self.gpio,
+            irq_pin=IRQ_PIN,
+        )
+        self.sensor = WirelessSensor(radio=self.rf24, gpio=self.gpio, irq_pin=IRQ_PIN)
+        self.radio = self.sensor.radios[0]
+        self.rf24.radio_lock = self.radio.lock
+        self.lamp = self.sensor.get_node(node_id=1)
+
+        self.errors = ErrorsHandler()
+        logging.getLogger('sensors').addHandler(self.errors)
+        self.started = False
+
+    def tearDown(self):
+        self.sim.stop()
+        if self.started:
+            self.sensor.stop()
+            self.radio.thread.join(2)
+        logging.getLogger('sensors').removeHandler(self.errors)
+
+    def start(self):
+        self.sensor.start()
+        self.started = True
+
+    def fifo_empty(self):
+        with self.radio.lock:
+            return not self.rf24.available()
+
+    def wait_for(self, condition, timeout=2):
+        deadline = time() + timeout
+        while not condition():
+            if time() > deadline:
+                return False
+            sleep(0.005)
+        return True
+
+    def test_irq_setup(self):
+        self.start()
+
+        # Only "RX data ready" pulls the line down
+        self.assertEqual(self.rf24.irq_masks, (True, True, False))
+        self.assertIn(IRQ_PIN, self.gpio._callbacks)
+        self.assertTrue(self.radio.thread.is_alive())
+
+        self.sensor.stop()
+        self.started = False
+        self.radio.thread.join(2)
+
+        self.assertNotIn(IRQ_PIN, self.gpio._callbacks)
+        self.assertFalse(self.radio.thread.is_alive())
+
+    def test_edge_drains_fifo(self):
+        # Nothing but the IRQ wakes the radio thread up
+        self.sensor.IRQ_WAIT_TIMEOUT = 60
+        self.start()
+
+        for power_on in (1, 0, 1):
+            self.rf24.inject(bytearray([1, 0, power_on]))
+        sleep(0.1)
+        self.assertEqual(self.rf24.stats['read'], 0)
+
+        version = self.lamp.state_version
+        self.gpio.fire(IRQ_PIN)
+
+        self.assertTrue(self.lamp.wait_for_state(version, 2))
+        self.assertTrue(self.wait_for(lambda: self.rf24.stats['read'] == 3))
+        self.assertTrue(self.fifo_empty())
+        self.assertEqual(self.lamp.state.data, {'power_on': 1})
+        self.assertTrue(self.lamp.state.is_online)
+        self.assertEqual(self.rf24.unlocked_calls, [])
+
+    def test_concurrent_state_changes(self):
+        """
+        The device reports its status all the time, while the state is
+        changed from another thread: everything received is processed,
+        the radio is used only under its lock, and in the end the hub,
+        the device and the last change agree.
+        """
+        device = self.sim.add_node(Lamp(interval=0.005, seed=2))
+        self.start()
+        self.sim.start()
+        self.assertTrue(self.wait_for(lambda: self.lamp.state.is_online))
+
+        versions = []
+        stop = threading.Event()
+
+        def watch():
+            version = self.lamp.state_version
+            while not stop.is_set():
+                if self.lamp.wait_for_state(version, 0.1):
+                    version = self.lamp.state_version
+                    versions.append(version)
+
+        watcher = threading.Thread(target=watch)
+        watcher.start()
+        try:
+            for i in xrange(100):
+                self.sensor.process_client_message({
+                    'type': 'set_state',
+                    'sensor': self.sensor.NAME,
+                    'node_id': 1,
+                    'state': {'power_on': i % 2},
+                })
+                sleep(0.002)
+            last = 99 % 2
+
+            self.assertTrue(self.wait_for(lambda: device.power_on == last))
+            self.assertTrue(self.wait_for(lambda: self.lamp.state.data == {'power_on': last}))
+        finally:
+            stop.set()
+            watcher.join()
+
+        self.sim.stop()
+        self.assertTrue(self.wait_for(self.fifo_empty))
+        self.assertEqual(self.rf24.stats['read'], self.rf24.stats['rx'])
+        self.assertEqual(self.rf24.unlocked_calls, [])
+        self.assertEqual(versions, sorted(set(versions)))
+        self.assertEqual(self.errors.records, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
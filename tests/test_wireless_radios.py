@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+"""
+Several radios on different channels: which radio a node is talked to with.
+"""
+import unittest
+
+from sensor_modules import import_sensor_module
+
+WirelessSensor = import_sensor_module('sensors.wireless.base').WirelessSensor
+PowerControlMessage = import_sensor_module('sensors.wireless.power_control').PowerControlMessage
+simulator = import_sensor_module('sensors.wireless.simulator')
+
+
+class RadiosTest(unittest.TestCase):
+    def setUp(self):
+        self.sim = simulator.Simulation(seed=1)
+        self.rf24 = [self.sim.radio(), self.sim.radio()]
+        self.sensor = self.create_sensor(WirelessSensor)
+        self.lamp = self.sensor.get_node(node_id=1)
+
+    def create_sensor(self, sensor_cls):
+        return sensor_cls(radios=[
+            {'channel': 0x30, 'rf24': self.rf24[0]},
+            {'channel': 0x40, 'rf24': self.rf24[1]},
+        ])
+
+    def turn_on(self):
+        return self.lamp.send_data(PowerControlMessage(1, PowerControlMessage.TYPE_ON))
+
+    def test_default_radio(self):
+        self.assertIs(self.lamp.radio, self.sensor.radios[0])
+        self.assertIs(self.sensor.get_node(node_id=2).radio, self.sensor.radios[0])
+
+    def test_configured_radio(self):
+        class Sensor(WirelessSensor):
+            NODE_RADIOS = {1: 1}
+
+        sensor = self.create_sensor(Sensor)
+        self.assertIs(sensor.get_node(node_id=1).radio, sensor.radios[1])
+        self.assertIs(sensor.get_node(node_id=2).radio, sensor.radios[0])
+
+    def test_queued_messages_move_with_node(self):
+        first, second = self.sensor.radios
+        device = self.sim.add_node(simulator.VirtualNode(
+            node_id=1, pipe_addr=0x01, interval=0, channel=0x40,
+        ))
+        future = self.turn_on()
+
+        self.rf24[1].inject(bytearray([1, 0, 0]))
+        self.sensor._process_hw_messages(second)
+
+        self.assertIs(self.lamp.radio, second)
+        self.assertEqual(len(first.tx_queue), 0)
+        self.assertEqual(len(second.tx_queue), 1)
+
+        self.sensor._send_queued(second)
+        self.assertTrue(future.result(1))
+        self.assertEqual(self.rf24[0].stats['tx'], 0)
+        self.assertEqual(self.rf24[1].stats['tx'], 1)
+        self.assertEqual(len(device.received), 1)
+
+    def test_sent_with_queue_radio(self):
+        """
+        The node moves after its message is popped: the message still goes
+        with the radio which popped it.
+        """
+        first, second = self.sensor.radios
+        self.turn_on()
+        self.lamp.radio = second
+
+        self.sensor._send_queued(first)
+        self.assertEqual(self.rf24[0].stats['tx'], 1)
+        self.assertEqual(self.rf24[1].stats['tx'], 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,147 @@
+# -*- coding: utf-8 -*-
+"""
+Multi-hop routing: proxy headers and route selection.
+"""
+import unittest
+from time import time
+
+from sensor_modules import import_sensor_module
+
+base = import_sensor_module('sensors.wireless.base')
+routing = import_sensor_module('sensors.wireless.routing')
+simulator = import_sensor_module('sensors.wireless.simulator')
+
+TYPE_PROXY = base.Message.TYPE_PROXY
+
+
+def relay_down(payload):
+    """
+    What a relay does with a message from the hub: (next node id, the rest).
+    """
+    assert payload[0] == TYPE_PROXY
+    return payload[1], payload[2:]
+
+
+def relay_up(relay_id, payload):
+    """
+    What a relay does with a message to the hub.
+    """
+    return bytearray([relay_id, TYPE_PROXY]) + payload
+
+
+class WrapTest(unittest.TestCase):
+    def test_proxy_type(self):
+        self.assertEqual(routing.TYPE_PROXY, TYPE_PROXY)
+
+    def test_direct(self):
+        payload = bytearray([255])
+        self.assertEqual(routing.wrap(payload, 5, [], 32), payload)
+        self.assertEqual(routing.unwrap(bytearray([5, 0, 1])), ([], bytearray([5, 0, 1])))
+
+    def test_wrap(self):
+        self.assertEqual(
+            routing.wrap(bytearray([255]), 5, [3, 4], 32),
+            bytearray([TYPE_PROXY, 4, TYPE_PROXY, 5, 255]),
+        )
+
+    def test_round_trip(self):
+        message = bytearray([5, 0, 1, 2])
+        relays = [3, 4, 6]
+
+        # Device 5 -> 6 -> 4 -> 3 -> hub
+        packet = message
+        for relay in reversed(relays):
+            packet = relay_up(relay, packet)
+
+        learned, received = routing.unwrap(packet)
+        self.assertEqual(learned, relays)
+        self.assertEqual(received, message)
+
+        # And back the same way: hub -> 3 -> 4 -> 6 -> 5
+        payload = bytearray([255, 1])
+        packet = routing.wrap(payload, 5, learned, 32)
+        path = [learned[0]]
+        while path[-1] != 5:
+            next_id, packet = relay_down(packet)
+            path.append(next_id)
+
+        self.assertEqual(path, [3, 4, 6, 5])
+        self.assertEqual(packet, payload)
+
+    def test_too_long(self):
+        payload = bytearray(range(1, 29))
+        self.assertEqual(len(routing.wrap(payload, 5, [3, 4], 32)), 32)
+        with self.assertRaises(base.SensorError):
+            routing.wrap(payload, 5, [3, 4, 6], 32)
+
+
+class RouteTableTest(unittest.TestCase):
+    def setUp(self):
+        self.routes = routing.RouteTable()
+
+    def send(self, node_id, successes, failures):
+        route = self.routes.best(node_id)
+        for _ in xrange(successes):
+            route.add_tx_result(True, 0.01)
+        for _ in xrange(failures):
+            route.add_tx_result(False, 0.01)
+        return route
+
+    def test_unknown_node(self):
+        self.assertEqual(self.routes.best(5).relays, ())
+
+    def test_shorter_wins_without_stats(self):
+        self.routes.learn(5, [3, 4])
+        self.routes.learn(5, [3])
+        self.routes.learn(5, [])
+        self.assertEqual(self.routes.best(5).relays, ())
+
+    def test_multi_hop(self):
+        self.routes.learn(5, [])
+        self.routes.learn(5, [3, 4])
+
+        direct = self.send(5, 1, 10)
+        self.assertEqual(direct.relays, ())
+
+        relayed = self.routes.best(5)
+        self.assertEqual(relayed.relays, (3, 4))
+        for _ in xrange(10):
+            relayed.add_tx_result(True, 0.02)
+        self.assertEqual(self.routes.best(5).relays, (3, 4))
+
+        # Relays got worse, the direct route is back
+        for _ in xrange(50):
+            relayed.add_tx_result(False, 0.02)
+        self.assertEqual(self.routes.best(5).relays, ())
+
+    def test_old_routes_forgotten(self):
+        self.routes.learn(5, [3])
+        self.send(5, 0, 10)
+        self.assertEqual(self.routes.best(5).relays, (3,))
+
+        self.routes._routes[5][(3,)].last_seen = time() - routing.RouteTable.ROUTE_TTL - 1
+        self.assertEqual(self.routes.best(5).relays, ())
+        self.assertNotIn((3,), self.routes._routes[5])
+
+
+class RelayedSendTest(unittest.TestCase):
+    def test_sent_via_relay(self):
+        sim = simulator.Simulation(seed=1)
+        sensor = base.WirelessSensor(radio=sim.radio())
+        radio = sensor.radios[0]
+        relay = sim.add_node(simulator.VirtualNode(node_id=1, pipe_addr=0x01, interval=0))
+
+        # The weather node is heard only through the lamp
+        sensor.routes.learn(2, [1])
+        sensor.routes.best(2).add_tx_result(False, 0.01)
+        self.assertEqual(sensor.routes.best(2).relays, (1,))
+
+        sensor._send_via_route(radio, sensor.get_node(node_id=2), bytearray([100]))
+        self.assertEqual(
+            [bytearray(p) for p in relay.received],
+            [bytearray([TYPE_PROXY, 2, 100])],
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
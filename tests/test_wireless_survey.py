@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+"""
+Channel survey, and moving to the quietest channel.
+"""
+import unittest
+
+from sensor_modules import import_sensor_module
+
+base = import_sensor_module('sensors.wireless.base')
+simulator = import_sensor_module('sensors.wireless.simulator')
+ChannelSurvey = import_sensor_module('sensors.wireless.survey').ChannelSurvey
+
+
+class SurveyTest(unittest.TestCase):
+    def test_quietest(self):
+        survey = ChannelSurvey([1, 2, 3], sweeps=10)
+        survey.histogram.update({1: 5, 2: 0, 3: 0})
+
+        self.assertEqual(survey.quietest(), 2)
+        self.assertEqual(survey.quietest(exclude=[2]), 3)
+        self.assertEqual(survey.quietest(exclude=[1, 2, 3]), None)
+
+    def test_no_candidate_channel(self):
+        class Sensor(base.WirelessSensor):
+            SURVEY_INTERVAL = 60
+            SURVEY_CHANNELS = [0x30, 0x31]
+
+        sim = simulator.Simulation(seed=1)
+        # The other radio is too close to both channels
+        sensor = Sensor(radios=[
+            {'channel': 0x30, 'rf24': sim.radio()},
+            {'channel': 0x31, 'rf24': sim.radio()},
+        ])
+        radio = sensor.radios[0]
+
+        sensor._survey_if_idle(radio)
+        self.assertIsNotNone(radio.last_survey)
+        self.assertEqual(radio.channel, 0x30)
+
+        future = sensor.switch_channel(radio, None)
+        self.assertIsInstance(future.exception(0), base.SensorError)
+        self.assertEqual(radio.channel, 0x30)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+# -*- coding: utf-8 -*-
+"""
+Replay a radio packet capture (see sensors/wireless/capture.py) through
+WirelessSensor message processing.
+
+Received packets are fed to `_process_hw_messages` on a simulated radio,
+either with original timing or as fast as possible. Resulting node states are
+written as JSON, so a capture can be used as a regression test (compare with
+the output of a previous version), and the timing - as a benchmark of the
+decode path. With `--trace` the report also has per-stage latencies
+(see sensors/tracing.py).
+
+    python tools/radio_replay.py /var/log/sensors_radio.cap --speed max \\
+        --output replay.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from time import time, sleep
+
+from sensor_modules import import_sensor_module
+
+# No RF24 and RPi.GPIO, the radio is simulated
+os.environ['WIRELESS_SIMULATOR'] = '1'
+
+WirelessSensor = import_sensor_module('sensors.wireless.base').WirelessSensor
+capture = import_sensor_module('sensors.wireless.capture')
+SimulatedRF24 = import_sensor_module('sensors.wireless.simulator').SimulatedRF24
+tracer = import_sensor_module('sensors.tracing').tracer
+
+log = logging.getLogger('radio_replay')
+
+
+def replay(sensor, rf24, packets, realtime):
+    """
+    :return: (number of packets, seconds spent in processing)
+    """
+    processing = 0.0
+    count = 0
+    first_ts = None
+    started = time()
+
+    for ts, direction, _, payload in packets:
+        if direction != capture.DIRECTION_RX:
+            continue
+
+        if realtime:
+            if first_ts is None:
+                first_ts = ts
+            delay = (ts - first_ts) - (time() - started)
+            if delay > 0:
+                sleep(delay)
+
+        rf24.inject(payload)
+
+        t = time()
+        try:
+            sensor._process_hw_messages(sensor.radios[0])
+        except Exception as ex:
+            log.warning('Error processing packet %s: %s', list(payload), ex)
+        processing += time() - t
+        count += 1
+
+    return count, processing
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('capture', nargs='+', help='Capture files, in order')
+    parser.add_argument('--speed', choices=['original', 'max'], default='max')
+    parser.add_argument('--output', default='replay.json')
+    parser.add_argument('--trace', action='store_true', help='Per-stage latencies')
+    opts = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    radio = SimulatedRF24()
+    # Not started: the only thread touching the radio is ours.
+    sensor = WirelessSensor(radio=radio)
+    tracer.enabled = opts.trace
+
+    count, processing = 0, 0.0
+    for path in opts.capture:
+        c, p = replay(sensor, radio, capture.read_capture(path), opts.speed == 'original')
+        count += c
+        processing += p
+
+    report = {
+        'params': vars(opts),
+        'packets': count,
+        'processing_seconds': round(processing, 4),
+        'packets_per_sec': round(count / processing, 1) if processing else None,
+        'us_per_packet': round(processing / count * 1e6, 2) if count else None,
+        'messages_sent': radio.stats['tx'],
+        'nodes': {
+            node.NAME: {
+                'node_id': node.NODE_ID,
+                'is_online': node.state.is_online,
+                'state': node.state.data,
+            }
+            for node in sensor.get_nodes()
+        },
+    }
+    if opts.trace:
+        report['stages'] = tracer.to_dict()['stages']
+
+    with open(opts.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    log.warning('Results written to %s', opts.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
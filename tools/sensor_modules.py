@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+"""
+Imports sensor modules for the tools, without running `sensors/__init__.py`
+(and `sensors/wireless/__init__.py`), which start every sensor: radio,
+weather API, DHT22... The tools need only the modules they measure.
+
+    socket_server = import_sensor_module('sensors.socket_server')
+"""
+
+import imp
+import importlib
+import os
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def import_sensor_module(name):
+    if ROOT not in sys.path:
+        sys.path.insert(0, ROOT)
+
+    # Parent packages are registered empty, so relative imports work,
+    # but their __init__ modules are not executed.
+    parts = name.split('.')
+    for i in xrange(1, len(parts)):
+        package = '.'.join(parts[:i])
+        if package not in sys.modules:
+            module = imp.new_module(package)
+            module.__path__ = [os.path.join(ROOT, *parts[:i])]
+            sys.modules[package] = module
+
+    return importlib.import_module(name)
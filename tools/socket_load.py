@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+Load generator for the consumer socket server (sensors/socket_server.py).
+
+Starts a SocketServer in this process, connects N consumers to it from a child
+process, registers them across M message streams and fires state-update
+broadcasts (same payload and call as `State.send_update_message`) at a fixed
+rate. A few consumers can be made artificially slow, to see how they affect
+everybody else.
+
+Consumers run in a separate process, so CPU time measured here belongs to the
+server and the broadcaster only.
+
+Results are written as JSON, so runs can be compared before and after
+server changes:
+
+    python tools/socket_load.py --consumers 50 --streams 5 --rate 200 \\
+        --duration 30 --slow 3 --output before.json
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import resource
+import socket
+import sys
+import threading
+from time import time, sleep
+
+from sensor_modules import import_sensor_module
+
+log = logging.getLogger('socket_load')
+
+SENSOR_NAME = 'nrf24l01'
+
+
+def load_socket_server():
+    # Only the socket server module (and tracing), not the sensors.
+    return import_sensor_module('sensors.socket_server')
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+
+    idx = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+    return sorted_values[idx]
+
+
+def summarize(latencies):
+    latencies = sorted(latencies)
+    return {
+        'count': len(latencies),
+        'p50_ms': _to_ms(percentile(latencies, 50)),
+        'p99_ms': _to_ms(percentile(latencies, 99)),
+        'max_ms': _to_ms(latencies[-1] if latencies else None),
+    }
+
+
+def _to_ms(value):
+    if value is None:
+        return None
+    return round(value * 1000, 3)
+
+
+class Consumer(threading.Thread):
+    """
+    Single socket consumer, registered to one stream.
+    Slow consumers sleep between reads and have a tiny receive buffer.
+    """
+
+    def __init__(self, idx, port, msg_stream, slow_delay=None):
+        super(Consumer, self).__init__()
+        self.daemon = True
+        self.idx = idx
+        self.msg_stream = msg_stream
+        self.slow_delay = slow_delay
+        self.latencies = []
+        self.disconnected = False
+        self.registered = threading.Event()
+        self.should_stop = False
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if slow_delay:
+            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, 4096)
+        self._sock.connect(('127.0.0.1', port))
+        self._sock.settimeout(0.5)
+
+    def run(self):
+        self._sock.sendall(json.dumps({
+            'type': 'register',
+            'sensor': SENSOR_NAME,
+            'msg_stream': self.msg_stream,
+        }) + '\n')
+        self.registered.set()
+
+        buf = ''
+        while not self.should_stop:
+            try:
+                chunk = self._sock.recv(4096 if not self.slow_delay else 256)
+            except socket.timeout:
+                continue
+            except socket.error:
+                self.disconnected = True
+                break
+
+            if not chunk:
+                self.disconnected = True
+                break
+
+            received_at = time()
+            buf += chunk
+            lines = buf.split('\n')
+            buf = lines.pop()
+
+            for line in lines:
+                if not line:
+                    continue
+                data = json.loads(line)
+                self.latencies.append(received_at - data['sent_at'])
+
+            if self.slow_delay:
+                sleep(self.slow_delay)
+
+        self._sock.close()
+
+    def result(self):
+        return {
+            'idx': self.idx,
+            'msg_stream': self.msg_stream,
+            'slow': bool(self.slow_delay),
+            'disconnected': self.disconnected,
+            'latencies': self.latencies,
+        }
+
+
+def run_consumers(opts, ready, stop, results):
+    consumers = []
+    for i in xrange(opts.consumers):
+        consumers.append(Consumer(
+            idx=i,
+            port=opts.port,
+            msg_stream=str(i % opts.streams),
+            slow_delay=opts.slow_delay if i < opts.slow else None,
+        ))
+
+    for consumer in consumers:
+        consumer.start()
+    for consumer in consumers:
+        consumer.registered.wait()
+    ready.set()
+
+    stop.wait()
+    # Let in-flight messages arrive.
+    sleep(opts.drain)
+
+    for consumer in consumers:
+        consumer.should_stop = True
+    for consumer in consumers:
+        consumer.join()
+        results.put(consumer.result())
+
+
+def wait_for_registrations(server, count, timeout=10):
+    deadline = time() + timeout
+    while time() < deadline:
+        with server.server_lock:
+            registered = sum(
+                len(fnos)
+                for fnos in server.registrations.get(SENSOR_NAME, {}).itervalues()
+            )
+        if registered >= count:
+            return
+        sleep(0.01)
+
+    raise RuntimeError('Only %s of %s consumers registered' % (registered, count))
+
+
+def render_state(seq, msg_stream):
+    """
+    Same shape as `State.render_to_response`, plus timing info.
+    """
+    return {
+        'sensor': SENSOR_NAME,
+        'node_id': int(msg_stream),
+        'msg_stream': msg_stream,
+        'is_online': True,
+        'type': 'state',
+        'state': {'power_on': seq % 2},
+        'seq': seq,
+        'sent_at': time(),
+    }
+
+
+def broadcast(server, opts):
+    interval = 1.0 / opts.rate
+    sent_by_stream = {}
+    call_durations = []
+
+    started = time()
+    next_at = started
+    seq = 0
+
+    while time() - started < opts.duration:
+        msg_stream = str(seq % opts.streams)
+
+        call_started = time()
+        server.send_broadcast_message(
+            render_state(seq, msg_stream),
+            SENSOR_NAME,
+            msg_stream,
+        )
+        call_durations.append(time() - call_started)
+        sent_by_stream[msg_stream] = sent_by_stream.get(msg_stream, 0) + 1
+        seq += 1
+
+        next_at += interval
+        delay = next_at - time()
+        if delay > 0:
+            sleep(delay)
+
+    return sent_by_stream, call_durations, time() - started
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--consumers', type=int, default=20)
+    parser.add_argument('--streams', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=100,
+                        help='Broadcasts per second, over all streams')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds')
+    parser.add_argument('--slow', type=int, default=2,
+                        help='How many consumers are slow')
+    parser.add_argument('--slow-delay', type=float, default=0.05,
+                        help='Pause of slow consumers after every read')
+    parser.add_argument('--drain', type=float, default=1,
+                        help='Seconds to wait for in-flight messages')
+    parser.add_argument('--port', type=int, default=10151)
+    parser.add_argument('--output', default='socket_load.json')
+    opts = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    socket_server = load_socket_server()
+    server = socket_server.SocketServer(opts.port)
+    sleep(0.5)  # Let the listener bind
+
+    ready = multiprocessing.Event()
+    stop = multiprocessing.Event()
+    results = multiprocessing.Queue()
+    proc = multiprocessing.Process(
+        target=run_consumers,
+        args=(opts, ready, stop, results),
+    )
+    proc.start()
+
+    ready.wait()
+    wait_for_registrations(server, opts.consumers)
+
+    cpu_started = cpu_time()
+    sent_by_stream, call_durations, elapsed = broadcast(server, opts)
+    cpu_used = cpu_time() - cpu_started
+
+    stop.set()
+    consumers = [results.get() for _ in xrange(opts.consumers)]
+    proc.join()
+
+    all_latencies = []
+    fast_latencies = []
+    slow_latencies = []
+    expected = 0
+    for consumer in consumers:
+        expected += sent_by_stream.get(consumer['msg_stream'], 0)
+        all_latencies.extend(consumer['latencies'])
+        if consumer['slow']:
+            slow_latencies.extend(consumer['latencies'])
+        else:
+            fast_latencies.extend(consumer['latencies'])
+
+    report = {
+        'params': vars(opts),
+        'broadcasts_sent': sum(sent_by_stream.values()),
+        'deliveries_expected': expected,
+        'deliveries_received': len(all_latencies),
+        'throughput_msg_per_sec': round(len(all_latencies) / elapsed, 1),
+        'consumers_disconnected': sum(1 for c in consumers if c['disconnected']),
+        'latency': summarize(all_latencies),
+        'latency_fast_consumers': summarize(fast_latencies),
+        'latency_slow_consumers': summarize(slow_latencies),
+        'broadcast_call': summarize(call_durations),
+        'server_cpu': {
+            'seconds': round(cpu_used, 3),
+            'percent': round(100 * cpu_used / elapsed, 1),
+        },
+    }
+
+    with open(opts.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    log.warning('Results written to %s', opts.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
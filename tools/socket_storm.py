@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Connection storm benchmark for the consumer socket server.
+
+Simulates all consumers reconnecting at once (e.g. after a deploy restart):
+K connections are opened as fast as possible, every one immediately sends
+R pipelined requests. Measures how fast the server accepts the connections
+and reads the requests.
+
+    python tools/socket_storm.py --connections 500 --requests 20 --output storm.json
+"""
+
+import argparse
+import json
+import logging
+import multiprocessing
+import socket
+import sys
+import threading
+from time import time, sleep
+
+from socket_load import load_socket_server, SENSOR_NAME
+
+log = logging.getLogger('socket_storm')
+
+
+def run_clients(opts, start, done):
+    request = json.dumps({
+        'type': 'get_state',
+        'sensor': SENSOR_NAME,
+        'node_id': 1,
+    }) + '\n'
+    payload = request * opts.requests
+
+    connections = []
+    lock = threading.Lock()
+
+    def connect(count):
+        for _ in xrange(count):
+            sock = socket.create_connection(('127.0.0.1', opts.port))
+            sock.sendall(payload)
+            with lock:
+                connections.append(sock)
+
+    per_thread = opts.connections // opts.threads
+    counts = [per_thread] * opts.threads
+    counts[-1] += opts.connections - per_thread * opts.threads
+
+    threads = [threading.Thread(target=connect, args=(c,)) for c in counts]
+
+    start.wait()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    # Keep connections open until the server has read everything.
+    done.wait()
+    for sock in connections:
+        sock.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--connections', type=int, default=200)
+    parser.add_argument('--requests', type=int, default=10,
+                        help='Pipelined requests per connection')
+    parser.add_argument('--threads', type=int, default=8,
+                        help='Client threads opening connections')
+    parser.add_argument('--timeout', type=float, default=30)
+    parser.add_argument('--port', type=int, default=10152)
+    parser.add_argument('--output', default='socket_storm.json')
+    opts = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    socket_server = load_socket_server()
+    server = socket_server.SocketServer(opts.port)
+    sleep(0.5)  # Let the listener bind
+
+    start = multiprocessing.Event()
+    done = multiprocessing.Event()
+    proc = multiprocessing.Process(target=run_clients, args=(opts, start, done))
+    proc.start()
+
+    expected_messages = opts.connections * opts.requests
+    accepted_at = None
+    messages = 0
+
+    started = time()
+    start.set()
+
+    while time() - started < opts.timeout:
+        messages += len(server.get_messages())
+
+        if accepted_at is None and len(server.active_sockets) >= opts.connections:
+            accepted_at = time()
+
+        if accepted_at is not None and messages >= expected_messages:
+            break
+
+        sleep(0.001)
+
+    finished_at = time()
+    connections_accepted = len(server.active_sockets)
+    done.set()
+    proc.join()
+
+    accept_time = (accepted_at or finished_at) - started
+    total_time = finished_at - started
+
+    report = {
+        'params': vars(opts),
+        'connections_accepted': connections_accepted,
+        'messages_read': messages,
+        'messages_expected': expected_messages,
+        'accept_seconds': round(accept_time, 4),
+        'accept_per_sec': round(opts.connections / accept_time, 1),
+        'total_seconds': round(total_time, 4),
+        'messages_per_sec': round(messages / total_time, 1),
+        'timed_out': messages < expected_messages,
+    }
+
+    with open(opts.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    log.warning('Results written to %s', opts.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+Load test of WirelessSensor on the simulated radio.
+
+Creates N virtual lamps, which say hello and then send status updates with
+total rate R packets per second, with given loss/latency/ACK failure rates.
+Measures how many packets reach the hub and get processed.
+
+    python tools/wireless_load.py --nodes 100 --rate 2000 --duration 10 \\
+        --loss 0.05 --irq --output wireless.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import sys
+from time import time, sleep
+
+from sensor_modules import import_sensor_module
+
+# No RF24 and RPi.GPIO, the radio is simulated
+os.environ['WIRELESS_SIMULATOR'] = '1'
+
+WirelessSensor = import_sensor_module('sensors.wireless.base').WirelessSensor
+PowerControlNode = import_sensor_module('sensors.wireless.power_control').PowerControlNode
+simulator = import_sensor_module('sensors.wireless.simulator')
+
+log = logging.getLogger('wireless_load')
+
+IRQ_PIN = 17
+FIRST_NODE_ID = 10
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--nodes', type=int, default=50)
+    parser.add_argument('--rate', type=float, default=1000,
+                        help='Status packets per second, all nodes together')
+    parser.add_argument('--duration', type=float, default=10)
+    parser.add_argument('--loss', type=float, default=0.0)
+    parser.add_argument('--ack-failure', type=float, default=0.0)
+    parser.add_argument('--latency-ms', type=float, default=0.0,
+                        help='Max delivery latency, uniformly distributed')
+    parser.add_argument('--fifo', type=int, default=3, help='RX FIFO size')
+    parser.add_argument('--irq', action='store_true', help='Use IRQ mode')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='wireless_load.json')
+    opts = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING)
+
+    sim = simulator.Simulation(seed=opts.seed)
+    gpio = simulator.FakeGPIO()
+    radio = sim.radio(
+        rx_fifo_size=opts.fifo,
+        gpio=gpio,
+        irq_pin=IRQ_PIN if opts.irq else None,
+    )
+
+    sensor = WirelessSensor(
+        radio=radio,
+        gpio=gpio,
+        irq_pin=IRQ_PIN if opts.irq else None,
+    )
+
+    nodes = []
+    for i in xrange(opts.nodes):
+        counter = [0]
+
+        def status(counter=counter):
+            counter[0] = (counter[0] + 1) % 256
+            return [counter[0] % 2]
+
+        nodes.append(sim.add_node(simulator.VirtualNode(
+            node_id=FIRST_NODE_ID + i,
+            node_type=PowerControlNode.NODE_TYPE,
+            pipe_addr=PowerControlNode.LISTEN_PIPE_ADDR,
+            status=status,
+            interval=float(opts.nodes) / opts.rate,
+            loss=opts.loss,
+            ack_failure=opts.ack_failure,
+            latency=(0, opts.latency_ms / 1000.0),
+            channel=sensor.CHANNEL,
+            seed=opts.seed + i,
+            addressed=True,
+        )))
+
+    sensor.start()
+    for node in nodes:
+        while not node.send_hello():
+            sleep(0.001)
+
+    started = time()
+    sim.start()
+    sleep(opts.duration)
+    sim.stop()
+    elapsed = time() - started
+    # Let the hub read what is left in FIFO
+    sleep(0.5)
+    sensor.stop()
+
+    sent = sum(n.stats['sent'] for n in nodes)
+    processed = radio.stats['read']
+    report = {
+        'params': vars(opts),
+        'nodes_registered': len(sensor.get_nodes()),
+        'packets_sent': sent,
+        'packets_acked': sum(n.stats['acked'] for n in nodes),
+        'packets_processed': processed,
+        'processed_per_sec': round(processed / elapsed, 1),
+        'radio': radio.stats,
+        'delivery_ratio': round(float(processed) / sent, 4) if sent else None,
+    }
+
+    with open(opts.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+
+    log.warning('Results written to %s', opts.output)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())